@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks of hot paths (entity wrapping, check engine, transliteration, distance, source entity handling,
+report generation) on synthetic data. Each benchmark reports operations per second and memory it allocates,
+and results are stored for each commit, so regressions between commits are visible:
+
+    python benchmark/run_benchmarks.py --entities 100000
+    python benchmark/run_benchmarks.py --compare <commit>
+"""
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import simplejson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic_pbf import BBOX, generate_entities, write_pbf
+
+# Benchmarks slower than this (relative to compared run) are reported as regressions
+REGRESSION_THRESHOLD = 0.1
+BENCHMARKS = []
+# Temporary files made by benchmarks, removed once all benchmarks are done
+TEMP_FILES = []
+
+
+def benchmark(name):
+    """
+    Registers benchmark. Benchmark function gets list of synthetic entities and returns function which runs
+    the benchmark once and returns number of operations it did.
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+def temp_filename(suffix):
+    """
+    :return: Name of new temporary file, which is removed after all benchmarks are done
+    """
+    fd, filename = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    TEMP_FILES.append(filename)
+    return filename
+
+
+@benchmark('osm_lint_entity')
+def bench_osm_lint_entity(raw_entities):
+    from osm_lint_entity import OsmLintEntity
+
+    def run():
+        for raw_entity in raw_entities:
+            OsmLintEntity(raw_entity)
+        return len(raw_entities)
+    return run
+
+
+def _offline_checks():
+    """
+    :return: Checks which do not need Wikipedia/Wikidata (so they measure our code, not network)
+    """
+    import checks
+    return [checks.NameMissingCheck, checks.NameCyrillicCheck, checks.LatinNameExistsCheck,
+            checks.LatinNameSameAsCyrillicCheck, checks.LatinNameNotInCyrillicCheck]
+
+
+def _check_context():
+    return {'fix': False, 'dry_run': True, 'map-check': {'name': 'Synthetic', 'suite': 'Synthetic'}}
+
+
+@benchmark('check_all')
+def bench_check_all(raw_entities):
+    from engine import CheckEngine
+    from osm_lint_entity import OsmLintEntity
+    check_classes = _offline_checks()
+    entities = [OsmLintEntity(raw_entity) for raw_entity in raw_entities]
+    context = _check_context()
+
+    def run():
+        for entity in entities:
+            CheckEngine(check_classes, entity, context).check_all()
+        return len(entities)
+    return run
+
+
+@benchmark('check_chunk')
+def bench_check_chunk(raw_entities):
+    from engine import check_chunk
+    from osm_lint_entity import OsmLintEntity
+    check_classes = _offline_checks()
+    entities = [OsmLintEntity(raw_entity) for raw_entity in raw_entities]
+    context = _check_context()
+
+    def run():
+        for i in range(0, len(entities), 1000):
+            check_chunk(check_classes, entities[i:i + 1000], context)
+        return len(entities)
+    return run
+
+
+@benchmark('cyr2lat')
+def bench_cyr2lat(raw_entities):
+    from transliteration import cyr2lat
+    names = [raw_entity.tags['name'] for raw_entity in raw_entities if 'name' in raw_entity.tags]
+
+    def run():
+        for name in names:
+            cyr2lat(name)
+        return len(names)
+    return run
+
+
+@benchmark('at_least_some_in_cyrillic')
+def bench_at_least_some_in_cyrillic(raw_entities):
+    from transliteration import at_least_some_in_cyrillic, cyr2lat
+    names = [raw_entity.tags['name'] for raw_entity in raw_entities if 'name' in raw_entity.tags]
+    # Latin names are the worst case, whole name is looked at
+    names = names + [cyr2lat(name) for name in names]
+
+    def run():
+        for name in names:
+            at_least_some_in_cyrillic(name)
+        return len(names)
+    return run
+
+
+@benchmark('haversine')
+def bench_haversine(raw_entities):
+    from haversine import haversine
+    points = [(raw_entity.lat, raw_entity.lon) for raw_entity in raw_entities]
+    center = ((BBOX[0] + BBOX[2]) / 2, (BBOX[1] + BBOX[3]) / 2)
+
+    def run():
+        for point in points:
+            haversine(center, point)
+        return len(points)
+    return run
+
+
+@benchmark('entity_found')
+def bench_entity_found(raw_entities):
+    from sources.osm_source import OSMSource
+
+    class SyntheticSource(OSMSource):
+        def _process_map(self):
+            for raw_entity in raw_entities:
+                self._entity_found(raw_entity)
+
+    def run():
+        # Checks are not performed, only entity handling in source (wrapping, filtering, chunking) is measured
+        source = SyntheticSource({}, [{'name': 'Synthetic'}], lambda entities, context: [{}] * len(entities))
+        source.process_map()
+        return len(raw_entities)
+    return run
+
+
+@benchmark('generate_report')
+def bench_generate_report(raw_entities):
+    import main
+    from engine import check_chunk
+    from osm_lint_entity import OsmLintEntity
+    check_classes = _offline_checks()
+    entities = [OsmLintEntity(raw_entity) for raw_entity in raw_entities]
+    all_checks = {'Synthetic (synthetic.osm.pbf)': {}}
+    for i in range(0, len(entities), 1000):
+        chunk = entities[i:i + 1000]
+        for entity, checks_done in zip(chunk, check_chunk(check_classes, chunk, _check_context())):
+            if len(checks_done) > 0:
+                all_checks['Synthetic (synthetic.osm.pbf)'][(entity.entity_type, entity.id)] = (
+                    entity.tags.get('name', str(entity.id)), entity.entity_type, checks_done)
+    report_filename = temp_filename('.html')
+
+    def run():
+        main.generate_report({'report_filename': report_filename}, all_checks)
+        return len(all_checks['Synthetic (synthetic.osm.pbf)'])
+    return run
+
+
+@benchmark('pbf_read')
+def bench_pbf_read(raw_entities):
+    # This import is here since user doesn't have to have it (optional)
+    import osmium
+    from sources.pbf_source import PBFSource
+    pbf_filename = temp_filename('.osm.pbf')
+    write_pbf(pbf_filename, len(raw_entities))
+    map_checks = [{'name': 'Synthetic', 'location': pbf_filename, 'checks': [], 'rules': []}]
+
+    def run():
+        source = PBFSource({}, lambda entities, context: [{}] * len(entities), map_checks, pbf_filename)
+        source.process_map_with_osmium(pbf_filename)
+        return source.processed
+    return run
+
+
+def measure(run, repeat):
+    """
+    :return: Dictionary with best time of given number of runs, and memory allocated in one more run
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operations = run()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        run()
+        end_size, peak_size = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'operations': operations,
+        'seconds': best,
+        'ops_per_second': operations / best if best > 0 else 0.0,
+        'peak_bytes': peak_size - start_size,
+        'retained_bytes': end_size - start_size,
+        'bytes_per_operation': (peak_size - start_size) / operations if operations > 0 else 0.0,
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], universal_newlines=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def same_parameters(run, args):
+    """
+    :return: True if stored run was made on the same synthetic data as asked for now, so they can be compared
+    """
+    return run.get('entities') == args.entities and run.get('place_density') == args.place_density
+
+
+def compare(results, baseline):
+    """
+    Prints change of each benchmark against baseline run
+    :return: List of names of benchmarks which regressed
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = result['ops_per_second'] / baseline[name]['ops_per_second'] - 1 \
+            if baseline[name]['ops_per_second'] > 0 else 0.0
+        regressed = change < -REGRESSION_THRESHOLD
+        if regressed:
+            regressions.append(name)
+        print('{0:30} {1:+7.1%}{2}'.format(name, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs micro-benchmarks on synthetic data.')
+    parser.add_argument('--entities', metavar='N', type=int, default=100000,
+                        help='Number of synthetic nodes to run benchmarks on. Default is 100000.')
+    parser.add_argument('--place-density', metavar='P', type=float, default=0.01,
+                        help='Part of nodes which are places (cities, towns, villages). Default is 0.01.')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='Each benchmark is run this many times and the best time is taken. Default is 3.')
+    parser.add_argument('--only', metavar='NAME', action='append',
+                        help='Run only given benchmark. Can be given more times. Available: {0}.'.format(
+                            ', '.join(name for name, _ in BENCHMARKS)))
+    parser.add_argument('--results-file', metavar='FILE',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json'),
+                        help='File where results of each commit are stored. Default is benchmark/results.json.')
+    parser.add_argument('--compare', metavar='COMMIT',
+                        help='Compare with stored results of this commit. Default is the last other commit stored.')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='Exit with error if any benchmark is more than {0:.0%} slower than compared run.'.format(
+                            REGRESSION_THRESHOLD))
+    args = parser.parse_args()
+    if args.entities <= 0 or args.repeat <= 0:
+        parser.error('--entities and --repeat must be greater than 0')
+
+    raw_entities = list(generate_entities(args.entities, args.place_density))
+    results = {}
+    try:
+        for name, func in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            try:
+                run = func(raw_entities)
+            except ImportError as e:
+                print('{0:30} skipped ({1})'.format(name, e))
+                continue
+            results[name] = measure(run, args.repeat)
+            print('{0:30} {1:12,.0f} ops/s {2:10,.0f} KB peak {3:8.1f} B/op'.format(
+                name, results[name]['ops_per_second'], results[name]['peak_bytes'] / 1024,
+                results[name]['bytes_per_operation']))
+    finally:
+        for filename in TEMP_FILES:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    all_results = {}
+    if os.path.isfile(args.results_file):
+        with open(args.results_file, 'r', encoding='utf-8') as f:
+            all_results = simplejson.load(f)
+    commit = current_commit()
+    baseline_commit = args.compare
+    if baseline_commit is None:
+        # Only runs on the same synthetic data can be compared
+        others = [c for c in all_results if c != commit and same_parameters(all_results[c], args)]
+        baseline_commit = max(others, key=lambda c: all_results[c]['date']) if others else None
+    all_results[commit] = {'date': datetime.datetime.now().isoformat(), 'entities': args.entities,
+                           'place_density': args.place_density, 'benchmarks': results}
+    with open(args.results_file, 'w', encoding='utf-8') as f:
+        simplejson.dump(all_results, f, indent=2, sort_keys=True)
+
+    if baseline_commit is None:
+        return
+    if baseline_commit not in all_results:
+        parser.error('There are no stored results for commit {0}'.format(baseline_commit))
+    if not same_parameters(all_results[baseline_commit], args):
+        parser.error('Results of commit {0} are for --entities {1} --place-density {2}, they cannot be compared'.format(
+            baseline_commit, all_results[baseline_commit].get('entities'),
+            all_results[baseline_commit].get('place_density')))
+    print('\nChange against {0}:'.format(baseline_commit))
+    regressions = compare(results, all_results[baseline_commit]['benchmarks'])
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
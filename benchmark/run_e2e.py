@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of the whole run, offline. Local stand-ins of all external services are started (see
+standins.py), main.py is run against them (all requests to real hosts are redirected with --redirect-host), and
+wall time, number of requests to each service and peak memory of each stage of each map are reported:
+
+    python benchmark/run_e2e.py --entities 200000 --latency 0.05 --rate sophox=2:4
+    python benchmark/run_e2e.py --fix --wiki-checks
+
+Anything after "--" is passed to main.py as is.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import simplejson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import standins
+from synthetic_pbf import generate_entities, write_pbf
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PBF_PATH = '/europe/synthetic-latest.osm.pbf'
+OFFLINE_CHECKS = ['checks.NameMissingCheck', 'checks.NameCyrillicCheck', 'checks.LatinNameExistsCheck',
+                  'checks.LatinNameSameAsCyrillicCheck', 'checks.LatinNameNotInCyrillicCheck']
+WIKI_CHECKS = ['checks.WikipediaEntryValidCheck', 'checks.WikidataEntryValidCheck',
+               'checks.WikipediaAndWikidataInSyncCheck', 'checks.WikidataEntryExistsCheck']
+
+
+def start_stand_ins(entities, pbf_filename, latency, rates, recordings_dir):
+    """
+    :return: List of started stand-ins
+    """
+    def kwargs(name):
+        return {'latency': latency, 'rate': rates.get(name), 'recordings_dir': recordings_dir}
+
+    stand_ins = [standins.Sophox(entities, **kwargs('sophox')),
+                 standins.Wikipedia(entities, **kwargs('wikipedia')),
+                 standins.Wikidata(entities, **kwargs('wikidata')),
+                 standins.OsmApi(entities, **kwargs('osm'))]
+    if pbf_filename is not None:
+        stand_ins.append(standins.Geofabrik({PBF_PATH: pbf_filename}, **kwargs('geofabrik')))
+    for stand_in in stand_ins:
+        stand_in.start()
+    return stand_ins
+
+
+def write_config(work_dir, with_pbf, wiki_checks):
+    maps = {'Sophox adding name': os.path.join(ROOT, 'sparql', 'adding_name.sparql')}
+    if with_pbf:
+        maps['PBF'] = 'https://download.geofabrik.de' + PBF_PATH
+    config = {'Synthetic checks': {
+        'maps': maps,
+        'checks': OFFLINE_CHECKS + (WIKI_CHECKS if wiki_checks else []) + ['checks.GenericSophoxCheck']
+    }}
+    filename = os.path.join(work_dir, 'config.json')
+    with open(filename, 'w', encoding='utf-8') as f:
+        simplejson.dump(config, f, indent=2)
+    return filename
+
+
+def memory_by_stage(memory_profile):
+    """
+    :return: Dictionary of map name -> stage -> peak RSS (in MB)
+    """
+    memory = {}
+    for map_name, profile in dict(memory_profile.get('maps', {}), main=memory_profile.get('main')).items():
+        if profile is None:
+            continue
+        memory[map_name] = {s['stage']: s['stage_peak_rss'] / (1024 * 1024) for s in profile['stages']}
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs whole lint offline, against local stand-ins of external '
+                                                 'services, and reports how long it took.')
+    parser.add_argument('--entities', metavar='N', type=int, default=100000,
+                        help='Number of synthetic nodes. Default is 100000.')
+    parser.add_argument('--place-density', metavar='P', type=float, default=0.01,
+                        help='Part of nodes which are places (cities, towns, villages). Default is 0.01.')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.0,
+                        help='Latency of each response of each stand-in. Default is 0.')
+    parser.add_argument('--rate', metavar='SERVICE=RATE[:BURST]', action='append', default=[],
+                        help='Requests per second stand-in of service ({0}) accepts, requests over it get 429. '
+                             'Can be given more times. Default is no limit.'.format(
+                                 ', '.join(s.name for s in (standins.Geofabrik, standins.Sophox, standins.Wikipedia,
+                                                            standins.Wikidata, standins.OsmApi))))
+    parser.add_argument('--recordings-dir', metavar='DIR',
+                        help='Directory with recorded responses, served instead of synthetic ones (see standins.py).')
+    parser.add_argument('--wiki-checks', action='store_true',
+                        help='Also perform checks using Wikipedia and Wikidata.')
+    parser.add_argument('--fix', action='store_true',
+                        help='Run in fix mode, confirming every fix. Fixes are uploaded to OSM API stand-in.')
+    parser.add_argument('--results-file', metavar='FILE', help='If given, results are written to this file as JSON.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep working directory (config, report, logs, stats) after the run.')
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help='Arguments passed to main.py, after "--".')
+    args = parser.parse_args()
+
+    rates = {}
+    for rate in args.rate:
+        try:
+            service, value = rate.split('=')
+            value, _, burst = value.partition(':')
+            rates[service] = (float(value), int(burst) if burst else max(1, int(float(value))))
+        except ValueError:
+            parser.error('--rate must be in format SERVICE=RATE[:BURST]')
+    main_args = args.main_args[1:] if args.main_args[:1] == ['--'] else args.main_args
+
+    work_dir = tempfile.mkdtemp(prefix='serbian-osm-lint-e2e_')
+    entities = list(generate_entities(args.entities, args.place_density))
+    pbf_filename = os.path.join(work_dir, 'synthetic.osm.pbf')
+    try:
+        write_pbf(pbf_filename, args.entities, args.place_density)
+    except ImportError:
+        print('PyOsmium is not installed, PBF map is not used (only Sophox)')
+        pbf_filename = None
+
+    stand_ins = start_stand_ins(entities, pbf_filename, args.latency, rates, args.recordings_dir)
+    try:
+        config_filename = write_config(work_dir, pbf_filename is not None, args.wiki_checks)
+        password_filename = os.path.join(work_dir, 'osm-password')
+        with open(password_filename, 'w') as f:
+            f.write('synthetic@example.com:synthetic\n')
+
+        command = [sys.executable, os.path.join(ROOT, 'src', 'main.py'),
+                   '--config-file', config_filename,
+                   '--output-file', os.path.join(work_dir, 'report.html'),
+                   '--password-file', password_filename,
+                   '--download-dir', os.path.join(work_dir, 'downloads'),
+                   '--sophox-cache-ttl', '0',
+                   '--stats-file', os.path.join(work_dir, 'stats.json'),
+                   '--memory-profile', os.path.join(work_dir, 'memory.json')]
+        for stand_in in stand_ins:
+            for host in stand_in.hosts:
+                command.extend(['--redirect-host', '{0}={1}'.format(host, stand_in.url)])
+        command.append('--fix' if args.fix else '--dry-run')
+        command.extend(main_args)
+
+        start = time.time()
+        with open(os.path.join(work_dir, 'output.log'), 'w', encoding='utf-8') as log:
+            # In fix mode, every question is answered with "yes"
+            process = subprocess.run(command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT,
+                                     input=('y\n' * args.entities if args.fix else ''), universal_newlines=True)
+        wall_time = time.time() - start
+    finally:
+        for stand_in in stand_ins:
+            stand_in.stop()
+
+    memory = {}
+    if os.path.isfile(os.path.join(work_dir, 'memory.json')):
+        with open(os.path.join(work_dir, 'memory.json'), 'r', encoding='utf-8') as f:
+            memory = memory_by_stage(simplejson.load(f))
+    results = {
+        'entities': args.entities,
+        'exit_code': process.returncode,
+        'wall_time': wall_time,
+        'services': {stand_in.name: stand_in.stats() for stand_in in stand_ins},
+        'peak_rss_mb': memory,
+    }
+
+    print('Exit code {0}, wall time {1:.1f} s'.format(process.returncode, wall_time))
+    for name, stats in sorted(results['services'].items()):
+        print('{0:12} {1:6} requests {2:5} throttled {3:10,} bytes'.format(
+            name, sum(stats['requests'].values()), stats['throttled'], stats['bytes_sent']))
+    for map_name, stages in sorted(memory.items()):
+        print('{0}: {1}'.format(map_name, ', '.join('{0} {1:.0f} MB'.format(stage, peak)
+                                                     for stage, peak in stages.items())))
+    if args.results_file is not None:
+        with open(args.results_file, 'w', encoding='utf-8') as f:
+            simplejson.dump(results, f, indent=2)
+    if args.keep or process.returncode != 0:
+        print('Output, report and stats are in {0}'.format(work_dir))
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(process.returncode)
+
+
+if __name__ == '__main__':
+    main()
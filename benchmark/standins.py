@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-ins for all external services (Geofabrik, Sophox, Wikipedia, Wikidata, OSM API), so whole run can be
+reproduced and measured offline. Each stand-in is a local HTTP server answering with synthetic responses made from
+synthetic entities (see synthetic_pbf.py), with configurable latency and rate (requests over the rate get 429).
+
+Responses which are not synthesised here (or which should be exactly as real service answers) can be recorded.
+Recorded response is looked up in <recordings dir>/<service>/<key>.json, where key is SHA1 of
+"<METHOD> <path with query>\\n<body>", and file has "status", "headers" and "body" keys.
+"""
+
+import collections
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import zlib
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from haversine import haversine
+from sources.sophox_source import p_center, p_radius
+
+WKT_LITERAL = 'http://www.opengis.net/ont/geosparql#wktLiteral'
+TIMESTAMP = '2018-01-01T00:00:00Z'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, same as real services, so connection pooling is measured too
+    protocol_version = 'HTTP/1.1'
+
+    def _serve(self):
+        self.server.stand_in.serve(self)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _serve
+
+    def log_message(self, *args):
+        pass
+
+
+class StandIn(object):
+    """
+    One stand-in service, running on its own local port
+    """
+    name = None
+    # Hosts of real service this stand-in replaces
+    hosts = ()
+
+    def __init__(self, latency=0.0, rate=None, recordings_dir=None):
+        """
+        :param latency: Seconds each response is delayed for
+        :param rate: Tuple (requests per second, burst). Requests over it are answered with 429. None for no limit
+        :param recordings_dir: Directory with recorded responses, if any
+        """
+        self.latency = latency
+        self.rate = rate
+        self.recordings_dir = recordings_dir
+        self.lock = threading.Lock()
+        self.tokens = rate[1] if rate is not None else 0
+        self.updated = time.time()
+        # Number of requests by HTTP method, number of throttled requests and bytes sent
+        self.requests = collections.Counter()
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        return {'requests': dict(self.requests), 'throttled': self.throttled, 'bytes_sent': self.bytes_sent}
+
+    def _throttle(self):
+        """
+        :return: True if request is over the rate and should be rejected
+        """
+        if self.rate is None:
+            return False
+        rate, burst = self.rate
+        with self.lock:
+            now = time.time()
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.throttled = self.throttled + 1
+                return True
+            self.tokens = self.tokens - 1
+            return False
+
+    def _recorded(self, method, path, body):
+        if self.recordings_dir is None:
+            return None
+        key = hashlib.sha1('{0} {1}\n'.format(method, path).encode('utf-8') + body).hexdigest()
+        filename = os.path.join(self.recordings_dir, self.name, key + '.json')
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r', encoding='utf-8') as f:
+            recorded = json.load(f)
+        return recorded.get('status', 200), recorded.get('headers', {}), recorded['body'].encode('utf-8')
+
+    def serve(self, handler):
+        method = handler.command
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        with self.lock:
+            self.requests[method] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if self._throttle():
+            status, headers, response = 429, {'Retry-After': '1'}, b''
+        else:
+            response = self._recorded(method, handler.path, body)
+            if response is None:
+                parsed = urlparse(handler.path)
+                params = dict(parse_qsl(parsed.query))
+                if handler.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode('utf-8')))
+                response = self.respond(method, parsed.path, params, body, handler.headers)
+            status, headers, response = response
+
+        handler.send_response(status)
+        for header, value in headers.items():
+            handler.send_header(header, value)
+        if 'Content-Length' not in headers:
+            handler.send_header('Content-Length', str(len(response)))
+        handler.end_headers()
+        if method != 'HEAD':
+            handler.wfile.write(response)
+            with self.lock:
+                self.bytes_sent = self.bytes_sent + len(response)
+
+    def respond(self, method, path, params, body, headers):
+        """
+        :return: Tuple (status, headers, body bytes)
+        """
+        raise NotImplementedError()
+
+
+def _json(data):
+    return 200, {'Content-Type': 'application/json; charset=utf-8'}, json.dumps(data).encode('utf-8')
+
+
+def _not_found():
+    return 404, {}, b''
+
+
+class Geofabrik(StandIn):
+    """
+    Serves PBF files (with .md5 next to them), with support for HEAD and range requests, like download server does
+    """
+    name = 'geofabrik'
+    hosts = ('download.geofabrik.de',)
+
+    def __init__(self, files, **kwargs):
+        """
+        :param files: Dictionary of path (e.g. "/europe/serbia-latest.osm.pbf") -> local file to serve
+        """
+        super(Geofabrik, self).__init__(**kwargs)
+        self.files = {}
+        for path, filename in files.items():
+            with open(filename, 'rb') as f:
+                self.files[path] = f.read()
+
+    def respond(self, method, path, params, body, headers):
+        if path.endswith('.md5') and path[:-4] in self.files:
+            content = '{0}  {1}\n'.format(hashlib.md5(self.files[path[:-4]]).hexdigest(), os.path.basename(path[:-4]))
+            return 200, {'Content-Type': 'text/plain'}, content.encode('utf-8')
+        if path not in self.files:
+            return _not_found()
+        content = self.files[path]
+        response_headers = {'Accept-Ranges': 'bytes', 'ETag': '"{0}"'.format(hashlib.md5(content).hexdigest()),
+                            'Content-Type': 'application/octet-stream'}
+        if method == 'HEAD':
+            response_headers['Content-Length'] = str(len(content))
+            return 200, response_headers, b''
+        m = re.match(r'bytes=(\d+)-(\d*)$', headers.get('Range', ''))
+        if m is None:
+            return 200, response_headers, content
+        start = int(m.group(1))
+        end = min(int(m.group(2)), len(content) - 1) if m.group(2) else len(content) - 1
+        response_headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, len(content))
+        return 206, response_headers, content[start:end + 1]
+
+
+class Sophox(StandIn):
+    """
+    SPARQL endpoint. Whatever the query is, it finds places without "name:sr" tag in the area of the query's
+    "wikibase:around" service, and suggests adding "name:sr" tag.
+    """
+    name = 'sophox'
+    hosts = ('sophox.org',)
+
+    def __init__(self, entities, **kwargs):
+        super(Sophox, self).__init__(**kwargs)
+        self.places = [e for e in entities if 'place' in e.tags and 'name' in e.tags and 'name:sr' not in e.tags]
+
+    def respond(self, method, path, params, body, headers):
+        if path != '/bigdata/namespace/wdq/sparql' or 'query' not in params:
+            return _not_found()
+        center, radius = p_center.search(params['query']), p_radius.search(params['query'])
+        lines = ['?id\t?name\t?loc\t?tag_1\t?val_1']
+        for place in self.places:
+            if center is not None and radius is not None and haversine(
+                    (float(center.group('lat')), float(center.group('lon'))),
+                    (place.lat, place.lon)) > float(radius.group('radius')):
+                continue
+            lines.append('<https://www.openstreetmap.org/node/{0}>\t"{1}"\t"Point({2} {3})"^^<{4}>\t"name:sr"\t"{1}"'
+                         .format(place.id, place.tags['name'], place.lon, place.lat, WKT_LITERAL))
+        return 200, {'Content-Type': 'text/tab-separated-values; charset=utf-8'}, \
+            ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class Wikipedia(StandIn):
+    """
+    MediaWiki API of Serbian Wikipedia. There is an article (with coordinates in infobox) for each synthetic place
+    which has "wikipedia" tag.
+    """
+    name = 'wikipedia'
+    hosts = ('sr.wikipedia.org',)
+    lang = 'sr'
+    site_url = 'https://sr.wikipedia.org'
+
+    def __init__(self, entities, **kwargs):
+        super(Wikipedia, self).__init__(**kwargs)
+        self.pages = {}
+        for e in entities:
+            if 'wikipedia' in e.tags and e.tags['wikipedia'].startswith('sr:'):
+                self.pages[e.tags['wikipedia'][3:]] = e
+
+    def _siteinfo(self):
+        return {
+            'general': {'mainpage': 'Главна страна', 'base': self.site_url + '/wiki/', 'sitename': 'Википедија',
+                        'generator': 'MediaWiki 1.31.0', 'case': 'first-letter', 'lang': self.lang,
+                        'server': self.site_url, 'servername': urlparse(self.site_url).hostname,
+                        'articlepath': '/wiki/$1', 'scriptpath': '/w', 'script': '/w/index.php',
+                        'wikiid': '{0}wiki'.format(self.lang), 'timezone': 'UTC', 'timeoffset': 0,
+                        'maxarticlesize': 2097152},
+            'namespaces': {str(ns): {'id': ns, 'case': 'first-letter', '*': name, 'canonical': name}
+                           for ns, name in ((0, ''), (1, 'Talk'), (2, 'User'), (4, 'Project'), (6, 'File'),
+                                            (10, 'Template'), (14, 'Category'))},
+            'namespacealiases': [], 'interwikimap': [], 'extensions': [], 'magicwords': [],
+        }
+
+    def _page(self, title, pageid):
+        entity = self.pages.get(title)
+        if entity is None:
+            return {'ns': 0, 'title': title, 'missing': ''}
+        content = '{{{{Насељено место у Србији\n| гшир = {0:.5f}\n| гдуж = {1:.5f}\n}}}}\n\'\'\'{2}\'\'\' је насеље.'\
+            .format(entity.lat, entity.lon, title)
+        return {'pageid': pageid, 'ns': 0, 'title': title, 'contentmodel': 'wikitext', 'lastrevid': pageid,
+                'touched': TIMESTAMP, 'length': len(content.encode('utf-8')),
+                'pageprops': {'wikibase_item': entity.tags.get('wikidata', '')},
+                'revisions': [{'revid': pageid, 'parentid': 0, 'timestamp': TIMESTAMP, 'user': 'Synthetic',
+                               'contentformat': 'text/x-wiki', 'contentmodel': 'wikitext', '*': content}]}
+
+    def _query(self, params):
+        result = {}
+        meta = params.get('meta', '').split('|')
+        if 'siteinfo' in meta:
+            result.update(self._siteinfo())
+        if 'userinfo' in meta:
+            result['userinfo'] = {'id': 0, 'name': '127.0.0.1', 'anon': '', 'groups': ['*'], 'rights': ['read']}
+        if 'tokens' in meta:
+            result['tokens'] = {'csrftoken': '+\\'}
+        if 'titles' in params:
+            result['pages'] = {}
+            for i, title in enumerate(params['titles'].split('|')):
+                page = self._page(title, zlib.crc32(title.encode('utf-8')) + 1)
+                result['pages'][str(page.get('pageid', -1 - i))] = page
+        return {'batchcomplete': '', 'query': result}
+
+    def respond(self, method, path, params, body, headers):
+        if path != '/w/api.php':
+            return _not_found()
+        if params.get('action') == 'query':
+            return _json(self._query(params))
+        if params.get('action') == 'paraminfo':
+            return _json({'paraminfo': {'modules': []}})
+        return _json({'error': {'code': 'badvalue', 'info': 'Not supported by stand-in'}})
+
+
+class Wikidata(Wikipedia):
+    """
+    Wikibase API of Wikidata. There is an item for each synthetic place which has "wikidata" tag,
+    linking to article about it on Serbian Wikipedia.
+    """
+    name = 'wikidata'
+    hosts = ('www.wikidata.org',)
+    lang = 'en'
+    site_url = 'https://www.wikidata.org'
+
+    def __init__(self, entities, **kwargs):
+        super(Wikidata, self).__init__(entities, **kwargs)
+        self.items = {e.tags['wikidata']: e for e in entities if 'wikidata' in e.tags}
+
+    def _item(self, item_id):
+        entity = self.items.get(item_id)
+        if entity is None:
+            return {'id': item_id, 'missing': ''}
+        name = entity.tags.get('wikipedia', 'sr:' + entity.tags.get('name', ''))[3:]
+        return {'pageid': int(item_id[1:]), 'ns': 0, 'title': item_id, 'lastrevid': int(item_id[1:]),
+                'modified': TIMESTAMP, 'type': 'item', 'id': item_id,
+                'labels': {'sr': {'language': 'sr', 'value': name}}, 'descriptions': {}, 'aliases': {},
+                'sitelinks': {'srwiki': {'site': 'srwiki', 'title': name, 'badges': []}},
+                'claims': {'P625': [{'mainsnak': {'snaktype': 'value', 'property': 'P625', 'datatype':
+                                                  'globe-coordinate', 'datavalue': {'type': 'globecoordinate', 'value': {
+                                                      'latitude': entity.lat, 'longitude': entity.lon,
+                                                      'precision': 0.0001,
+                                                      'globe': 'http://www.wikidata.org/entity/Q2'}}},
+                                     'type': 'statement', 'id': '{0}$1'.format(item_id), 'rank': 'normal'}]}}
+
+    def respond(self, method, path, params, body, headers):
+        if path == '/w/api.php' and params.get('action') == 'wbgetentities':
+            return _json({'success': 1, 'entities': {item_id: self._item(item_id)
+                                                     for item_id in params.get('ids', '').split('|')}})
+        return super(Wikidata, self).respond(method, path, params, body, headers)
+
+
+class OsmApi(StandIn):
+    """
+    OSM API 0.6. Elements are synthetic entities, changes uploaded to it are accepted (and counted), but not kept.
+    """
+    name = 'osm'
+    hosts = ('www.openstreetmap.org', 'api.openstreetmap.org')
+
+    def __init__(self, entities, **kwargs):
+        super(OsmApi, self).__init__(**kwargs)
+        self.entities = {e.id: e for e in entities}
+        self.changesets = 0
+        # Number of uploaded changes, by element type
+        self.changes = collections.Counter()
+
+    def stats(self):
+        stats = super(OsmApi, self).stats()
+        stats['changesets'] = self.changesets
+        stats['changes'] = dict(self.changes)
+        return stats
+
+    def _node(self, node_id):
+        entity = self.entities.get(node_id)
+        if entity is None:
+            return _not_found()
+        node = ElementTree.Element('node', id=str(node_id), version=str(entity.version), changeset='1',
+                                   user='Synthetic', uid='1', visible='true', timestamp=TIMESTAMP,
+                                   lat=str(entity.lat), lon=str(entity.lon))
+        for k, v in sorted(entity.tags.items()):
+            ElementTree.SubElement(node, 'tag', k=k, v=v)
+        osm = ElementTree.Element('osm', version='0.6', generator='stand-in')
+        osm.append(node)
+        return 200, {'Content-Type': 'text/xml; charset=utf-8'}, ElementTree.tostring(osm, encoding='utf-8')
+
+    def _upload(self, body):
+        diff = ElementTree.Element('diffResult', version='0.6', generator='stand-in')
+        for action in ElementTree.fromstring(body):
+            for element in action:
+                with self.lock:
+                    self.changes[element.tag] += 1
+                ElementTree.SubElement(diff, element.tag, old_id=element.get('id'), new_id=element.get('id'),
+                                       new_version=str(int(element.get('version') or 0) + 1))
+        return 200, {'Content-Type': 'text/xml; charset=utf-8'}, ElementTree.tostring(diff, encoding='utf-8')
+
+    def respond(self, method, path, params, body, headers):
+        m = re.match(r'/api/0\.6/(node|way|relation|changeset)/(\w+)(?:/(\w+))?$', path)
+        if m is None:
+            return _not_found()
+        element, element_id, action = m.groups()
+        if element == 'changeset':
+            if element_id == 'create' and method == 'PUT':
+                with self.lock:
+                    self.changesets = self.changesets + 1
+                    return 200, {'Content-Type': 'text/plain'}, str(self.changesets).encode('utf-8')
+            if action == 'upload' and method == 'POST':
+                return self._upload(body)
+            if action == 'close' and method == 'PUT':
+                return 200, {}, b''
+            return _not_found()
+        if method == 'GET' and element == 'node':
+            return self._node(int(element_id))
+        if method == 'PUT':
+            with self.lock:
+                self.changes[element] += 1
+            version = ElementTree.fromstring(body).find(element).get('version') or '0'
+            return 200, {'Content-Type': 'text/plain'}, str(int(version) + 1).encode('utf-8')
+        return _not_found()
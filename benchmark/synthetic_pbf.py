@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Generator of synthetic OSM data for benchmarks. Data looks enough like Serbian extract for checks to have something
+to do - most nodes have no tags at all, some have unrelated tags, and some are places with names in Cyrillic and
+Latin script (correct and incorrect), Wikipedia and Wikidata tags.
+
+Entities can be generated in memory, or written to PBF file (needs PyOsmium):
+
+    python benchmark/synthetic_pbf.py synthetic.osm.pbf --entities 1000000 --place-density 0.01
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from entity_store import StoredEntity
+from transliteration import cyr2lat
+
+# (min lat, min lon, max lat, max lon) of Serbia
+BBOX = (42.2, 18.8, 46.2, 23.0)
+PLACES = ('city', 'town', 'village', 'village', 'village', 'village')
+NAMES = ('Београд', 'Нови Сад', 'Ниш', 'Крагујевац', 'Суботица', 'Зрењанин', 'Панчево', 'Чачак', 'Краљево',
+         'Нови Пазар', 'Смедерево', 'Лесковац', 'Ужице', 'Ваљево', 'Вршац', 'Шабац', 'Сомбор', 'Пожаревац',
+         'Пирот', 'Зајечар', 'Кикинда', 'Сремска Митровица', 'Јагодина', 'Врање', 'Ћуприја', 'Џеп', 'Љиг', 'Његовац')
+OTHER_TAGS = ({'amenity': 'cafe'}, {'shop': 'bakery'}, {'highway': 'bus_stop'}, {'natural': 'tree'},
+              {'amenity': 'school', 'name': 'Основна школа'}, {'barrier': 'gate'})
+# Part of nodes which have any tags
+TAGGED = 0.1
+
+
+def _place_tags(rnd, entity_id):
+    name = rnd.choice(NAMES)
+    if rnd.random() < 0.5:
+        name = '{0} {1}'.format(name, entity_id)
+    tags = {'place': rnd.choice(PLACES)}
+    kind = rnd.random()
+    if kind < 0.05:
+        # Name missing
+        return tags
+    if kind < 0.1:
+        # Name only in Latin script
+        tags['name'] = cyr2lat(name)
+        return tags
+    tags['name'] = name
+    if kind < 0.6:
+        tags['name:sr'] = name
+        tags['name:sr-Latn'] = cyr2lat(name)
+    elif kind < 0.7:
+        # Latin name not transliterated correctly
+        tags['name:sr-Latn'] = cyr2lat(name).replace('š', 's').replace('č', 'c')
+    if rnd.random() < 0.3:
+        tags['wikipedia'] = 'sr:{0}'.format(name)
+        tags['wikidata'] = 'Q{0}'.format(entity_id)
+    return tags
+
+
+def generate_entities(count, place_density=0.01, seed=0, bbox=BBOX):
+    """
+    Generates synthetic nodes. Same arguments always generate the same nodes.
+    :param count: Number of nodes to generate
+    :param place_density: Part of nodes which are places (cities, towns, villages)
+    :param seed: Seed of random generator
+    :param bbox: Nodes are spread uniformly in this (min lat, min lon, max lat, max lon) box
+    :return: Iterator over StoredEntity objects
+    """
+    rnd = random.Random(seed)
+    for entity_id in range(1, count + 1):
+        lat = rnd.uniform(bbox[0], bbox[2])
+        lon = rnd.uniform(bbox[1], bbox[3])
+        value = rnd.random()
+        if value < place_density:
+            tags = _place_tags(rnd, entity_id)
+        elif value < place_density + TAGGED:
+            tags = dict(rnd.choice(OTHER_TAGS))
+        else:
+            tags = {}
+        yield StoredEntity(entity_id, 1, 'node', tags, lat, lon)
+
+
+def write_pbf(filename, count, place_density=0.01, seed=0, bbox=BBOX):
+    """
+    Writes synthetic nodes to PBF file
+    """
+    # This import is here since user doesn't have to have it (optional)
+    import osmium
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    writer = osmium.SimpleWriter(filename)
+    try:
+        for entity in generate_entities(count, place_density, seed, bbox):
+            writer.add_node(osmium.osm.mutable.Node(id=entity.id, version=entity.version,
+                                                    location=(entity.lon, entity.lat),
+                                                    tags=list(entity.tags.items())))
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates synthetic PBF file for benchmarks.')
+    parser.add_argument('filename', help='PBF file to write to')
+    parser.add_argument('--entities', metavar='N', type=int, default=100000,
+                        help='Number of nodes to generate. Default is 100000.')
+    parser.add_argument('--place-density', metavar='P', type=float, default=0.01,
+                        help='Part of nodes which are places (cities, towns, villages). Default is 0.01.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of random generator. Default is 0.')
+    args = parser.parse_args()
+    if not 0 <= args.place_density <= 1:
+        parser.error('--place-density must be between 0 and 1')
+    write_pbf(args.filename, args.entities, args.place_density, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import hashlib
+import os
+import pickle
+import tempfile
+
+import simplejson
+
+import registry
+import tools
+
+logger = tools.get_logger(__name__)
+
+
+class Checkpoints(object):
+    """
+    On-disk checkpoints of the run, so run which died can be continued with --resume instead of started again.
+    For each group of map-checks (one source), results are kept once map is done. While map is read, progress
+    (number of entities already checked, and results so far) is kept too, so sources which always find entities in
+    the same order can continue reading from there. Both are kept with keys map claimed in run-wide deduplicator, so
+    other maps do not repeat checks whose results are already kept.
+    """
+    def __init__(self, directory, options):
+        """
+        :param directory: Directory where checkpoints are kept
+        :param options: Options which change results of the run. Checkpoints made with other options are not used
+        """
+        self.directory = directory
+        self.options = options
+
+    def _key(self, map_checks):
+        signature = simplejson.dumps([self.options] + [
+            [map_check['name'], map_check['location'], [registry.name_of(c) for c in map_check['checks']],
+             [registry.name_of(r) for r in map_check['rules']]] for map_check in map_checks], sort_keys=True)
+        return hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+
+    def _filename(self, map_checks, kind):
+        return os.path.join(self.directory, '{0}.{1}.pickle'.format(self._key(map_checks), kind))
+
+    def export_filename(self, map_checks, export_format):
+        """
+        :return: Filename of part of export in given format, where results of given map-checks are written. It is kept
+        together with checkpoints, so results of maps which are done are still exported after --resume
+        """
+        return os.path.join(self.directory, '{0}.export.{1}'.format(self._key(map_checks), export_format))
+
+    @staticmethod
+    def _load(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning('Checkpoint %s cannot be read, it is not used: %s', filename, e)
+            return None
+
+    def _save(self, filename, data):
+        # Checkpoint is written to temporary file first, so checkpoint is never left half-written
+        os.makedirs(self.directory, exist_ok=True)
+        f = tempfile.NamedTemporaryFile('wb', dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, filename)
+        except BaseException:
+            os.remove(f.name)
+            raise
+
+    def load_map(self, map_checks):
+        """
+        :return: Result of process_map for given map-checks, or None if map is not done yet
+        """
+        done = self.load_done(map_checks)
+        return None if done is None else done[0]
+
+    def load_done(self, map_checks):
+        """
+        :return: Tuple (result of process_map, keys it claimed in run-wide deduplicator) for given map-checks, or None
+        if map is not done yet
+        """
+        done = self._load(self._filename(map_checks, 'done'))
+        return None if done is None else (done['result'], done['claimed'])
+
+    def save_map(self, map_checks, result, claimed=()):
+        """
+        :param claimed: Keys map claimed in run-wide deduplicator (see EntityDeduplicator.owned), so they are claimed
+        again when its results are taken from checkpoint
+        """
+        self._save(self._filename(map_checks, 'done'), {'result': result, 'claimed': list(claimed)})
+        try:
+            os.remove(self._filename(map_checks, 'progress'))
+        except FileNotFoundError:
+            pass
+
+    def load_progress(self, map_checks, version):
+        """
+        :param version: Version of the map being read. Progress made on other version is not used
+        :return: Dictionary with progress, as it was saved, or None if there is no progress on this version of map
+        """
+        progress = self._load(self._filename(map_checks, 'progress'))
+        if progress is None or progress['version'] != version:
+            return None
+        return progress
+
+    def load_claimed(self, map_checks):
+        """
+        :return: Keys claimed in run-wide deduplicator by map which is not done yet, as saved with its progress (on
+        whichever version of map it was made). Empty if there is no progress
+        """
+        progress = self._load(self._filename(map_checks, 'progress'))
+        if progress is None:
+            return []
+        return progress.get('claimed', [])
+
+    def save_progress(self, map_checks, version, progress):
+        self._save(self._filename(map_checks, 'progress'), dict(progress, version=version))
+
+    def clear(self):
+        """
+        Removes all checkpoints, so next run with --resume starts from the beginning
+        """
+        for filename in glob.glob(os.path.join(self.directory, '*.pickle')) + \
+                glob.glob(os.path.join(self.directory, '*.export.*')):
+            os.remove(filename)
@@ -1,40 +1,189 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import contextlib
+import functools
+import threading
+import time
+
 import pywikibot
+from pywikibot.comms import http as pywikibot_http
 
+import http_client
 import tools
 from applicability import City, Town, Village, SophoxEntity
-from exceptions import CalculateDistanceException
+from engine import Result
+from exceptions import CalculateDistanceException, DeadlineExceededException, ServiceUnavailableException
 from haversine import haversine
 from transliteration import at_least_some_in_cyrillic, cyr2lat
 
-en_wiki = pywikibot.Site("en", "wikipedia")
-sr_wiki = pywikibot.Site("sr", "wikipedia")
-wikidata = pywikibot.Site("wikidata", "wikidata")
-wiki_repo = wikidata.data_repository()
-
 logger = tools.get_logger(__name__)
 
+# What checks need from Wikipedia pages and Wikidata items is kept for this many seconds (by default), so workers
+# which live long (in daemon mode) are not loading them again on every run, but do see edits eventually
+WIKI_CACHE_TTL = 2 * 86400
+# Maximum number of pages and items kept in cache of each worker
+WIKI_CACHE_SIZE = 20000
+_wiki_cache = collections.OrderedDict()
+
+# Retries of pywikibot are turned off (its config is global) while any thread is in block with deadline (see
+# _wiki_requests). Original config is kept here, and it is restored only when the last such block ends.
+_retries_lock = threading.Lock()
+_retries_depth = 0
+_retries_saved = None
+
+# Parameters of place templates on Serbian Wikipedia holding latitude and longitude
+COORDINATE_PARAMETERS = ('гшир', 'гдуж')
+
+# Only what checks need from Wikipedia page: its title, id (0 if page does not exist) and latitude/longitude
+# parameters of each template on it, by template name
+WikipediaPage = collections.namedtuple('WikipediaPage', ['title', 'pageid', 'coordinates'])
+# Only what checks need from Wikidata item: its id, page id (0 if item does not exist) and its Serbian label
+WikidataItem = collections.namedtuple('WikidataItem', ['id', 'pageid', 'label_sr'])
+
 
-def _wiki_osm_distance(wikipedia_entry, valid_boxes, osm_entity):
+@functools.lru_cache(maxsize=None)
+def get_site(code, family):
+    """
+    Creates pywikibot site on first use. Sites are not created on import, since it is slow and it needs network,
+    and every worker (and every test) would pay for it, even if it never does any Wikipedia check.
+    """
+    # Wikipedia/Wikidata requests made by pywikibot are throttled together with all other requests to them
+    http_client.mount(pywikibot_http.session)
+    return pywikibot.Site(code, family)
+
+
+@functools.lru_cache(maxsize=None)
+def get_wiki_repo():
+    return get_site('wikidata', 'wikidata').data_repository()
+
+
+def _disable_retries():
+    global _retries_depth, _retries_saved
+    with _retries_lock:
+        if _retries_depth == 0:
+            _retries_saved = pywikibot.config.max_retries, pywikibot.config.retry_wait
+            pywikibot.config.max_retries, pywikibot.config.retry_wait = 0, 0
+        _retries_depth += 1
+
+
+def _restore_retries():
+    global _retries_depth
+    with _retries_lock:
+        _retries_depth -= 1
+        if _retries_depth == 0:
+            pywikibot.config.max_retries, pywikibot.config.retry_wait = _retries_saved
+
+
+@contextlib.contextmanager
+def _wiki_requests():
+    """
+    Block in which pywikibot sends requests. While there is deadline, pywikibot is not retrying failed requests
+    (it would be waiting for Wikipedia over deadline), in any thread. Request which failed because deadline passed,
+    or because Wikipedia became unavailable, is raised as such, so check is skipped instead of failed.
+    """
+    no_retries = http_client.remaining_time() is not None
+    if no_retries:
+        _disable_retries()
+    try:
+        yield
+    except ServiceUnavailableException:
+        raise
+    except Exception:
+        remaining = http_client.remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededException('deadline exceeded while waiting for wikimedia')
+        if not http_client.is_available('wikimedia'):
+            raise ServiceUnavailableException('wikimedia is unavailable')
+        raise
+    finally:
+        if no_retries:
+            _restore_retries()
+
+
+def _cached(key, ttl, load):
+    """
+    :param key: Key of the value in cache
+    :param ttl: How long value is kept in cache, in seconds
+    :param load: Function loading value if it is not in cache (or it is there for more than ttl seconds)
+    :return: Value, from cache or just loaded
+    """
+    cached = _wiki_cache.get(key)
+    if cached is not None and time.time() - cached[0] < ttl:
+        _wiki_cache.move_to_end(key)
+        return cached[1]
+    with _wiki_requests():
+        value = load()
+    _wiki_cache[key] = time.time(), value
+    _wiki_cache.move_to_end(key)
+    if len(_wiki_cache) > WIKI_CACHE_SIZE:
+        _wiki_cache.popitem(last=False)
+    return value
+
+
+def _template_coordinates(templates):
+    """
+    :param templates: Templates of Wikipedia page, as (name, parameters) tuples
+    :return: Dictionary of template name -> its latitude and longitude parameters (only those which it has),
+    in order in which templates are on the page
+    """
+    coordinates = collections.OrderedDict()
+    for name, parameters in templates:
+        coordinates.setdefault(name, {k: v for k, v in parameters.items() if k in COORDINATE_PARAMETERS})
+    return coordinates
+
+
+def get_wikipedia_page(title, ttl=WIKI_CACHE_TTL):
+    """
+    :param title: Title of Serbian Wikipedia page
+    :param ttl: How long page is kept in cache, in seconds
+    :return: WikipediaPage
+    """
+    def load():
+        page = pywikibot.Page(get_site('sr', 'wikipedia'), title)
+        try:
+            pageid = page.pageid
+        except pywikibot.exceptions.NoPage:
+            pageid = 0
+        coordinates = _template_coordinates(page.raw_extracted_templates) if pageid != 0 else {}
+        return WikipediaPage(title, pageid, coordinates)
+    return _cached(('wikipedia', title), ttl, load)
+
+
+def get_wikidata_item(item_id, ttl=WIKI_CACHE_TTL):
+    """
+    :param item_id: Q-id of Wikidata item
+    :param ttl: How long item is kept in cache, in seconds
+    :return: WikidataItem
+    """
+    def load():
+        item = pywikibot.ItemPage(get_wiki_repo(), item_id)
+        if item.pageid == 0:
+            return WikidataItem(item_id, 0, None)
+        text = item.text
+        label_sr = text['labels']['sr'] if 'labels' in text and 'sr' in text['labels'] else None
+        return WikidataItem(item_id, item.pageid, label_sr)
+    return _cached(('wikidata', item_id), ttl, load)
+
+
+def _wiki_osm_distance(title, coordinates, valid_boxes, osm_entity):
     """
     Calculates distance between wiki entry and OSM entity,
     or throws CalculateDistanceException if it cannot calculate it.
-    :param wikipedia_entry: Wikipedia entry to calculate distance
+    :param title: Title of Wikipedia entry to calculate distance
+    :param coordinates: Latitude and longitude parameters of templates of Wikipedia entry, by template name
     :param valid_boxes: Template boxes from where latitude/longitude will be pulled from
     :param osm_entity: OSM entity
     :return: distance in km
     """
-    templates = wikipedia_entry.raw_extracted_templates
-    found_box = next((t[1] for t in templates if t[0] in valid_boxes), None)
+    found_box = next((box for name, box in coordinates.items() if name in valid_boxes), None)
     if found_box is None:
         raise CalculateDistanceException(
             'Cannot calculate distance as Wikipedia article {0} does not contain any of valid boxes {1}'.format(
-                     wikipedia_entry.title, ','.join(valid_boxes)))
+                     title, ','.join(valid_boxes)))
 
     if 'гшир' not in found_box or 'гдуж' not in found_box:
-        raise CalculateDistanceException('Wikipedia entry {0} is missing latitude or longitude'.format(
-            wikipedia_entry.title))
+        raise CalculateDistanceException('Wikipedia entry {0} is missing latitude or longitude'.format(title))
 
     wiki_point = (float(found_box['гшир']), float(found_box['гдуж']))
 
@@ -70,7 +219,8 @@ def _guess_from_wikipedia(name, entity, api, valid_boxes, visited_pages=None, de
         # We are too much in recursion, bail out
         return None
 
-    page = pywikibot.Page(sr_wiki, name)
+    # Only done while fixing, so page is not cached
+    page = pywikibot.Page(get_site('sr', 'wikipedia'), name)
     try:
         if page.pageid == 0:
             logger.debug('Wikipedia entry for %s does not exist', name)
@@ -122,7 +272,7 @@ def _guess_from_wikipedia(name, entity, api, valid_boxes, visited_pages=None, de
     # It is about residential place, let's see how apart are Wiki and OSM place,
     # if they are not too far apart (20km), it means we have a winner!
     try:
-        distance = _wiki_osm_distance(page, valid_boxes, entity)
+        distance = _wiki_osm_distance(name, _template_coordinates(templates), valid_boxes, entity)
         if distance <= 20:
             return name
         else:
@@ -136,14 +286,25 @@ def _guess_from_wikipedia(name, entity, api, valid_boxes, visited_pages=None, de
 
 class AbstractCheck(object):
     applicable_on = []
+    # Checks which need to pass before this check is performed (e.g. because this check is using their artifacts)
+    depends_on = []
     is_fixable = False
+    # Set to True in checks implementing do_check_batch()
+    batch_capable = False
+    # External services (see http_client.SERVICES) check sends requests to. Check is skipped while any is unavailable
+    services = []
     explanation = ''
 
     def __init__(self, entity_context):
         self.entity_context = entity_context
         # helpers to shorten getting stuff from global_context
         self.map_name = entity_context['global_context']['map-check']['name']
-        self.dry_run = entity_context['global_context']['dry_run']
+        # Simulated fixes are never sent to OSM, so they are done as if they were for real (see SimulatedApi)
+        self.simulate = entity_context['global_context'].get('simulate', False)
+        self.dry_run = entity_context['global_context']['dry_run'] and not self.simulate
+        self.wiki_cache_ttl = entity_context['global_context'].get('wiki_cache_ttl')
+        if self.wiki_cache_ttl is None:
+            self.wiki_cache_ttl = WIKI_CACHE_TTL
 
     def do_check(self, entity):
         """
@@ -154,6 +315,56 @@ class AbstractCheck(object):
         """
         return ''
 
+    def do_check_batch(self, chunk):
+        """
+        Does check on many entities at once. Implement it (and set batch_capable) in checks which are only looking
+        at tags, where calling do_check() for each entity costs more than check itself.
+        Unlike in do_check(), artifacts and results of other checks are not available here.
+        :param chunk: EntityChunk with entities on which check is to be performed. Engine guarantees all of them
+        are applicable for this check and that all dependent checks are satisfied for each of them.
+        :return: List of Result.CHECKED_OK/Result.CHECKED_ERROR, one for each entity in chunk. Error messages are
+        taken from do_check().
+        """
+        return [Result.CHECKED_OK if self.do_check(entity) == '' else Result.CHECKED_ERROR
+                for entity in chunk.entities]
+
+    @property
+    def artifacts(self):
+        """
+        Dictionary where check keeps whatever it found out during check (e.g. Wikipedia page it fetched),
+        so other checks on the same entity can reuse it.
+        """
+        return self.entity_context['artifacts'].setdefault(type(self), {})
+
+    def result_of(self, check_cls):
+        """
+        Result of other check on the same entity. Engine performs it now if it is not already performed.
+        :param check_cls: Check class
+        :return: Tuple (Result, message)
+        """
+        return self.entity_context['engine'].result_of(check_cls)
+
+    def check_passed(self, check_cls):
+        return self.result_of(check_cls)[0] == Result.CHECKED_OK
+
+    def artifacts_of(self, check_cls):
+        """
+        Artifacts of other check on the same entity. Engine performs it now if it is not already performed.
+        """
+        self.result_of(check_cls)
+        return self.entity_context['artifacts'].get(check_cls, {})
+
+    @staticmethod
+    def result_key(entity):
+        """
+        Identifies result of this check on a given entity. Same check is done only once on the same entity in a run,
+        so checks whose result depends on more than entity itself (like from which query entity came from)
+        should return that here.
+        :param entity: Entity on which check is to be performed
+        :return: String identifying result of the check
+        """
+        return ''
+
     def fix(self, entity, api):
         """
         Returns empty string if fix is not done. Returns changeset comment if fix is applied.
@@ -161,8 +372,8 @@ class AbstractCheck(object):
         fixing. Use osmapi to check and apply fix.
         Engine guarantees that there is open changeset.
         :param entity: Entity to fix. Engine guarantees entity is applicable for this check.
-        Engine also guarantees that all dependent checks are satisfied prior to calling this check. If there is
-        additional checks, you'll have to do them manually.
+        Engine also guarantees that all dependent checks are satisfied prior to calling this check. If fix needs
+        additional checks, use check_passed() to get their (memoized) results.
         :param api: OsmApi
         """
         return ''
@@ -172,8 +383,10 @@ class AbstractCheck(object):
         Simple wrapper to ask user to do something. Method will append "(y/n)" and dump entity
         :param input_text: Text to ask. 
         :param entity: entity for whcih question is being asked
-        :return: True if user confirmed, False otherwise
+        :return: True if user confirmed, False otherwise. Simulated fixes are always confirmed
         """
+        if self.simulate:
+            return True
         for k, v in entity.tags.items():
             # Ignore following (coming from Sophox), just polluting output
             if k == 'metadata':
@@ -194,6 +407,7 @@ class NameMissingCheck(AbstractCheck):
     Checks that 'name' tag is present in entity.
     """
     applicable_on = [City, Town, Village]
+    batch_capable = True
 
     def __init__(self, entity_context):
         super(NameMissingCheck, self).__init__(entity_context)
@@ -204,12 +418,16 @@ class NameMissingCheck(AbstractCheck):
             return 'Name missing for {0} with id {1}: {2}'.format(place_type, entity.id, entity)
         return ''
 
+    def do_check_batch(self, chunk):
+        return [Result.CHECKED_OK if name else Result.CHECKED_ERROR for name in chunk.column('name')]
+
 
 class NameCyrillicCheck(AbstractCheck):
     """
     Checks that name of the entity is in cyrillic script.
     """
     applicable_on = [City, Town, Village]
+    batch_capable = True
 
     def __init__(self, entity_context):
         super(NameCyrillicCheck, self).__init__(entity_context)
@@ -230,6 +448,16 @@ class NameCyrillicCheck(AbstractCheck):
             return 'Seems that {0} name is not in cyrillic for "{1}"'.format(place_type, name)
         return ''
 
+    def do_check_batch(self, chunk):
+        if 'Serbia checks' in self.map_name:
+            # Exclude places close, but not in Serbia
+            names = [name if country is None or country == 'Serbia' else None
+                     for name, country in zip(chunk.column('name'), chunk.column('is_in:country'))]
+        else:
+            names = chunk.column('name:sr')
+        return [Result.CHECKED_OK if not name or at_least_some_in_cyrillic(name) else Result.CHECKED_ERROR
+                for name in names]
+
 
 class LatinNameExistsCheck(AbstractCheck):
     """
@@ -260,14 +488,14 @@ class LatinNameExistsCheck(AbstractCheck):
 
     def fix(self, entity, api):
         if 'Serbia checks' in self.map_name:
-            if NameMissingCheck(self.entity_context).do_check(entity) != '':
+            if not self.check_passed(NameMissingCheck):
                 # We cannot automatically set latin name, if cyrillic is not set
                 return ''
         else:
             if 'name:sr' not in entity.tags:
                 return ''
 
-        if NameCyrillicCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(NameCyrillicCheck):
             # Doesn't make sense to set latin name, if original name is not in cyrillic
             return ''
 
@@ -302,6 +530,7 @@ class LatinNameSameAsCyrillicCheck(AbstractCheck):
     """
     applicable_on = [City, Town, Village]
     is_fixable = True
+    batch_capable = True
 
     def __init__(self, entity_context):
         super(LatinNameSameAsCyrillicCheck, self).__init__(entity_context)
@@ -325,6 +554,14 @@ class LatinNameSameAsCyrillicCheck(AbstractCheck):
                 latin_name, place_type, cyrillic_name)
         return ''
 
+    def do_check_batch(self, chunk):
+        cyrillic_names = chunk.column('name' if 'Serbia checks' in self.map_name else 'name:sr')
+        return [Result.CHECKED_ERROR if cyrillic_name is not None and latin_name is not None and
+                (country is None or country == 'Serbia') and cyr2lat(cyrillic_name) != latin_name
+                else Result.CHECKED_OK
+                for cyrillic_name, latin_name, country in zip(cyrillic_names, chunk.column('name:sr-Latn'),
+                                                              chunk.column('is_in:country'))]
+
     def fix(self, entity, api):
         name = entity.tags['name'] if 'Serbia checks' in self.map_name else entity.tags['name:sr']
         old_latin_name = entity.tags['name:sr-Latn']
@@ -399,10 +636,10 @@ class WikipediaEntryExistsCheck(AbstractCheck):
         return ''
 
     def fix(self, entity, api):
-        if NameMissingCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(NameMissingCheck):
             # We should not set Wikipedia tag, if there is no name
             return ''
-        if NameCyrillicCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(NameCyrillicCheck):
             # We should not set Wikipedia tag, if name is not in cyrillic
             return ''
 
@@ -462,10 +699,10 @@ class WikipediaEntryIsInSerbianCheck(AbstractCheck):
         """
         Basically, same fix as if there is no wikipedia entry, but we are not adding new tag, we replace existing one
         """
-        if NameMissingCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(NameMissingCheck):
             # We should not set Wikipedia tag, if there is no name
             return ''
-        if NameCyrillicCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(NameCyrillicCheck):
             # We should not set Wikipedia tag, if name is not in cyrillic
             return ''
 
@@ -500,6 +737,7 @@ class WikipediaEntryValidCheck(AbstractCheck):
     Checks that Wikipedia entry for a given entity actually exists in Wikipedia.
     """
     applicable_on = [City, Town, Village]
+    services = ['wikimedia']
 
     def __init__(self, entity_context):
         super(WikipediaEntryValidCheck, self).__init__(entity_context)
@@ -519,28 +757,18 @@ class WikipediaEntryValidCheck(AbstractCheck):
         place_type = entity.tags['place']
         name = entity.tags['name'] if 'name' in entity.tags else entity.id
 
-        wikipedia_entry = self.entity_context['local_store']['wikipedia']\
-            if 'wikipedia' in self.entity_context['local_store'] else None
-
-        if wikipedia_entry is not None:
-            # Already checked, everything is OK
-            return ''
-
         error_message = 'Wikipedia entry {0} is not valid for {1} {2}'.format(
             entity.tags['wikipedia'][3:], place_type, name)
-        wikipedia_entry = pywikibot.Page(sr_wiki, entity.tags['wikipedia'][3:])
-        try:
-            if wikipedia_entry.pageid == 0:
-                return error_message
-        except pywikibot.exceptions.NoPage:
+        wikipedia_entry = get_wikipedia_page(entity.tags['wikipedia'][3:], self.wiki_cache_ttl)
+        if wikipedia_entry.pageid == 0:
             return error_message
 
         try:
-            distance = _wiki_osm_distance(wikipedia_entry,
+            distance = _wiki_osm_distance(wikipedia_entry.title, wikipedia_entry.coordinates,
                                           ['Насељено место у Србији', 'Град у Србији', 'Градска четврт'], entity)
             if distance <= 20:
-                # Cache it now
-                self.entity_context['local_store']['wikipedia'] = wikipedia_entry
+                # Other checks can use it now
+                self.artifacts['wikipedia'] = wikipedia_entry
                 return ''
             else:
                 entity_name = entity.tags['name'] if 'name' in entity.tags else entity.id
@@ -576,13 +804,12 @@ class WikidataEntryExistsCheck(AbstractCheck):
         """
         Fixing is by going to wikipedia article and getting Q value from there
         """
-        if WikipediaEntryValidCheck(self.entity_context).do_check(entity) != '':
+        if not self.check_passed(WikipediaEntryValidCheck):
             # If Wikipedia is not valid entry, no point getting wikidata
             return ''
 
         name = entity.tags['name'] if 'Serbia checks' in self.map_name else entity.tags['name:sr']
-        wikipedia_entry = self.entity_context['local_store']['wikipedia'] \
-            if 'wikipedia' in self.entity_context['local_store'] else None
+        wikipedia_entry = self.artifacts_of(WikipediaEntryValidCheck).get('wikipedia')
 
         if wikipedia_entry:
             if entity.entity_type == 'way':
@@ -591,7 +818,8 @@ class WikidataEntryExistsCheck(AbstractCheck):
                 osm_entity = api.NodeGet(entity.id)
 
             if 'wikidata' not in osm_entity['tag']:
-                wikidata = wikipedia_entry.data_item().id
+                # Only done while fixing, so page is not cached
+                wikidata = pywikibot.Page(get_site('sr', 'wikipedia'), wikipedia_entry.title).data_item().id
                 question = 'Wikidata entry was missing and it exists (based on Wikipedia article "{0}"). ' \
                            'Are you sure you want to add tag "wikidata" for entity "{1}" with value "{2}"'.format(
                             osm_entity['tag']['wikipedia'], name, wikidata)
@@ -612,6 +840,7 @@ class WikidataEntryValidCheck(AbstractCheck):
     Checks that Wikidata entry for a given entity actually exists in Wikidata.
     """
     applicable_on = [City, Town, Village]
+    services = ['wikimedia']
 
     def __init__(self, entity_context):
         super(WikidataEntryValidCheck, self).__init__(entity_context)
@@ -623,12 +852,12 @@ class WikidataEntryValidCheck(AbstractCheck):
         if 'is_in:country' in entity.tags and entity.tags['is_in:country'] != 'Serbia':
             return ''
 
-        wikidata_entry = pywikibot.ItemPage(wiki_repo, entity.tags['wikidata'])
+        wikidata_entry = get_wikidata_item(entity.tags['wikidata'], self.wiki_cache_ttl)
         if wikidata_entry.pageid == 0:
             place_type = entity.tags['place']
             name = entity.tags['name'] if 'name' in entity.tags else entity.id
             return 'Wikidata entry {0} for {1} {2} wrong'.format(entity.tags['wikidata'], place_type, name)
-        self.entity_context['local_store']['wikidata'] = wikidata_entry
+        self.artifacts['wikidata'] = wikidata_entry
         return ''
 
 
@@ -637,6 +866,8 @@ class WikipediaAndWikidataInSyncCheck(AbstractCheck):
     If both Wikipedia and Wikidata entry do exist, checks that Wikidata entry links to Wikipedia entry.
     """
     applicable_on = [City, Town, Village]
+    depends_on = [WikidataEntryValidCheck]
+    services = ['wikimedia']
 
     def __init__(self, entity_context):
         super(WikipediaAndWikidataInSyncCheck, self).__init__(entity_context)
@@ -651,9 +882,8 @@ class WikipediaAndWikidataInSyncCheck(AbstractCheck):
         if 'is_in:country' in entity.tags and entity.tags['is_in:country'] != 'Serbia':
             return ''
 
-        wikidata_entry = self.entity_context['local_store']['wikidata']
-        wd_txt = wikidata_entry.text
-        if 'labels' in wd_txt and 'sr' in wd_txt['labels'] and wd_txt['labels']['sr'] != entity.tags['wikipedia'][3:]:
+        wikidata_entry = self.artifacts_of(WikidataEntryValidCheck)['wikidata']
+        if wikidata_entry.label_sr is not None and wikidata_entry.label_sr != entity.tags['wikipedia'][3:]:
             place_type = entity.tags['place']
             name = entity.tags['name'] if 'name' in entity.tags else entity.id
             return 'Wikidata entry {0} for {1} {2} doesn\'t match wikipedia entry ({3})for it'.format(
@@ -716,17 +946,21 @@ class GenericSophoxCheck(AbstractCheck):
             if 'check_description' in entity.tags['metadata'] else 'no description'
         return check_description.format(name)
 
-    def fix(self, entity, api):
-        name = entity.tags['name'] if 'name' in entity.tags else entity.id
-        changed_anything = False
-        if entity.entity_type == 'way':
-            osm_entity = api.WayGet(entity.id)
-        elif entity.entity_type == 'node':
-            osm_entity = api.NodeGet(entity.id)
-        else:
-            osm_entity = api.RelationGet(entity.id)
+    @staticmethod
+    def result_key(entity):
+        # Different queries can find same entity and each of them should be checked,
+        # but same query over overlapping areas should be checked only once
+        return entity.tags['metadata']['check_description'] \
+            if 'check_description' in entity.tags['metadata'] else ''
 
-        # Check for all suggestions
+    @staticmethod
+    def suggestions(entity):
+        """
+        :param entity: Entity returned from Sophox
+        :return: List of (tag, value) tuples query is suggesting (from its tag_N and val_N columns). Value is None
+        if tag is to be deleted
+        """
+        suggestions = []
         suggestion_id = 1
         while True:
             tag_key = 'tag_{0}'.format(suggestion_id)
@@ -737,7 +971,27 @@ class GenericSophoxCheck(AbstractCheck):
             val = entity.tags[value_key]
             if val == 'false' and entity.tags[value_key]['datatype'] == 'http://www.w3.org/2001/XMLSchema#boolean':
                 val = None
+            suggestions.append((tag, val))
+            suggestion_id = suggestion_id + 1
+        return suggestions
+
+    def fix(self, entity, api):
+        if self.simulate:
+            # Columns of the query are not tags of the entity (e.g. name can hold value of name:sr),
+            # so only what query is suggesting is known, not what is in OSM now
+            api.suggest(self.suggestions(entity))
+            return ''
 
+        name = entity.tags['name'] if 'name' in entity.tags else entity.id
+        changed_anything = False
+        if entity.entity_type == 'way':
+            osm_entity = api.WayGet(entity.id)
+        elif entity.entity_type == 'node':
+            osm_entity = api.NodeGet(entity.id)
+        else:
+            osm_entity = api.RelationGet(entity.id)
+
+        for tag, val in self.suggestions(entity):
             if val is not None:
                 # We are adding/modifying value
                 if tag not in osm_entity['tag']:
@@ -777,7 +1031,6 @@ class GenericSophoxCheck(AbstractCheck):
                         api.NodeUpdate(osm_entity)
                     else:
                         api.RelationUpdate(osm_entity)
-            suggestion_id = suggestion_id + 1
 
         if changed_anything:
             return 'Fixes made'
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding pieces of daemon mode, where lint keeps running and checks maps again on schedule (or as soon as they
+change), while current results can be queried over local HTTP API.
+"""
+
+import http.server
+import threading
+import urllib.parse
+
+import simplejson
+
+import tools
+from results_db import ResultsDatabase
+
+logger = tools.get_logger(__name__)
+
+
+def map_versions(source_factory, map_check_groups):
+    """
+    :param source_factory: SourceFactory used to create sources of the maps (nothing is read from them)
+    :param map_check_groups: List of map-checks using the same source
+    :return: Dictionary of location -> version of the map at that location (None if it cannot be known)
+    """
+    versions = {}
+    for map_checks in map_check_groups:
+        location = map_checks[0]['location']
+        try:
+            versions[location] = source_factory.create_source(map_checks).version()
+        except Exception as e:
+            logger.warning('[%s] Cannot find out version of map: %s', location, e)
+            versions[location] = None
+    return versions
+
+
+def changed_maps(previous, current):
+    """
+    :return: List of locations whose version is known now, and it is not the same as before
+    """
+    return [location for location, version in current.items()
+            if version is not None and version != previous.get(location)]
+
+
+class QueryApi(object):
+    """
+    Local HTTP API serving results of the last finished run from results database, and status of the daemon.
+    All responses are JSON:
+    * GET /status - what daemon is doing, and when it is going to run again
+    * GET /errors - current errors, optionally only of given map (?map=), check (?check=) and/or entity
+      (?entity=node/123)
+    * GET /changes - new and resolved errors in the last run, compared to the run before it
+    """
+    def __init__(self, results_db_filename, port):
+        self.results_db_filename = results_db_filename
+        self.port = port
+        # Updated by daemon, read by requests
+        self.status = {'state': 'starting'}
+        self.server = None
+
+    def _errors(self, query):
+        entity = None
+        if 'entity' in query:
+            entity_type, _, entity_id = query['entity'].partition('/')
+            if not entity_id.isdigit():
+                raise ValueError('entity must be in format TYPE/ID')
+            entity = (entity_type, int(entity_id))
+        results_db = ResultsDatabase(self.results_db_filename)
+        try:
+            errors = results_db.errors(map_name=query.get('map'), check_name=query.get('check'), entity=entity)
+        finally:
+            results_db.close()
+        return [{'map': map_name, 'check': check_name, 'entity_type': entity_type, 'entity_id': entity_id,
+                 'name': entity_name, 'messages': messages}
+                for map_name, check_name, entity_type, entity_id, entity_name, messages in errors]
+
+    def _changes(self):
+        results_db = ResultsDatabase(self.results_db_filename)
+        try:
+            run = results_db.last_run()
+            previous = results_db.previous_run(run) if run is not None else None
+            if previous is None:
+                return None
+            changes = results_db.changes(run, previous[0])
+        finally:
+            results_db.close()
+        return {'run': run, 'previous_run': previous[0], 'count_new': changes['count_new'],
+                'count_resolved': changes['count_resolved'], 'count_persistent': changes['count_persistent'],
+                'new': sorted(changes['new']), 'resolved': changes['resolved']}
+
+    def handle(self, path):
+        """
+        :param path: Path of GET request, with query string
+        :return: Tuple (HTTP status, JSON-serializable body)
+        """
+        url = urllib.parse.urlparse(path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        try:
+            if url.path == '/status':
+                return 200, dict(self.status)
+            if url.path == '/errors':
+                return 200, self._errors(query)
+            if url.path == '/changes':
+                changes = self._changes()
+                if changes is None:
+                    return 404, {'error': 'there is no previous run to compare with'}
+                return 200, changes
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        return 404, {'error': 'unknown path {0}'.format(url.path)}
+
+    def start(self):
+        api = self
+
+        class QueryHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = api.handle(self.path)
+                body = simplejson.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), QueryHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info('Serving results on http://127.0.0.1:%d/errors', self.server.server_address[1])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
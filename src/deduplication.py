@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+
+class EntityDeduplicator(object):
+    """
+    Run-wide set of already performed checks, shared between all workers through SQLite file.
+    Used so that each check is performed only once on each entity in a check suite, even if entity is found
+    in more than one source (e.g. in overlapping Sophox queries). Each check is claimed by source performing it,
+    and it is released if source could not perform it after all.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS claimed (key TEXT PRIMARY KEY, owner TEXT) WITHOUT ROWID')
+        connection.execute('CREATE INDEX IF NOT EXISTS claimed_owner ON claimed (owner)')
+
+    def __getstate__(self):
+        # Connections cannot be shared between processes, each process opens its own
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._local = threading.local()
+
+    def _connection(self):
+        return tools.thread_connection(self._local, self.filename)
+
+    @staticmethod
+    def _key(key):
+        return '\x1f'.join(str(k) for k in key)
+
+    def claim(self, keys, owner=None):
+        """
+        Atomically claims all given keys.
+        :param keys: Iterable of keys, where each key is tuple of strings and numbers
+        :param owner: Who is claiming keys (e.g. location of the map), so all its keys can be released together
+        :return: Set of keys claimed by this call. Keys not in this set were already claimed before.
+        """
+        connection = self._connection()
+        claimed = set()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key in keys:
+                cursor = connection.execute('INSERT OR IGNORE INTO claimed (key, owner) VALUES (?, ?)',
+                                            (self._key(key), owner))
+                if cursor.rowcount == 1:
+                    claimed.add(key)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return claimed
+
+    def release(self, keys):
+        """
+        Releases given keys, so they can be claimed again (e.g. check is skipped, so other source can try it).
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('DELETE FROM claimed WHERE key=?', [(self._key(key),) for key in keys])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def release_owner(self, owner):
+        """
+        Releases all keys claimed by given owner (e.g. map failed, so none of its results are kept).
+        """
+        self._connection().execute('DELETE FROM claimed WHERE owner=?', (owner,))
+
+    def owned(self, owner):
+        """
+        :return: All keys claimed by given owner, in the form they are kept in (so they can be restored in other run)
+        """
+        return [row[0] for row in self._connection().execute('SELECT key FROM claimed WHERE owner=?', (owner,))]
+
+    def restore(self, keys, owner):
+        """
+        Claims again keys owner claimed in run which died (see owned), so other sources do not repeat checks whose
+        results are kept in owner's checkpoint.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR IGNORE INTO claimed (key, owner) VALUES (?, ?)',
+                                   [(key, owner) for key in keys])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
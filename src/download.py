@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module for downloading big files (PBF maps). Files are downloaded in parallel, in more HTTP ranges (if server supports
+ranges), progress is saved next to the file, so interrupted downloads are resumed from where they stopped,
+and checksum is verified at the end.
+"""
+
+import os
+import threading
+import time
+
+import simplejson
+
+import http_client
+import metrics
+import tools
+from exceptions import ChecksumMismatchException, ServiceUnavailableException
+
+logger = tools.get_logger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Files smaller than this are downloaded in one range
+MIN_RANGE_SIZE = 16 * 1024 * 1024
+# How often (in bytes) progress is saved and logged
+PROGRESS_EVERY = 10 * 1024 * 1024
+ATTEMPTS = 3
+TIMEOUT = (10, 120)
+
+
+class Downloader(object):
+    """
+    Downloads one URL to one file. If file was partially downloaded before (and remote file did not change),
+    download continues from where it stopped.
+    """
+    def __init__(self, url, filename, connections=4, log_prefix=''):
+        """
+        :param url: URL to download
+        :param filename: File to download to. Progress is kept in the file with the same name and ".progress" suffix
+        :param connections: Maximum number of parallel ranges to download
+        :param log_prefix: Prefix of all log messages (usually map name)
+        """
+        self.url = url
+        self.filename = filename
+        self.progress_filename = filename + '.progress'
+        self.connections = connections
+        self.log_prefix = log_prefix
+        self.lock = threading.Lock()
+        self.state = None
+        self.downloaded = 0
+        self.last_saved = 0
+        # Bytes received in this download (without those downloaded before resuming)
+        self.received = 0
+
+    def _remote_info(self):
+        r = http_client.request('HEAD', self.url, allow_redirects=True, timeout=TIMEOUT)
+        r.raise_for_status()
+        size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+        accept_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        version = r.headers.get('ETag') or r.headers.get('Last-Modified') or ''
+        return size, accept_ranges, version
+
+    def _load_state(self, size, version):
+        """
+        Loads progress of previous download, if it is for the same remote file
+        """
+        if not os.path.isfile(self.progress_filename) or not os.path.isfile(self.filename):
+            return None
+        try:
+            with open(self.progress_filename, 'r') as f:
+                state = simplejson.load(f)
+        except (IOError, ValueError):
+            return None
+        if state.get('url') != self.url or state.get('size') != size or state.get('version') != version:
+            logger.info('[%s] Remote file changed, starting download from scratch', self.log_prefix)
+            return None
+        return state
+
+    def _save_state(self):
+        with open(self.progress_filename + '.tmp', 'w') as f:
+            simplejson.dump(self.state, f)
+        os.replace(self.progress_filename + '.tmp', self.progress_filename)
+
+    def _new_state(self, size, accept_ranges, version):
+        if size is None or not accept_ranges:
+            ranges = [[0, None, 0]]
+        else:
+            count = max(1, min(self.connections, size // MIN_RANGE_SIZE))
+            range_size = size // count
+            ranges = [[i * range_size, size - 1 if i == count - 1 else (i + 1) * range_size - 1, 0]
+                      for i in range(count)]
+        with open(self.filename, 'wb') as f:
+            if size is not None:
+                f.truncate(size)
+        return {'url': self.url, 'size': size, 'version': version, 'ranges': ranges}
+
+    def _download_range(self, download_range):
+        """
+        Downloads one range, starting from already downloaded part of it. Executed in its own thread.
+        :param download_range: List of [start, end, downloaded bytes]. End is None if size is not known.
+        """
+        for attempt in range(1, ATTEMPTS + 1):
+            start, end, done = download_range
+            if end is not None and start + done > end:
+                return
+            headers = {}
+            if end is not None:
+                headers['Range'] = 'bytes={0}-{1}'.format(start + done, end)
+            try:
+                # Retries are done here, so they can continue from where previous attempt stopped
+                r = http_client.request('GET', self.url, attempts=1, headers=headers, stream=True, timeout=TIMEOUT)
+                r.raise_for_status()
+                if end is not None and r.status_code != 206:
+                    raise Exception('Server ignored range request for {0}'.format(self.url))
+                if end is None and done > 0:
+                    # We can only start over if we cannot ask for range
+                    download_range[2] = done = 0
+                # Unbuffered, so saved progress never claims more than what is really written
+                with open(self.filename, 'r+b', buffering=0) as f:
+                    f.seek(start + done)
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        self._progress(download_range, len(chunk))
+                return
+            except ServiceUnavailableException:
+                raise
+            except Exception as e:
+                if attempt == ATTEMPTS:
+                    raise
+                logger.warning('[%s] Error downloading %s (%s), retrying', self.log_prefix, self.url, e)
+                time.sleep(http_client.backoff_delay(attempt))
+
+    def _progress(self, download_range, length):
+        with self.lock:
+            download_range[2] += length
+            self.downloaded += length
+            self.received += length
+            metrics.inc('bytes_downloaded_total', length, map=self.log_prefix)
+            if self.state['size']:
+                metrics.gauge('progress', self.downloaded / self.state['size'], map=self.log_prefix, stage='download')
+            if self.downloaded - self.last_saved >= PROGRESS_EVERY:
+                self.last_saved = self.downloaded
+                self._save_state()
+                logger.info('[%s] Downloaded %d MB', self.log_prefix, self.downloaded / (1024 * 1024))
+
+    def download(self, expected_md5=None):
+        """
+        Downloads file (or continues previous download).
+        :param expected_md5: If given, MD5 of downloaded file is verified against it
+        :return: Filename of downloaded file
+        """
+        size, accept_ranges, version = self._remote_info()
+        self.state = self._load_state(size, version) if accept_ranges else None
+        if self.state is None:
+            self.state = self._new_state(size, accept_ranges, version)
+        else:
+            logger.info('[%s] Resuming download of %s', self.log_prefix, self.url)
+        self.downloaded = self.last_saved = sum(r[2] for r in self.state['ranges'])
+        self._save_state()
+
+        threads = []
+        errors = []
+
+        def run(download_range):
+            try:
+                self._download_range(download_range)
+            except Exception as e:
+                errors.append(e)
+
+        for download_range in self.state['ranges']:
+            thread = threading.Thread(target=run, args=(download_range,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        with self.lock:
+            self._save_state()
+        if len(errors) > 0:
+            # Progress is saved, next download will continue from here
+            raise errors[0]
+
+        if expected_md5 is not None:
+            actual_md5 = tools.file_md5(self.filename)
+            if actual_md5 != expected_md5:
+                os.remove(self.filename)
+                os.remove(self.progress_filename)
+                raise ChecksumMismatchException('Checksum of {0} is {1}, expected {2}'.format(
+                    self.url, actual_md5, expected_md5))
+        os.remove(self.progress_filename)
+        logger.info('[%s] Downloaded %s', self.log_prefix, self.url)
+        return self.filename
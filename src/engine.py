@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import time
 from enum import Enum
 from osmapi.OsmApi import ElementDeletedApiError
 
+import http_client
+import registry
 import tools
+from exceptions import CheckDependencyException, ServiceUnavailableException, SimulationException
+from simulation import SimulatedApi
 
 logger = tools.get_logger(__name__)
 
@@ -12,75 +18,378 @@ class Result(Enum):
     NOT_APPLICABLE = 1
     CHECKED_OK = 2
     CHECKED_ERROR = 3
+    DEPENDENCY_NOT_SATISFIED = 4
+    # Check could not be performed (service it needs is unavailable, or it took too long)
+    SKIPPED = 5
+
+
+def merge_checks(existing_checks, checks):
+    """
+    Merges checks done on the same entity (from different sources) into existing checks.
+    Errors are never overwritten, if both are erroneous, messages are joined. Skipped checks never overwrite
+    performed ones.
+    """
+    for check_name, check in checks.items():
+        if check_name in existing_checks and check['result'] == Result.SKIPPED:
+            continue
+        if check_name not in existing_checks or existing_checks[check_name]['result'] != Result.CHECKED_ERROR:
+            existing_checks[check_name] = check
+        elif check['result'] == Result.CHECKED_ERROR:
+            existing_checks[check_name]['messages'].extend(check['messages'])
+
+
+@functools.lru_cache(maxsize=None)
+def order_checks(check_classes):
+    """
+    Orders checks so that every check comes after all checks it depends on. Checks which are only dependencies
+    of given checks are included too.
+    :param check_classes: Tuple of check classes
+    :return: Tuple of check classes, in order in which they should be performed
+    """
+    ordered = []
+    visiting = []
+
+    def visit(check_cls):
+        if check_cls in ordered:
+            return
+        if check_cls in visiting:
+            cycle = visiting[visiting.index(check_cls):] + [check_cls]
+            raise CheckDependencyException('Checks are depending on each other: {0}'.format(
+                ' -> '.join(registry.name_of(c) for c in cycle)))
+        visiting.append(check_cls)
+        for dependency in check_cls.depends_on:
+            visit(dependency)
+        visiting.pop()
+        ordered.append(check_cls)
+
+    for check_cls in check_classes:
+        visit(check_cls)
+    return tuple(ordered)
+
+
+class EntityChunk(object):
+    """
+    Chunk of entities, together with their data in columns, for checks that can check all of them at once.
+    Columns are built on first use and shared between all checks using them.
+    """
+    def __init__(self, entities):
+        self.entities = entities
+        self.ids = [entity.id for entity in entities]
+        self.entity_types = [entity.entity_type for entity in entities]
+        self._columns = {}
+        self._subsets = {}
+
+    def __len__(self):
+        return len(self.entities)
+
+    def column(self, tag):
+        """
+        :param tag: Tag key
+        :return: List of values of given tag, one for each entity in chunk (None for entities without it)
+        """
+        if tag not in self._columns:
+            self._columns[tag] = [entity.tags.get(tag) for entity in self.entities]
+        return self._columns[tag]
+
+    def subset(self, indices):
+        """
+        :param indices: Indices of entities to take. Most checks are applicable on the same entities,
+        so same subset is returned for same indices.
+        :return: Chunk of only those entities
+        """
+        key = tuple(indices)
+        if key not in self._subsets:
+            self._subsets[key] = self if len(key) == len(self.entities) else \
+                EntityChunk([self.entities[i] for i in indices])
+        return self._subsets[key]
 
 
 class CheckEngine(object):
     """
     Main engine that do check dependency resolution, applicability resolution and perform all checks on one entity.
+    Each check is performed at most once on entity, no matter how many other checks need its result.
     """
     def __init__(self, check_classes, entity, global_context):
         self.check_classes = check_classes[:]
         self.entity = entity
         self.global_context = global_context
+        # Results of all performed checks (as (Result, message) tuples) and their artifacts, by check class
+        self.entity_context = {'checks': {}, 'results': {}, 'artifacts': {}, 'global_context': global_context,
+                               'engine': self}
+        # Stats are collected only if asked for
+        self.stats = global_context.get('stats')
+        # Applicable checks from the suite, as (check class name, check class) tuples, None until they are found
+        self.applicable_checks = None
+        # Keys claimed in run-wide deduplicator for the whole chunk entity is in, None if engine claims them itself
+        self.claimed = None
+        # Claimed keys of checks which are skipped, to be released so other sources can try them
+        self.skipped_keys = []
 
     @staticmethod
-    def do_entity_check_and_fix(check, entity):
-        """
-        Takes one entity and one check and performs check.
-        If check is erroneous, it will also try to fix error (if it is possible and allowed).
-        :param check: Check to perform
-        :param entity: Entity to check
-        :return: String that tells what check did. If it is empty, it means there is no problem.
-        """
-        name = entity.tags['name'] if 'name' in entity.tags else entity.id
-        message = check.do_check(entity)
-        if message != '': # OK, check is erroneous, let's see if we can perform fix
-            if check.entity_context['global_context']['fix']:
-                message_fixed = ''
-                try:
-                    message_fixed = check.fix(entity, check.entity_context['global_context']['api'])
-                except ElementDeletedApiError as e:
-                    # This can happen during fixing, just ignore and continue
-                    logger.exception(e)
-                if message_fixed != '':
-                    logger.debug('[%s] %s', check.entity_context['global_context']['map-check']['name'], message_fixed)
-        return message
+    def do_entity_fix(check, entity, check_stats=None):
+        """
+        Tries to fix error found by check (if it is possible and allowed). If fixes are simulated, fix is done
+        on entity as it is read from the map (see SimulatedApi), and nothing is read from OSM.
+        :param check: Check which found error
+        :param entity: Entity to fix
+        :param check_stats: CheckStats where time spent fixing is recorded, if stats are collected
+        :return: List of (tag, old value, new value) tuples fix would change if fixes are simulated, None otherwise
+        (or if fix could not be simulated)
+        """
+        global_context = check.entity_context['global_context']
+        if not global_context['fix']:
+            return None
+        api = SimulatedApi(entity) if global_context.get('simulate') else global_context['api']
+        message_fixed = ''
+        start = time.perf_counter()
+        try:
+            message_fixed = check.fix(entity, api)
+        except ElementDeletedApiError as e:
+            # This can happen during fixing, just ignore and continue
+            logger.exception(e)
+        except ServiceUnavailableException as e:
+            logger.warning('[%s] Fix of %s on %s %d is not done: %s', check.map_name, registry.name_of(type(check)),
+                           entity.entity_type, entity.id, e.message)
+        except SimulationException as e:
+            logger.warning('[%s] Fix of %s on %s %d cannot be simulated: %s', check.map_name,
+                           registry.name_of(type(check)), entity.entity_type, entity.id, e.message)
+            return None
+        if check_stats is not None:
+            check_stats.add_fix(time.perf_counter() - start)
+        if message_fixed != '':
+            logger.debug('[%s] %s', global_context['map-check']['name'], message_fixed)
+        return api.changes() if isinstance(api, SimulatedApi) else None
 
-    def check_all(self, filter_not_checked=True):
+    def check_stats(self, check_cls):
         """
-        Main method that does all checks.
-        :param filter_not_checked: If True, engine will remove all checks that resulted in not applicable
-        or dependecy not satisfied errors. This significantly lower memory footprint and is not needed for report.
-        :return: Dictionary of all check with name of the check class as key
+        :return: CheckStats of a check, or None if stats are not collected
+        """
+        if self.stats is None:
+            return None
+        return self.stats.check(self.global_context['map-check']['name'], registry.name_of(check_cls))
+
+    def _is_applicable(self, check_cls):
+        return any(a for a in check_cls.applicable_on if a.is_entity_applicable(self.entity))
+
+    def result_of(self, check_cls):
+        """
+        Result of a check on this entity. Check is performed only if it is not already performed (and it is never
+        fixed here, only checks from the suite are fixed). If any of checks it depends on did not pass, check is not
+        performed at all.
+        :param check_cls: Check class
+        :return: Tuple (Result, message)
+        """
+        results = self.entity_context['results']
+        if check_cls in results:
+            return results[check_cls]
+
+        result = self._precondition(check_cls)
+        if result is None:
+            result = self._perform(check_cls)
+        results[check_cls] = result
+        return result
+
+    def _perform(self, check_cls):
+        """
+        Performs check on this entity. Check is skipped if any service it needs is unavailable, or if it does not
+        finish its requests before check timeout (if there is one).
+        :return: Tuple (Result, message)
+        """
+        unavailable = [s for s in getattr(check_cls, 'services', []) if not http_client.is_available(s)]
+        if len(unavailable) > 0:
+            return Result.SKIPPED, 'Skipped: {0} unavailable'.format(', '.join(unavailable))
+
+        check = check_cls(self.entity_context)
+        start = time.perf_counter()
+        try:
+            with http_client.deadline(self.global_context.get('check_timeout')):
+                message = check.do_check(self.entity)
+        except ServiceUnavailableException as e:
+            return Result.SKIPPED, 'Skipped: {0}'.format(e.message)
+        finally:
+            if self.stats is not None:
+                self.check_stats(check_cls).add(time.perf_counter() - start, self.entity.entity_type, self.entity.id)
+        return (Result.CHECKED_OK, '') if message == '' else (Result.CHECKED_ERROR, message)
+
+    def _precondition(self, check_cls):
+        """
+        :return: Result of check if it is known without performing it (it is not applicable, or its dependencies
+        are not satisfied), None if check needs to be performed
         """
-        entity_context = {'checks': {}, 'local_store': {}, 'global_context': self.global_context}
+        if not self._is_applicable(check_cls):
+            return Result.NOT_APPLICABLE, ''
+        for dependency in check_cls.depends_on:
+            result, message = self.result_of(dependency)
+            if result == Result.SKIPPED:
+                # It is not known if check would pass, so it is skipped too
+                return Result.SKIPPED, message
+            if result != Result.CHECKED_OK:
+                return Result.DEPENDENCY_NOT_SATISFIED, ''
+        return None
 
-        for check_cls in self.check_classes:
-            check_cls_name = '{0}.{1}'.format(check_cls.__module__, check_cls.__name__)
+    def set_result(self, check_cls, result, message):
+        """
+        Sets result of check performed outside of engine (on the whole chunk)
+        """
+        self.entity_context['results'][check_cls] = result, message
+
+    def find_applicable_checks(self):
+        """
+        Finds which checks from the suite are applicable on entity. Checks which are not are recorded as such.
+        :return: List of (check class name, check class) tuples, in order in which checks are performed
+        """
+        if self.applicable_checks is not None:
+            return self.applicable_checks
+        self.applicable_checks = []
+        for check_cls in order_checks(tuple(self.check_classes)):
+            if check_cls not in self.check_classes:
+                # Only dependency of some check from the suite, it is performed when (and if) needed
+                continue
+            check_cls_name = registry.name_of(check_cls)
 
             # Test if we do check this on this entity
-            if not any(a for a in check_cls.applicable_on if a.is_entity_applicable(self.entity)):
-                entity_context['checks'][check_cls_name] = {
+            if not self._is_applicable(check_cls):
+                self.entity_context['checks'][check_cls_name] = {
                     'result': Result.NOT_APPLICABLE,
                     'messages': [],
                     'fixable': False}
                 continue
+            self.applicable_checks.append((check_cls_name, check_cls))
+        return self.applicable_checks
 
-            message = CheckEngine.do_entity_check_and_fix(check_cls(entity_context), self.entity)
-            if message == '':
-                entity_context['checks'][check_cls_name] = {'result': Result.CHECKED_OK,
-                                                            'messages': [],
-                                                            'fixable': False}
-            else:
+    def claim_keys(self):
+        """
+        :return: Keys of applicable checks in run-wide deduplicator, in the same order as applicable checks
+        """
+        suite = self.global_context['map-check']['suite']
+        return [(suite, self.entity.entity_type, self.entity.id, check_cls_name, check_cls.result_key(self.entity))
+                for check_cls_name, check_cls in self.find_applicable_checks()]
+
+    def _claim_checks(self):
+        """
+        Claims applicable checks in run-wide deduplicator (if there is one and they are not claimed for the whole
+        chunk already), so each check is done only once for this entity in this check suite, no matter how many
+        sources found it.
+        :return: List of (check class name, check class, key) tuples of applicable checks, without checks that were
+        already done by someone else. Key is None if there is no deduplicator
+        """
+        applicable_checks = self.find_applicable_checks()
+        deduplicator = self.global_context.get('deduplicator')
+        if deduplicator is None or len(applicable_checks) == 0:
+            return [(check_cls_name, check_cls, None) for check_cls_name, check_cls in applicable_checks]
+
+        keys = self.claim_keys()
+        claimed = self.claimed
+        if claimed is None:
+            claimed = deduplicator.claim(keys, self.global_context['map-check'].get('location'))
+        return [(check_cls_name, check_cls, key) for (check_cls_name, check_cls), key in zip(applicable_checks, keys)
+                if key in claimed]
+
+    def is_claimed(self, check_cls):
+        """
+        :return: True if this engine is going to perform given check from the suite (it is claimed, or nothing needs
+        to be claimed), or, for check which is only a dependency, if any claimed check could need it
+        """
+        if self.claimed is None:
+            return True
+        claimed_checks = [c for _, c, _ in self._claim_checks()]
+        if check_cls in self.check_classes:
+            return check_cls in claimed_checks
+        return len(claimed_checks) > 0
+
+    def check_all(self, filter_not_checked=True):
+        """
+        Main method that does all checks.
+        :param filter_not_checked: If True, engine will remove all checks that resulted in not applicable
+        or dependecy not satisfied errors. This significantly lower memory footprint and is not needed for report.
+        :return: Dictionary of all check with name of the check class as key
+        """
+        entity_context = self.entity_context
+
+        for check_cls_name, check_cls, key in self._claim_checks():
+            result, message = self.result_of(check_cls)
+            if result == Result.CHECKED_ERROR:
+                # OK, check is erroneous, let's see if we can perform fix
+                changes = CheckEngine.do_entity_fix(check_cls(entity_context), self.entity,
+                                                    self.check_stats(check_cls))
                 entity_context['checks'][check_cls_name] = {'result': Result.CHECKED_ERROR,
                                                             'messages': [message],
                                                             'fixable': check_cls.is_fixable}
+                if changes:
+                    entity_context['checks'][check_cls_name]['simulated_fix'] = changes
+            elif result == Result.SKIPPED:
+                entity_context['checks'][check_cls_name] = {'result': result,
+                                                            'messages': [message],
+                                                            'fixable': False}
+                if key is not None:
+                    self.skipped_keys.append(key)
+            else:
+                entity_context['checks'][check_cls_name] = {'result': result,
+                                                            'messages': [],
+                                                            'fixable': False}
+
+        if self.claimed is None and len(self.skipped_keys) > 0:
+            # It is not known if skipped check would pass, other sources can try it
+            self.global_context['deduplicator'].release(self.skipped_keys)
 
         # We don't care in reporting for unsatisfiable dependencies nor for not applicable checks, so filter those out
         filtered_checks = {}
         for check_cls_name in entity_context['checks']:
             check = entity_context['checks'][check_cls_name]
-            if (not filter_not_checked) or\
-                    check['result'] == Result.CHECKED_OK or check['result'] == Result.CHECKED_ERROR:
+            if (not filter_not_checked) or check['result'] in (Result.CHECKED_OK, Result.CHECKED_ERROR, Result.SKIPPED):
                 filtered_checks[check_cls_name] = check
         return filtered_checks
+
+
+def check_chunk(check_classes, entities, global_context):
+    """
+    Performs all checks on chunk of entities. Checks that can check all entities at once (see
+    AbstractCheck.do_check_batch) are performed on the whole chunk first, and all other checks are then performed
+    one entity at a time, as usual.
+    :param check_classes: Check classes to perform
+    :param entities: List of entities
+    :param global_context: Context
+    :return: List of checks done (as returned from CheckEngine.check_all), one for each entity
+    """
+    engines = [CheckEngine(check_classes, entity, global_context) for entity in entities]
+    deduplicator = global_context.get('deduplicator')
+    if deduplicator is not None:
+        # Checks of all entities are claimed at once, in one transaction
+        claimed = deduplicator.claim([key for engine in engines for key in engine.claim_keys()],
+                                     global_context['map-check'].get('location'))
+        for engine in engines:
+            engine.claimed = claimed
+    chunk = EntityChunk(entities)
+    for check_cls in order_checks(tuple(check_classes)):
+        if not getattr(check_cls, 'batch_capable', False):
+            continue
+        indices = []
+        for i, engine in enumerate(engines):
+            if not engine.is_claimed(check_cls):
+                # Someone else already did this check on this entity
+                continue
+            precondition = engine._precondition(check_cls)
+            if precondition is None:
+                indices.append(i)
+            else:
+                engine.set_result(check_cls, *precondition)
+        if len(indices) == 0:
+            continue
+
+        check = check_cls({'global_context': global_context, 'artifacts': {}})
+        start = time.perf_counter()
+        codes = check.do_check_batch(chunk.subset(indices))
+        if engines[0].stats is not None:
+            # Entity taking the longest cannot be known here, only time for whole batch
+            engines[0].check_stats(check_cls).add(time.perf_counter() - start, None, None, calls=len(indices))
+        for i, code in zip(indices, codes):
+            engine = engines[i]
+            # Errors are rare, so message for them is made by checking erroneous entity once again
+            message = check_cls(engine.entity_context).do_check(engine.entity) if code == Result.CHECKED_ERROR else ''
+            engine.set_result(check_cls, code, message)
+    all_checks = [engine.check_all() for engine in engines]
+    skipped_keys = [key for engine in engines for key in engine.skipped_keys]
+    if len(skipped_keys) > 0:
+        # It is not known if skipped checks would pass, other sources can try them
+        deduplicator.release(skipped_keys)
+    return all_checks
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding entity store - compact local database of entities from one PBF extract that checks care about.
+Store is built once per extract version (while extract is parsed) and later runs read entities from it directly,
+without downloading and parsing extract again.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+import simplejson
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+BATCH_SIZE = 10000
+# Changed whenever what is kept in store changes, so older stores are not used
+FORMAT = 2
+
+
+class StoredEntity(object):
+    """
+    Raw entity as read from entity store. Entities other than nodes do not have lat/lon attributes at all, same as
+    raw entities from PBF readers. Ways have centroid of their nodes instead, if it was known when store was built
+    (see OsmLintEntity.get_location).
+    """
+    __slots__ = ('id', 'version', 'entity_type', 'tags', 'lat', 'lon', 'centroid')
+
+    def __init__(self, entity_id, version, entity_type, tags, lat=None, lon=None):
+        self.id = entity_id
+        self.version = version
+        self.entity_type = entity_type
+        self.tags = tags
+        if lat is not None:
+            if entity_type == 'node':
+                self.lat = lat
+                self.lon = lon
+            else:
+                self.centroid = lat, lon
+
+
+def store_filename(store_dir, checksum, signature):
+    """
+    :param store_dir: Directory where all stores are kept
+    :param checksum: Checksum of the extract
+    :param signature: Identifies what is kept in store (which checks and rules it is made for)
+    :return: Filename of store for given extract version and checks
+    """
+    signature = '{0};{1}'.format(FORMAT, signature)
+    return os.path.join(store_dir, '{0}-{1}.db'.format(checksum, hashlib.sha256(signature.encode('utf-8'))
+                                                       .hexdigest()[:16]))
+
+
+class EntityStoreWriter(object):
+    """
+    Writes entities to new store. Store is visible under its final filename only after commit().
+    """
+    def __init__(self, filename, checksum, signature):
+        self.filename = filename
+        store_dir = os.path.dirname(filename)
+        os.makedirs(store_dir, exist_ok=True)
+        fd, self.temp_filename = tempfile.mkstemp(suffix='.tmp', dir=store_dir)
+        os.close(fd)
+        self.connection = sqlite3.connect(self.temp_filename)
+        self.connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE entities (type TEXT, id INTEGER, version INTEGER, lat REAL, lon REAL, '
+                                'tags TEXT, PRIMARY KEY (type, id)) WITHOUT ROWID')
+        self.connection.executemany('INSERT INTO meta VALUES (?, ?)', [('checksum', checksum),
+                                                                        ('signature', signature)])
+        self.batch = []
+        self.count = 0
+
+    def add(self, entity_type, entity_id, version, location, tags):
+        lat, lon = location if location is not None else (None, None)
+        self.batch.append((entity_type, entity_id, version, lat, lon, simplejson.dumps(tags, ensure_ascii=False)))
+        if len(self.batch) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self.connection.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)', self.batch)
+        self.count = self.count + len(self.batch)
+        self.batch = []
+
+    def commit(self):
+        self._flush()
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.temp_filename, self.filename)
+        logger.info('Stored %d entities to %s', self.count, self.filename)
+
+    def abort(self):
+        self.connection.close()
+        os.remove(self.temp_filename)
+
+
+def count_entities(filename):
+    """
+    :return: Number of entities in store
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        return connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def read_entities(filename):
+    """
+    Reads all entities from store
+    :return: Iterator over StoredEntity objects
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        for entity_type, entity_id, version, lat, lon, tags in connection.execute(
+                'SELECT type, id, version, lat, lon, tags FROM entities'):
+            yield StoredEntity(entity_id, version, entity_type, simplejson.loads(tags), lat, lon)
+    finally:
+        connection.close()
@@ -5,3 +5,41 @@ class CalculateDistanceException(Exception):
     def __init__(self, message):
         super(CalculateDistanceException, self).__init__()
         self.message = message
+
+
+class ChecksumMismatchException(Exception):
+    def __init__(self, message):
+        super(ChecksumMismatchException, self).__init__(message)
+        self.message = message
+
+
+class CheckDependencyException(Exception):
+    def __init__(self, message):
+        super(CheckDependencyException, self).__init__(message)
+        self.message = message
+
+
+class ServiceUnavailableException(Exception):
+    """
+    Raised instead of sending request to service which is down (its circuit breaker is open).
+    Retry loops should not catch it, there is no point waiting for service we already gave up on.
+    """
+    def __init__(self, message):
+        super(ServiceUnavailableException, self).__init__(message)
+        self.message = message
+
+
+class DeadlineExceededException(ServiceUnavailableException):
+    """
+    Raised instead of sending request after deadline of the check call or of the map is exceeded.
+    """
+    pass
+
+
+class SimulationException(Exception):
+    """
+    Raised when simulated fix needs something which is not available locally (like other entity).
+    """
+    def __init__(self, message):
+        super(SimulationException, self).__init__(message)
+        self.message = message
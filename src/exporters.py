@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding exporters of results in machine-readable formats (NDJSON, CSV, GeoJSON). Results are written while
+they are checked, by each source to its own part file, and parts are combined at the end of the run, so results
+are never held in memory for export.
+"""
+
+import csv
+import io
+import os
+import shutil
+
+import simplejson
+
+import tools
+from engine import Result
+
+logger = tools.get_logger(__name__)
+
+# Results which are exported. Passed checks are not, there are far more of them
+EXPORTED_RESULTS = {Result.CHECKED_ERROR: 'error', Result.SKIPPED: 'skipped'}
+
+CSV_COLUMNS = ['map', 'entity_type', 'entity_id', 'name', 'lat', 'lon', 'check', 'result', 'fixable', 'messages']
+
+
+class Exporter(object):
+    """
+    Abstract exporter. Each record is one line, with one (entity, check) result.
+    """
+    # Written at the beginning of the file, before all records
+    header = ''
+    # Written between records
+    separator = ''
+    # Written at the end of the file, after all records
+    footer = ''
+
+    def format(self, record):
+        """
+        :param record: Dictionary with all fields from CSV_COLUMNS
+        :return: Record, as line of text (ending with new line)
+        """
+        raise NotImplementedError()
+
+
+class NdjsonExporter(Exporter):
+    def format(self, record):
+        return simplejson.dumps(record, ensure_ascii=False) + '\n'
+
+
+class CsvExporter(Exporter):
+    header = ','.join(CSV_COLUMNS) + '\r\n'
+
+    def format(self, record):
+        output = io.StringIO()
+        csv.writer(output).writerow([record[c] if c != 'messages' else '; '.join(record[c]) for c in CSV_COLUMNS])
+        return output.getvalue()
+
+
+class GeoJsonExporter(Exporter):
+    header = '{"type": "FeatureCollection", "features": [\n'
+    separator = ',\n'
+    footer = ']}\n'
+
+    def format(self, record):
+        properties = {k: v for k, v in record.items() if k not in ('lat', 'lon')}
+        # Ways and relations do not have location
+        geometry = None if record['lat'] is None else {'type': 'Point', 'coordinates': [record['lon'], record['lat']]}
+        return simplejson.dumps({'type': 'Feature', 'id': '{0}/{1}'.format(record['entity_type'], record['entity_id']),
+                                 'geometry': geometry, 'properties': properties}, ensure_ascii=False) + '\n'
+
+
+EXPORTERS = {'ndjson': NdjsonExporter, 'csv': CsvExporter, 'geojson': GeoJsonExporter}
+
+
+def records(map_check_name, entity, checks_done):
+    """
+    :param map_check_name: Name of map-check entity is checked in
+    :param entity: OsmLintEntity
+    :param checks_done: Dictionary of checks done on entity, as returned from CheckEngine.check_all
+    :return: Iterator over records to export, one for each exported check
+    """
+    lat, lon = getattr(entity, 'lat', None), getattr(entity, 'lon', None)
+    for check_name, check in checks_done.items():
+        result = EXPORTED_RESULTS.get(check['result'])
+        if result is None:
+            continue
+        yield {'map': map_check_name, 'entity_type': entity.entity_type, 'entity_id': entity.id,
+               'name': entity.tags.get('name', ''), 'lat': lat, 'lon': lon, 'check': check_name, 'result': result,
+               'fixable': check['fixable'], 'messages': check['messages']}
+
+
+class Export(object):
+    """
+    Part files of one source, one for each format. Part files are opened on first write. If source is resumed
+    from checkpoint, parts are cut where they were when checkpoint was saved, so nothing is exported twice.
+    """
+    def __init__(self, filenames):
+        """
+        :param filenames: Dictionary of format -> part filename
+        """
+        self.filenames = filenames
+        self.exporters = {export_format: EXPORTERS[export_format]() for export_format in filenames}
+        self.files = None
+        # Where parts are cut when they are opened, None to start them from the beginning
+        self.offsets = None
+
+    def resume(self, offsets):
+        """
+        :param offsets: Size of each part, as returned from tell() when progress was saved
+        """
+        self.offsets = offsets
+
+    def _open(self):
+        self.files = {}
+        for export_format, filename in self.filenames.items():
+            offset = self.offsets.get(export_format) if self.offsets is not None else None
+            if offset is not None and os.path.exists(filename):
+                f = open(filename, 'r+b')
+                f.truncate(offset)
+                f.seek(offset)
+            else:
+                os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+                f = open(filename, 'wb')
+            self.files[export_format] = f
+
+    def write(self, map_check_name, entity, checks_done):
+        for record in records(map_check_name, entity, checks_done):
+            if self.files is None:
+                self._open()
+            for export_format, exporter in self.exporters.items():
+                self.files[export_format].write(exporter.format(record).encode('utf-8'))
+
+    def tell(self):
+        """
+        :return: Size of each part written so far (everything written is flushed)
+        """
+        if self.files is None:
+            self._open()
+        offsets = {}
+        for export_format, f in self.files.items():
+            f.flush()
+            offsets[export_format] = f.tell()
+        return offsets
+
+    def close(self):
+        if self.files is None:
+            # Nothing was found, but empty part still means map was exported
+            self._open()
+        for f in self.files.values():
+            f.close()
+
+
+def combine(export_format, parts, filename):
+    """
+    Combines parts of all sources into one file, streaming them.
+    :param export_format: One of EXPORTERS
+    :param parts: List of part filenames. Parts which do not exist are left out
+    :param filename: Output filename
+    """
+    exporter = EXPORTERS[export_format]()
+    separator = exporter.separator.encode('utf-8')
+    first = True
+    with open(filename, 'wb') as output:
+        output.write(exporter.header.encode('utf-8'))
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            with open(part, 'rb') as f:
+                if len(separator) == 0:
+                    # Records are not joined with anything, part can be copied as it is
+                    shutil.copyfileobj(f, output)
+                    continue
+                # Records are JSON, so each of them is on exactly one line, and separator comes instead of new line
+                for line in f:
+                    if not first:
+                        output.write(separator)
+                    output.write(line.rstrip(b'\n'))
+                    first = False
+        if not first:
+            output.write(b'\n')
+        output.write(exporter.footer.encode('utf-8'))
+    logger.info('Results exported to %s', filename)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+"""
+Common layer for all HTTP traffic to external services (Geofabrik, Sophox, Wikipedia/Wikidata, OSM API).
+All requests in one process go through one pooled session (with keep-alive connections to each host), and all
+requests from all processes are throttled by one rate limiter for each service, so parallel workers together never
+go over the rate each service allows.
+"""
+
+import contextlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+import osmapi
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import tools
+from exceptions import DeadlineExceededException, ServiceUnavailableException
+
+logger = tools.get_logger(__name__)
+
+# Service is guessed from the host request is sent to. Hosts of unknown services are not throttled.
+SERVICES = (
+    ('geofabrik.de', 'geofabrik'),
+    ('sophox.org', 'sophox'),
+    ('wikipedia.org', 'wikimedia'),
+    ('wikidata.org', 'wikimedia'),
+    ('openstreetmap.org', 'osm'),
+)
+# Requests per second and burst (maximum number of requests sent at once) for each service
+DEFAULT_RATES = {
+    'geofabrik': (10.0, 10),
+    'sophox': (2.0, 4),
+    'wikimedia': (10.0, 10),
+    'osm': (2.0, 2),
+}
+# Number of hosts we keep connections to, and number of connections kept to each host
+POOL_HOSTS = 10
+POOL_SIZE = 16
+ATTEMPTS = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Circuit of service is opened after this many failed requests in a row, and closed again after cooldown (in seconds)
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+
+_rate_limiter = None
+_circuit_breaker = None
+# Deadline (as time.time()) of everything in this process (e.g. of the map being processed), None if there is none
+_deadline = None
+# Deadline of the current call in each thread (e.g. of the check being performed)
+_call_deadline = threading.local()
+# Base URL (scheme://host:port) for hosts whose requests are sent somewhere else, e.g. to local stand-ins
+_host_overrides = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def service_for(url):
+    """
+    :return: Name of the service URL belongs to, or None if it is not one of known services
+    """
+    host = urlparse(url).hostname or ''
+    for domain, service in SERVICES:
+        if host == domain or host.endswith('.' + domain):
+            return service
+    return None
+
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter, so workers failing at the same time do not retry at the same time too.
+    :param attempt: Number of attempt that failed, starting from 1
+    :return: Number of seconds to wait before next attempt
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Token bucket for each service, shared between all workers through SQLite file.
+    """
+    def __init__(self, filename, rates=None):
+        """
+        :param filename: SQLite file where buckets are kept
+        :param rates: Dictionary of (requests per second, burst) for each service. Services not in it are not limited
+        """
+        self.filename = filename
+        self.rates = dict(DEFAULT_RATES) if rates is None else rates
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS buckets '
+                                   '(service TEXT PRIMARY KEY, tokens REAL, updated REAL) WITHOUT ROWID')
+
+    def __getstate__(self):
+        # Connections cannot be shared between processes, each process opens its own
+        return {'filename': self.filename, 'rates': self.rates}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.rates = state['rates']
+        self._local = threading.local()
+
+    def _connection(self):
+        return tools.thread_connection(self._local, self.filename)
+
+    def _take(self, service, rate, burst):
+        """
+        Takes one token from the bucket, if there is one.
+        :return: 0 if token is taken, or number of seconds to wait until there is one
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE service=?', (service,)).fetchone()
+            now = time.time()
+            tokens = burst if row is None else min(burst, row[0] + max(0, now - row[1]) * rate)
+            if tokens >= 1:
+                tokens = tokens - 1
+                delay = 0
+            else:
+                delay = (1 - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO buckets (service, tokens, updated) VALUES (?, ?, ?)',
+                               (service, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return delay
+
+    def acquire(self, service, timeout=None):
+        """
+        Blocks until request to given service can be sent.
+        :param timeout: Maximum number of seconds to wait, None to wait as long as needed
+        :return: True if request can be sent, False if it cannot be sent within timeout
+        """
+        if service not in self.rates:
+            return True
+        rate, burst = self.rates[service]
+        give_up = None if timeout is None else time.time() + timeout
+        throttled = False
+        while True:
+            delay = self._take(service, rate, burst)
+            if delay == 0:
+                return True
+            if not throttled:
+                throttled = True
+                metrics.inc('api_throttled_total', service=service)
+            if give_up is not None and time.time() + delay > give_up:
+                return False
+            time.sleep(delay)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for each service, shared between all workers through SQLite file. After a number of failed
+    requests (connection errors, timeouts, 5xx) in a row, service is considered unavailable and no requests are sent
+    to it until cooldown passes. After that, requests are let through again, and first one to fail opens it again.
+    """
+    def __init__(self, filename, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        """
+        :param filename: SQLite file where state of circuits is kept
+        :param failures: Number of failed requests in a row after which circuit is opened
+        :param cooldown: Number of seconds circuit is kept open
+        """
+        self.filename = filename
+        self.failures = failures
+        self.cooldown = cooldown
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS circuits '
+                                   '(service TEXT PRIMARY KEY, failures INTEGER, opened REAL) WITHOUT ROWID')
+
+    def __getstate__(self):
+        # Connections cannot be shared between processes, each process opens its own
+        return {'filename': self.filename, 'failures': self.failures, 'cooldown': self.cooldown}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.failures = state['failures']
+        self.cooldown = state['cooldown']
+        self._local = threading.local()
+
+    def _connection(self):
+        return tools.thread_connection(self._local, self.filename)
+
+    def is_available(self, service):
+        """
+        :return: False if circuit of service is open, True otherwise
+        """
+        if service is None:
+            return True
+        row = self._connection().execute('SELECT failures, opened FROM circuits WHERE service=?',
+                                         (service,)).fetchone()
+        return row is None or row[0] < self.failures or time.time() - row[1] >= self.cooldown
+
+    def record(self, service, succeeded):
+        """
+        Records result of request sent to service
+        """
+        if service is None:
+            return
+        connection = self._connection()
+        if succeeded:
+            # Most of the time there are no failures, and reading is cheaper than writing
+            if connection.execute('SELECT 1 FROM circuits WHERE service=?', (service,)).fetchone() is not None:
+                connection.execute('DELETE FROM circuits WHERE service=?', (service,))
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT failures FROM circuits WHERE service=?', (service,)).fetchone()
+            failures = 1 if row is None else row[0] + 1
+            connection.execute('INSERT OR REPLACE INTO circuits (service, failures, opened) VALUES (?, ?, ?)',
+                               (service, failures, time.time()))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if failures == self.failures:
+            logger.warning('Service %s failed %d times in a row, not sending requests to it for %d s',
+                           service, failures, self.cooldown)
+            metrics.inc('circuit_opened_total', service=service)
+
+
+def set_rate_limiter(rate_limiter):
+    """
+    Sets rate limiter used by all requests from this process. Needs to be called in each worker process.
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+def set_circuit_breaker(circuit_breaker):
+    """
+    Sets circuit breaker used by all requests from this process. Needs to be called in each worker process.
+    """
+    global _circuit_breaker
+    _circuit_breaker = circuit_breaker
+
+
+def is_available(service):
+    """
+    :return: False if requests to service are not sent at the moment, because it failed too many times
+    """
+    return _circuit_breaker is None or _circuit_breaker.is_available(service)
+
+
+def set_deadline(deadline):
+    """
+    Sets deadline after which no more requests are sent from this process.
+    :param deadline: Deadline as time.time(), or None to remove it
+    """
+    global _deadline
+    _deadline = deadline
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Within this block, requests from this thread are not sent after given number of seconds, and their timeouts
+    are shortened so they do not go over it.
+    :param seconds: Number of seconds, or None for no deadline
+    """
+    if seconds is None:
+        yield
+        return
+    previous = getattr(_call_deadline, 'deadline', None)
+    _call_deadline.deadline = time.time() + seconds
+    try:
+        yield
+    finally:
+        _call_deadline.deadline = previous
+
+
+def remaining_time():
+    """
+    :return: Number of seconds until the closest deadline of this thread, or None if there is no deadline
+    """
+    deadlines = [d for d in (_deadline, getattr(_call_deadline, 'deadline', None)) if d is not None]
+    if len(deadlines) == 0:
+        return None
+    return min(deadlines) - time.time()
+
+
+def _shorten_timeout(timeout, remaining):
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def set_host_overrides(host_overrides):
+    """
+    Sends all requests to given hosts to other base URLs instead (used to run against local stand-ins of external
+    services). Requests are still throttled as requests to the original service. Needs to be called in each worker
+    process.
+    :param host_overrides: Dictionary of host -> base URL (scheme://host:port)
+    """
+    global _host_overrides
+    _host_overrides = dict(host_overrides)
+
+
+def override_url(url):
+    """
+    :return: URL where request to given URL is really sent
+    """
+    parsed = urlparse(url)
+    base = _host_overrides.get(parsed.hostname)
+    if base is None:
+        return url
+    return base.rstrip('/') + parsed._replace(scheme='', netloc='').geturl()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter which waits for rate limiter before each request is sent. It can be mounted to sessions
+    of other libraries too (pywikibot, osmapi), so their requests are throttled together with ours.
+    """
+    def __init__(self):
+        super(RateLimitedAdapter, self).__init__(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+
+    def send(self, request, **kwargs):
+        service = service_for(request.url)
+        if not is_available(service):
+            raise ServiceUnavailableException('{0} is unavailable'.format(service))
+        # Throttled request is not waiting for its turn over deadline
+        if _rate_limiter is not None and not _rate_limiter.acquire(service, remaining_time()):
+            raise DeadlineExceededException('deadline exceeded while waiting for turn to send request to {0}'.format(
+                service or 'other'))
+        remaining = remaining_time()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceededException('deadline exceeded before request to {0}'.format(service or 'other'))
+            kwargs['timeout'] = _shorten_timeout(kwargs.get('timeout'), remaining)
+        metrics.inc('api_requests_total', service=service or 'other')
+        if len(_host_overrides) > 0:
+            request.url = override_url(request.url)
+        try:
+            response = super(RateLimitedAdapter, self).send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if _circuit_breaker is not None:
+                _circuit_breaker.record(service, False)
+            raise
+        if _circuit_breaker is not None:
+            _circuit_breaker.record(service, response.status_code < 500)
+        return response
+
+
+def mount(session):
+    """
+    Makes all requests from given session pooled and rate limited
+    """
+    adapter = RateLimitedAdapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    :return: Session shared by all threads of this process
+    """
+    pid = os.getpid()
+    with _sessions_lock:
+        # Sessions are not inherited by forked workers, each process has its own connections
+        if pid not in _sessions:
+            _sessions[pid] = mount(requests.Session())
+        return _sessions[pid]
+
+
+def _request_with_retries(method, url, attempts, **kwargs):
+    session = get_session()
+    for attempt in range(1, attempts + 1):
+        try:
+            r = session.request(method, url, **kwargs)
+            if r.status_code not in RETRY_STATUSES or attempt == attempts:
+                return r
+            delay = float(r.headers['Retry-After']) if r.headers.get('Retry-After', '').isdigit() \
+                else backoff_delay(attempt)
+            r.close()
+            logger.warning('Got status %d from %s, retrying in %.1f s', r.status_code, url, delay)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == attempts:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning('Error requesting %s (%s), retrying in %.1f s', url, e, delay)
+        metrics.inc('api_retries_total', service=service_for(url) or 'other')
+        time.sleep(delay)
+
+
+def request(method, url, attempts=ATTEMPTS, hedge_after=None, **kwargs):
+    """
+    Sends request, retrying it (with jittered backoff) on connection errors and on statuses which usually mean
+    that server is overloaded.
+    :param method: HTTP method
+    :param url: URL to send request to
+    :param attempts: Maximum number of attempts
+    :param hedge_after: If set, and there is no response after this many seconds, same request is sent once again
+    and whichever response comes first is used. Use only for idempotent requests which are not streamed.
+    :param kwargs: Other parameters passed to requests
+    :return: requests Response. It is not checked for errors, it is up to the caller to do so.
+    """
+    if hedge_after is None:
+        return _request_with_retries(method, url, attempts, **kwargs)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [executor.submit(_request_with_retries, method, url, attempts, **kwargs)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if len(done) == 0:
+            logger.info('No response from %s after %.1f s, sending hedged request', url, hedge_after)
+            futures.append(executor.submit(_request_with_retries, method, url, attempts, **kwargs))
+        pending = futures
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if len(succeeded) == 0 and len(pending) > 0:
+                # Failed, but the other one can still succeed
+                continue
+            winner = succeeded[0] if len(succeeded) > 0 else done.pop()
+            # Responses nobody is going to read should give their connections back to the pool
+            for other in succeeded[1:]:
+                other.result().close()
+            for other in pending:
+                other.add_done_callback(lambda f: f.exception() is None and f.result().close())
+            return winner.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+class OsmApi(osmapi.OsmApi):
+    """
+    osmapi client which sends its requests through our rate limited adapter
+    """
+    def _get_http_session(self):
+        return mount(super(OsmApi, self)._get_http_session())
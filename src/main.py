@@ -5,74 +5,107 @@ import collections
 import datetime
 import logging
 import multiprocessing
-
-# DO NOT REMOVE, needed to import it, so we can query __doc__ from those checks
-import checks, checks_extended
-
-# Just so lint is not complaining on unused import
-_ = checks.AbstractCheck
-_ = checks_extended.AbstractCheck
-
 import os
+import shutil
+import sys
 import tempfile
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError, as_completed, wait
 
-import osmapi
 import requests
 import simplejson
-from jinja2 import Environment, PackageLoader
 
+import daemon
+import exporters
+import http_client
+import metrics
+import regions
+import registry
 import tools
-from engine import CheckEngine, Result
-from sources.source_factory import SourceFactory
+from checkpoint import Checkpoints
+from results_db import ResultsDatabase
+from memory import MemoryProfiler
+from stats import Stats
+from deduplication import EntityDeduplicator
+from engine import Result, check_chunk, merge_checks
+from sources.source_factory import SourceFactory, group_by_location
+
+logger = tools.get_logger(__name__)
 
-logger = tools.setup_logger(logging_level=logging.INFO)
+# With --deadline, maps stop reading at this part of it, so there is time left to check what they found and make report
+DEADLINE_READING = 0.9
 
 
-def process_entity(entity, context):
+def process_entities(entities, context):
     """
-    Takes one entity and performs all check with engine on it.
-    :param entity: Entity to check
+    Takes chunk of entities and performs all check with engine on them.
+    :param entities: List of entities to check
     :param context: Context
-    :return: List of all performed checks
+    :return: List of all performed checks, for each entity
     """
     map_check = context['map-check']
-    cr = CheckEngine(map_check['checks'], entity, context)
-    return cr.check_all()
+    return check_chunk(map_check['checks'], entities, context)
 
 
-def generate_report(context, all_checks):
+def generate_report(context, all_checks, stats=None, incomplete=None, changes=None):
     """
     Generates all data needed to create report and creates it.
+    :param stats: Stats of the run, if they are collected
+    :param incomplete: Reason why not all entities are checked, for each map-check name where they are not
+    :param changes: Changes since previous run (see ResultsDatabase.changes), None if there is no previous run
     """
-    env = Environment(loader=PackageLoader('__main__', 'templates'))
+    # Only needed at the very end, no need for workers to import it
+    from jinja2 import Environment, FileSystemLoader
+    # Templates are found next to this file, even when report is generated from somewhere else (e.g. benchmarks)
+    env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
     template = env.get_template('report_template.html')
 
     # Calculate by countries and summary
-    count_total_checks, count_total_errors, count_total_fixable_errors = 0, 0, 0
+    incomplete = incomplete or {}
+    count_total_checks, count_total_errors, count_total_fixable_errors, count_total_skipped = 0, 0, 0, 0
+    count_total_simulated_fixes = 0
     countries = []
     for map_name, map_check in all_checks.items():
         count_map_checks = len(map_check)
-        count_map_errors, count_map_fixable_errors = 0, 0
+        count_map_errors, count_map_fixable_errors, count_map_skipped, count_map_simulated_fixes = 0, 0, 0, 0
         for entity_check in map_check.values():
             for type_check in entity_check[2].values():
                 if type_check['result'] == Result.CHECKED_ERROR:
                     count_map_errors = count_map_errors + 1
                     if type_check['fixable']:
                         count_map_fixable_errors = count_map_fixable_errors + 1
+                    if 'simulated_fix' in type_check:
+                        count_map_simulated_fixes = count_map_simulated_fixes + 1
+                elif type_check['result'] == Result.SKIPPED:
+                    count_map_skipped = count_map_skipped + 1
         countries.append((map_name, {'count_map_checks': count_map_checks,
                                      'count_map_errors': count_map_errors,
-                                     'count_map_fixable_errors': count_map_fixable_errors}),)
+                                     'count_map_fixable_errors': count_map_fixable_errors,
+                                     'count_map_skipped': count_map_skipped,
+                                     'count_map_simulated_fixes': count_map_simulated_fixes,
+                                     'incomplete': incomplete.get(map_name)}),)
         count_total_checks = count_total_checks + count_map_checks
         count_total_errors = count_total_errors + count_map_errors
         count_total_fixable_errors = count_total_fixable_errors + count_map_fixable_errors
+        count_total_skipped = count_total_skipped + count_map_skipped
+        count_total_simulated_fixes = count_total_simulated_fixes + count_map_simulated_fixes
+    # Maps which failed do not have any results, but they are still listed
+    for map_name, reason in incomplete.items():
+        if map_name not in all_checks:
+            countries.append((map_name, {'count_map_checks': 0, 'count_map_errors': 0, 'count_map_fixable_errors': 0,
+                                         'count_map_skipped': 0, 'count_map_simulated_fixes': 0,
+                                         'incomplete': reason}))
 
     countries = sorted(countries, key=lambda country: country[0])
     summary = {
         'maps': len(all_checks),
         'count_total_checks': count_total_checks,
         'count_total_errors': count_total_errors,
-        'count_total_fixable_errors': count_total_fixable_errors
+        'count_total_fixable_errors': count_total_fixable_errors,
+        'count_total_skipped': count_total_skipped,
+        'count_total_simulated_fixes': count_total_simulated_fixes,
+        'simulate': context.get('simulate', False),
+        'incomplete_maps': len(incomplete)
     }
 
     # Calculate by check types
@@ -81,35 +114,32 @@ def generate_report(context, all_checks):
         for entity_check in map_check.values():
             for type_check, check in entity_check[2].items():
                 if type_check not in check_types:
-                    type_check_cls = eval(type_check)
+                    type_check_cls = registry.resolve(type_check)
                     check_types[type_check] = {'explanation': type_check_cls.__doc__.strip(),
                                                'count_total_checks': 0,
-                                               'count_total_errors': 0}
+                                               'count_total_errors': 0,
+                                               'count_total_skipped': 0}
                 check_types[type_check]['count_total_checks'] = check_types[type_check]['count_total_checks'] + 1
-                if check['result'] != Result.CHECKED_OK:
+                if check['result'] == Result.CHECKED_ERROR:
                     check_types[type_check]['count_total_errors'] = check_types[type_check]['count_total_errors'] + 1
+                elif check['result'] == Result.SKIPPED:
+                    check_types[type_check]['count_total_skipped'] = check_types[type_check]['count_total_skipped'] + 1
 
     check_types = collections.OrderedDict(sorted(check_types.items(), key=lambda c: c[0]))
 
 
     # Each check is under "<overall_map_name> (<particular_source>)" and
     # we want to regroup and merge them all under "<overall_map_name>" only.
+    # Each check is done only once on each entity (see EntityDeduplicator), so there are no duplicates here.
     all_checks_merged = {}
     for full_map_name, check_dict in all_checks.items():
         overall_map_name = full_map_name.split(' (')[0]
-        if overall_map_name not in all_checks_merged:
-            all_checks_merged[overall_map_name] = {}
-        for entity_id, checks in check_dict.items():
-            if entity_id not in all_checks_merged[overall_map_name]:
-                all_checks_merged[overall_map_name][entity_id] = checks
+        merged = all_checks_merged.setdefault(overall_map_name, {})
+        for key, checks in check_dict.items():
+            if key not in merged:
+                merged[key] = checks
             else:
-                existing_checks_dict = checks[2]
-                for existing_check_name, existing_check_dict in existing_checks_dict.items():
-                    if existing_check_name in all_checks_merged[overall_map_name][entity_id][2]:
-                        # Somehow we already have this entity with this check
-                        pass
-                    else:
-                        all_checks_merged[overall_map_name][entity_id][2][existing_check_name] = existing_check_dict
+                merge_checks(merged[key][2], checks[2])
 
     # Sort all checks by overall map name (and sort all values which are also dictionaries by entity name)
     all_checks_sorted = {}
@@ -117,8 +147,18 @@ def generate_report(context, all_checks):
         all_checks_sorted[full_map_name] = collections.OrderedDict(sorted(check_dict.items(), key=lambda c: c[1][0]))
     all_checks_sorted = collections.OrderedDict(sorted(all_checks_sorted.items(), key=lambda c: c[0]))
 
+    # Slowest checks first
+    check_stats = []
+    if stats is not None:
+        for map_name, checks in stats.checks.items():
+            for check_name, check_stat in checks.items():
+                check_stats.append((map_name, check_name, check_stat.to_json()))
+        check_stats.sort(key=lambda c: c[2]['total'] + c[2]['fix_total'], reverse=True)
+    source_stats = sorted(stats.sources.items()) if stats is not None else []
+
     output = template.render(d=datetime.datetime.now(), summary=summary, countries=countries, check_types=check_types,
-                             all_checks=all_checks_sorted)
+                             all_checks=all_checks_sorted, check_stats=check_stats, source_stats=source_stats,
+                             changes=changes)
     with open(context['report_filename'], 'w', encoding='utf-8') as fh:
         fh.write(output)
 
@@ -143,11 +183,134 @@ def create_global_context():
                         help='Do not create final HTML report. Default is to create report.')
     parser.add_argument('--dry-run', action='store_true',
                         help='Dry run mode. Do all the checks and get data, but never commit to OSM')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Simulate fixes. Fixes are done on entities as they are read from maps, without asking '
+                             'and without reading anything from (or sending anything to) OSM, in all threads. '
+                             'Report shows what each fix would change. Implies --fix')
+    parser.add_argument('--sophox-tile-radius', metavar='KM', type=float, default=50,
+                        help='Sophox queries covering bigger area are split to tiles of this radius (in km), '
+                             'which are executed in parallel. Default is 50.')
+    parser.add_argument('--sophox-workers', metavar='N', type=int, default=4,
+                        help='Number of Sophox tiles to execute in parallel for each query. Default is 4.')
+    parser.add_argument('--sophox-cache-dir', default='sophox-cache',
+                        help='Directory where Sophox responses are cached. Default is "sophox-cache".')
+    parser.add_argument('--sophox-cache-ttl', metavar='HOURS', type=float, default=24,
+                        help='Sophox responses older than this (in hours) are not used from cache. '
+                             'Use 0 to disable cache. Default is 24.')
+    parser.add_argument('--extract', metavar='URL',
+                        help='URL (or local file) of one big PBF extract covering all PBF maps from config. If given, '
+                             'it is read only once instead of all PBF maps and entities are routed to maps by their '
+                             'regions (Geofabrik .poly files, or "regions" from config).')
+    parser.add_argument('--entity-store-dir', metavar='DIR',
+                        help='If given, entities that checks care about are kept in this directory, in one store '
+                             'for each version of each PBF map. Later runs on the same version of map are reading '
+                             'them from there, without downloading and parsing map again.')
+    parser.add_argument('--download-dir', metavar='DIR',
+                        help='Directory where maps are downloaded. Interrupted downloads are resumed from there. '
+                             'Default is system temporary directory.')
+    parser.add_argument('--download-connections', metavar='N', type=int, default=4,
+                        help='Number of parallel connections (ranges) used to download each map. Default is 4.')
+    parser.add_argument('--check-chunk-size', metavar='N', type=int, default=1000,
+                        help='Entities are checked in chunks of this size, so checks which can check many entities '
+                             'at once do it faster. Default is 1000.')
+    parser.add_argument('--limit', metavar='N', type=int,
+                        help='Development mode. Each source stops reading map after N entities are taken, '
+                             'so new check can be tried quickly.')
+    parser.add_argument('--sample', metavar='PERCENT', type=float,
+                        help='Development mode. Only given percent of entities of each map is taken. Entities are '
+                             'chosen by hash of their id, so the same entities are taken in every run.')
+    parser.add_argument('--bbox', metavar='MIN_LON,MIN_LAT,MAX_LON,MAX_LAT',
+                        help='Development mode. Only entities inside this bounding box (left,bottom,right,top, '
+                             'as in OSM) are taken. Ways are taken by centroid of their nodes (only when map is read '
+                             'with PyOsmium), relations are never taken.')
+    parser.add_argument('--checkpoint-dir', default='checkpoints',
+                        help='Directory where results of each finished map, and progress of maps being read, are '
+                             'kept while run is going on. Default is "checkpoints".')
+    parser.add_argument('--checkpoint-interval', metavar='SECONDS', type=float, default=300,
+                        help='How often progress of PBF map being read is saved. Use 0 to keep only results of '
+                             'finished maps. Default is 300.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue run which died, from checkpoints it left: finished maps are not processed '
+                             'again, and PBF maps are read from where they were saved last time.')
+    parser.add_argument('--export', metavar='FORMAT=FILE', action='append', default=[],
+                        help='Export errors (and skipped checks), one record for each check on each entity, to FILE in '
+                             'FORMAT ({0}). Records are written while maps are checked. Can be given more '
+                             'times.'.format(', '.join(sorted(exporters.EXPORTERS))))
+    parser.add_argument('--results-db', metavar='FILE', default='results.db',
+                        help='Database where errors found in each run are kept, so they can be compared between runs '
+                             '(new and resolved errors are shown in the report). Default is "results.db".')
+    parser.add_argument('--results-keep', metavar='N', type=int, default=30,
+                        help='Number of last runs kept in results database. Default is 30.')
+    parser.add_argument('--no-results-db', action='store_true',
+                        help='Do not keep results in results database (and do not compare them with previous run).')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running: run again on schedule (see --interval), or as soon as any PBF map '
+                             'changes (see --poll), with the same warm workers, and serve results of the last run '
+                             'on local HTTP API (see --api-port).')
+    parser.add_argument('--interval', metavar='SECONDS', type=float, default=86400,
+                        help='In daemon mode, how long to wait after run is done before running again. '
+                             'Default is 86400 (one day).')
+    parser.add_argument('--poll', metavar='SECONDS', type=float, default=600,
+                        help='In daemon mode, how often to check if any PBF map changed (from its checksum, '
+                             'or size and time of local file). Use 0 to run only on schedule. Default is 600.')
+    parser.add_argument('--api-port', metavar='PORT', type=int, default=9465,
+                        help='In daemon mode, results are served on http://127.0.0.1:PORT/ (/errors, /changes and '
+                             '/status). Default is 9465.')
+    parser.add_argument('--wiki-cache-ttl', metavar='SECONDS', type=float,
+                        help='How long what checks need from Wikipedia pages and Wikidata items is kept in each '
+                             'worker. In daemon mode, keep it longer than --interval, so runs start with warm cache. '
+                             'Default is two days.')
+    parser.add_argument('--deadline', metavar='SECONDS', type=float,
+                        help='Report is made at most this many seconds after start, from whatever is checked by then. '
+                             'Maps which are not done are marked in the report.')
+    parser.add_argument('--map-deadline', metavar='SECONDS', type=float,
+                        help='Each map stops reading after this many seconds, and only what is read by then is '
+                             'checked and marked in the report.')
+    parser.add_argument('--check-timeout', metavar='SECONDS', type=float,
+                        help='Check which does not finish its requests to external services in this many seconds '
+                             'is skipped (and marked in the report).')
+    parser.add_argument('--breaker-failures', metavar='N', type=int, default=http_client.BREAKER_FAILURES,
+                        help='After this many failed requests in a row, external service is considered unavailable: '
+                             'no requests are sent to it and checks needing it are skipped, until cooldown passes. '
+                             'Default is {0}.'.format(http_client.BREAKER_FAILURES))
+    parser.add_argument('--breaker-cooldown', metavar='SECONDS', type=float, default=http_client.BREAKER_COOLDOWN,
+                        help='How long external service is considered unavailable. Default is {0}.'.format(
+                            http_client.BREAKER_COOLDOWN))
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='If given, time spent in each check and source counters are collected, written to this '
+                             'file (as JSON) and summarised in the report.')
+    parser.add_argument('--memory-profile', metavar='FILE',
+                        help='If given, memory of each worker is sampled after each stage of processing each map '
+                             '(download, read, check, result) and written to this file (as JSON). Chunks of entities '
+                             'checked while map is still read are accounted to check stage.')
+    parser.add_argument('--memory-tracemalloc', action='store_true',
+                        help='With --memory-profile, also trace Python allocations and write top allocation sites '
+                             'at each stage. Makes run much slower.')
+    parser.add_argument('--rate-limit', metavar='SERVICE=RATE[:BURST]', action='append', default=[],
+                        help='Maximum number of requests per second sent to service ({0}), together from all workers. '
+                             'Can be given more times.'.format(', '.join(sorted(http_client.DEFAULT_RATES))))
+    parser.add_argument('--redirect-host', metavar='HOST=URL', action='append', default=[],
+                        help='Send all requests to HOST to base URL (scheme://host:port) instead. Used to run against '
+                             'local stand-ins of external services (see benchmark/run_e2e.py). Can be given more '
+                             'times.')
+    parser.add_argument('--log-debug-rate', metavar='N', type=int, default=tools.DEBUG_RATE,
+                        help='Maximum number of debug messages per second written to log from each module in each '
+                             'worker, others are dropped. Use 0 for no limit. Default is {0}.'.format(tools.DEBUG_RATE))
+    parser.add_argument('--metrics-textfile', metavar='FILE',
+                        help='If given, live metrics (entities per second, bytes downloaded, API requests, ETA...) '
+                             'are periodically written to this file, in Prometheus text format.')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                        help='If given, live metrics are served on http://127.0.0.1:PORT/metrics, '
+                             'in Prometheus text format.')
+    parser.add_argument('--metrics-interval', metavar='SECONDS', type=float, default=10,
+                        help='How often live metrics are exported. Default is 10.')
     parser.add_argument('-v', '--version', action='version', version='Serbian OSM Lint 0.1')
 
     args = parser.parse_args()
 
-    if not os.path.isfile(args.password_file):
+    if args.simulate:
+        args.fix = True
+    if not args.simulate and not os.path.isfile(args.password_file):
         error_msg = 'File {0} is missing. You need to create it and write in it <your_osm_mail>:<your_osm_password> '\
                     'for Serbian OSM Lint to function.'.format(args.password_file)
         parser.error(error_msg)
@@ -162,12 +325,13 @@ def create_global_context():
         except Exception as e:
             parser.error('Error during parsing of {}: \n{}'.format(args.config_file, e))
 
-    # Replace checks in config with their eval-ulated version (helps to detects errors earlier)
+    # Replace checks in config with their classes (helps to detects errors earlier)
     for _checks in config:
-        eval_checks = []
-        for check in config[_checks]['checks']:
-            eval_checks.append(eval(check))
-        config[_checks]['checks'] = eval_checks
+        try:
+            config[_checks]['checks'] = [registry.resolve(check) for check in config[_checks]['checks']]
+            config[_checks]['rules'] = [registry.resolve(rule) for rule in config[_checks].get('rules', [])]
+        except ValueError as e:
+            parser.error('Error in config {0}: {1}'.format(args.config_file, e))
 
     # Create Descartes product of all maps and all checks which we use throughout whole program
     config['_map-checks'] = []
@@ -175,11 +339,38 @@ def create_global_context():
         if _checks.startswith('_'):
             continue
         for _map in config[_checks]['maps']:
-            config['_map-checks'].append({
+            map_check = {
                 "name": "{0} ({1})".format(_checks, _map),
+                "suite": _checks,
                 "location": config[_checks]['maps'][_map],
-                "checks": config[_checks]['checks']
-            })
+                "checks": config[_checks]['checks'],
+                "rules": config[_checks]['rules']
+            }
+            if args.extract and map_check['location'].endswith('.pbf'):
+                region_location = config[_checks].get('regions', {}).get(_map) or \
+                                  regions.region_location(map_check['location'])
+                if region_location is None:
+                    parser.error('Cannot find region for map {0}, add it to "regions" in config'.format(_map))
+                map_check['region'] = regions.load_region(region_location)
+                map_check['location'] = args.extract
+            config['_map-checks'].append(map_check)
+
+    if args.check_chunk_size <= 0:
+        parser.error('--check-chunk-size must be greater than 0')
+
+    if args.limit is not None and args.limit <= 0:
+        parser.error('--limit must be greater than 0')
+    if args.sample is not None and not 0 < args.sample <= 100:
+        parser.error('--sample must be greater than 0 and at most 100')
+    bbox = None
+    if args.bbox is not None:
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(b) for b in args.bbox.split(','))
+        except ValueError:
+            parser.error('--bbox must be in format MIN_LON,MIN_LAT,MAX_LON,MAX_LAT')
+        if min_lon >= max_lon or min_lat >= max_lat:
+            parser.error('--bbox must have minimums smaller than maximums')
+        bbox = (min_lat, min_lon, max_lat, max_lon)
 
     try:
         changeset_size = int(args.changeset_size)
@@ -189,58 +380,442 @@ def create_global_context():
     if changeset_size <= 0:
         parser.error('--changeset_size must be greater than 0')
 
-    api = osmapi.OsmApi(passwordfile=args.password_file,
-                        changesetauto=not args.dry_run, changesetautosize=changeset_size, changesetautotags=
-                        {u"comment": u"Serbian lint bot. Various fixes around name:sr, name:sr-Latn and "
-                                     u"wikidata/wikipedia links",
-                         u"tag": u"mechanical=yes"})
+    rates = dict(http_client.DEFAULT_RATES)
+    for rate_limit in args.rate_limit:
+        try:
+            service, rate = rate_limit.split('=')
+            rate, _, burst = rate.partition(':')
+            rates[service] = (float(rate), int(burst) if burst else max(1, int(float(rate))))
+        except ValueError:
+            parser.error('--rate-limit must be in format SERVICE=RATE[:BURST]')
+        if service not in http_client.DEFAULT_RATES:
+            parser.error('--rate-limit service must be one of {0}'.format(', '.join(sorted(http_client.DEFAULT_RATES))))
+        if rates[service][0] <= 0:
+            parser.error('--rate-limit must be greater than 0')
+        if rates[service][1] < 1:
+            # Bucket never gets a whole token, so requests would wait forever
+            parser.error('--rate-limit burst must be at least 1')
+
+    host_overrides = {}
+    for redirect_host in args.redirect_host:
+        host, _, url = redirect_host.partition('=')
+        if host == '' or not url.startswith(('http://', 'https://')):
+            parser.error('--redirect-host must be in format HOST=URL')
+        host_overrides[host] = url
+    http_client.set_host_overrides(host_overrides)
+
+    if args.log_debug_rate < 0:
+        parser.error('--log-debug-rate must not be negative')
+
+    if args.metrics_interval <= 0:
+        parser.error('--metrics-interval must be greater than 0')
+
+    if args.checkpoint_interval < 0:
+        parser.error('--checkpoint-interval must not be negative')
+
+    for option, value in (('--deadline', args.deadline), ('--map-deadline', args.map_deadline),
+                          ('--check-timeout', args.check_timeout), ('--breaker-cooldown', args.breaker_cooldown)):
+        if value is not None and value <= 0:
+            parser.error('{0} must be greater than 0'.format(option))
+    if args.breaker_failures <= 0:
+        parser.error('--breaker-failures must be greater than 0')
+    if args.results_keep <= 0:
+        parser.error('--results-keep must be greater than 0')
+
+    if args.wiki_cache_ttl is not None and args.wiki_cache_ttl < 0:
+        parser.error('--wiki-cache-ttl must not be negative')
+
+    if args.daemon:
+        if args.no_results_db:
+            parser.error('--daemon serves results from results database, it cannot be used with --no-results-db')
+        if args.interval <= 0:
+            parser.error('--interval must be greater than 0')
+        if args.poll < 0:
+            parser.error('--poll must not be negative')
+        if args.entity_store_dir is None:
+            # Maps which did not change since last run are not downloaded and parsed again
+            args.entity_store_dir = 'entity-store'
+
+    exports = {}
+    for export in args.export:
+        export_format, _, filename = export.partition('=')
+        if export_format not in exporters.EXPORTERS or filename == '':
+            parser.error('--export must be in format FORMAT=FILE, where FORMAT is one of {0}'.format(
+                ', '.join(sorted(exporters.EXPORTERS))))
+        exports[export_format] = filename
+
+    # Checkpoints made with different options are having different results, they are not used
+    result_options = {'fix': args.fix, 'simulate': args.simulate, 'limit': args.limit, 'sample': args.sample,
+                      'bbox': bbox}
+    # Maps done without export have nothing to export, so they are done again
+    checkpoints = Checkpoints(args.checkpoint_dir, dict(result_options, exports=sorted(exports)))
+    if not args.resume:
+        checkpoints.clear()
+
+    # Everything created during the run which is shared between workers, removed at the end of the run
+    run_dir = tempfile.mkdtemp(prefix='serbian-osm-lint_')
+    rate_limiter = http_client.RateLimiter(os.path.join(run_dir, 'rate-limiter.db'), rates)
+    http_client.set_rate_limiter(rate_limiter)
+    circuit_breaker = http_client.CircuitBreaker(os.path.join(run_dir, 'circuit-breaker.db'), args.breaker_failures,
+                                                 args.breaker_cooldown)
+    http_client.set_circuit_breaker(circuit_breaker)
+    metrics_store = None
+    if args.metrics_textfile is not None or args.metrics_port is not None:
+        # Workers write their metrics twice as often as they are exported
+        metrics_store = metrics.MetricsStore(os.path.join(run_dir, 'metrics.db'), args.metrics_interval / 2)
+        metrics.set_metrics_store(metrics_store)
+
+    # Simulated fixes are not using OSM at all
+    api = None
+    if not args.simulate:
+        api = http_client.OsmApi(passwordfile=args.password_file,
+                            changesetauto=not args.dry_run, changesetautosize=changeset_size, changesetautotags=
+                            {u"comment": u"Serbian lint bot. Various fixes around name:sr, name:sr-Latn and "
+                                         u"wikidata/wikipedia links",
+                             u"tag": u"mechanical=yes"})
 
     global_context = {'map-checks': config['_map-checks'],
+                      # Each source is downloaded and read only once, for all map-checks using it
+                      'map-check-groups': group_by_location(config['_map-checks']),
                       'report': not args.no_report,
                       'fix': args.fix,
                       'dry_run': args.dry_run,
+                      'simulate': args.simulate,
                       'api': api,
-                      'report_filename': args.output_file}
+                      'run_dir': run_dir,
+                      'rate_limiter': rate_limiter,
+                      'circuit_breaker': circuit_breaker,
+                      'run_deadline': args.deadline,
+                      'map_deadline': args.map_deadline,
+                      'check_timeout': args.check_timeout,
+                      'host_overrides': host_overrides,
+                      'log_debug_rate': args.log_debug_rate,
+                      'metrics_store': metrics_store,
+                      'metrics_textfile': args.metrics_textfile,
+                      'metrics_port': args.metrics_port,
+                      'metrics_interval': args.metrics_interval,
+                      'report_filename': args.output_file,
+                      'sophox_tile_radius': args.sophox_tile_radius,
+                      'sophox_workers': args.sophox_workers,
+                      'sophox_cache_dir': args.sophox_cache_dir,
+                      'sophox_cache_ttl': args.sophox_cache_ttl * 3600,
+                      'entity_store_dir': args.entity_store_dir,
+                      'download_dir': args.download_dir,
+                      'download_connections': args.download_connections,
+                      'check_chunk_size': args.check_chunk_size,
+                      'checkpoints': checkpoints,
+                      'checkpoint_interval': args.checkpoint_interval,
+                      'results_db': None if args.no_results_db else args.results_db,
+                      'results_keep': args.results_keep,
+                      'result_options': result_options,
+                      'exports': exports,
+                      'daemon': args.daemon,
+                      'run_interval': args.interval,
+                      'wiki_cache_ttl': args.wiki_cache_ttl,
+                      'poll_interval': args.poll,
+                      'api_port': args.api_port,
+                      # Results are kept in memory only if they are needed at the end, not if they are only exported
+                      'keep_results': not args.no_report or not args.no_results_db,
+                      'entity_limit': args.limit,
+                      'sample_percent': args.sample,
+                      'bbox': bbox,
+                      'collect_stats': args.stats_file is not None,
+                      'stats_file': args.stats_file,
+                      'memory_profile': args.memory_profile,
+                      'memory_tracemalloc': args.memory_tracemalloc}
     return global_context
 
 
-def process_map(context, map_check):
+def process_map(context, map_checks):
     """
-    Figures out which source it should use and calls it
+    Figures out which source it should use and calls it.
+    :param map_checks: All map-checks using the same source
+    :return: Tuple of dictionary of all checks done (for each map-check name), stats and memory profile
+    (None if they are not collected), and reason why not all entities are checked (None if they are)
     """
-    logger.info('[%s] Starting processing of map %s', map_check['name'], map_check['name'])
-    context = context.copy()
-    context['map-check'] = map_check
-    source_factory = SourceFactory(process_entity, context)
-    source = source_factory.create_source(map_check)
-    return map_check['name'], source.process_map()
-
-
-def main():
-    global_context = create_global_context()
+    map_name = ', '.join(map_check['name'] for map_check in map_checks)
+    logger.info('[%s] Starting processing of map %s', map_checks[0]['location'], map_name)
+    http_client.set_rate_limiter(context['rate_limiter'])
+    http_client.set_circuit_breaker(context['circuit_breaker'])
+    http_client.set_host_overrides(context['host_overrides'])
+    metrics.set_metrics_store(context['metrics_store'])
+    # Map is stopped at its own deadline (counted from now), or when whole run has to stop, whichever comes first
+    deadlines = [d for d in (context['reading_deadline'], None if context['map_deadline'] is None else
+                             time.time() + context['map_deadline']) if d is not None]
+    deadline = min(deadlines) if len(deadlines) > 0 else None
+    http_client.set_deadline(deadline)
+    context = dict(context, deadline=deadline)
+    memory_profiler = None
+    if context['memory_profile']:
+        memory_profiler = MemoryProfiler(map_name, context['memory_tracemalloc'])
+        context = dict(context, memory_profiler=memory_profiler)
+    source_factory = SourceFactory(process_entities, context)
+    source = source_factory.create_source(map_checks)
+    all_checks = source.process_map()
+    memory_profile = None
+    if memory_profiler is not None:
+        memory_profiler.mark('result')
+        memory_profile = map_name, memory_profiler.to_json()
+    incomplete = source.incomplete
+    if incomplete is None and source.skipped > 0:
+        incomplete = 'checks on {0} entities were skipped'.format(source.skipped)
+    result = all_checks, source.stats, memory_profile, incomplete
+    # Map which is not completely checked is done again with --resume
+    if incomplete is None:
+        deduplicator = context.get('deduplicator')
+        claimed = [] if deduplicator is None else deduplicator.owned(map_checks[0]['location'])
+        context['checkpoints'].save_map(map_checks, result, claimed)
+    return result
+
+
+def worker_context():
+    """
+    :return: Multiprocessing context in which workers are started (queues shared with workers need to be made in it)
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    return multiprocessing.get_context('forkserver')
 
-    all_futures = []
-    thread_count = 1 if global_context['fix'] else multiprocessing.cpu_count()
-    thread_count = min(thread_count, len(global_context['map-checks']))
-    logger.info('Using %d threads to do work', thread_count)
 
+def create_executor(global_context, thread_count, log_queue):
+    """
+    Creates executor in which maps are processed. Process workers are forked from fork server which has all heavy
+    modules already imported, so each worker starts right away, without importing them again.
+    Also, workers forked that way are not inheriting anything opened in main process (like SQLite connections).
+    :param log_queue: Queue where workers are sending their log records to
+    """
     # If we are fixing stuff, we cannot use ProcessPoolExecutor since threads are interacting with user
-    executor_cls = ThreadPoolExecutor if global_context['fix'] else ProcessPoolExecutor
-    with executor_cls(max_workers=thread_count) as executor:
+    if global_context['fix'] and not global_context['simulate']:
+        return ThreadPoolExecutor(max_workers=thread_count)
+
+    mp_context = worker_context()
+    if mp_context.get_start_method() == 'forkserver':
+        preload = {'__main__', 'sources.source_factory', 'osmium', 'osmread'}
         for map_check in global_context['map-checks']:
-            future = executor.submit(process_map, global_context, map_check)
-            all_futures.append(future)
+            preload.update(cls.__module__ for cls in map_check['checks'] + map_check['rules'])
+        mp_context.set_forkserver_preload(sorted(preload))
+    return ProcessPoolExecutor(max_workers=thread_count, mp_context=mp_context, initializer=tools.setup_worker_logger,
+                               initargs=(log_queue, global_context['log_debug_rate']))
+
 
-        all_checks = {}
-        for future in as_completed(all_futures):
-            map_name, checks = future.result()
-            all_checks[map_name] = checks
+def run(global_context, executor):
+    """
+    Does one run: processes all maps, keeps and exports their results and makes report.
+    :param executor: Executor where maps are processed
+    :return: Tuple (reason why not all entities are checked, for each map-check name where they are not; whether
+    processing of any map failed; futures of maps which are still being processed after deadline)
+    """
+    memory_profiler = MemoryProfiler('main', global_context['memory_tracemalloc']) \
+        if global_context['memory_profile'] else None
+    # Deadlines are counted from the start of the run, and each run deduplicates its own checks
+    run_deadline = global_context['run_deadline']
+    fd, deduplication_filename = tempfile.mkstemp(prefix='deduplication-', suffix='.db', dir=global_context['run_dir'])
+    os.close(fd)
+    context = dict(global_context,
+                   deduplicator=EntityDeduplicator(deduplication_filename),
+                   deadline=None if run_deadline is None else time.time() + run_deadline,
+                   reading_deadline=None if run_deadline is None else time.time() + run_deadline * DEADLINE_READING)
+
+    if context['metrics_store'] is not None:
+        # Progress and queues of maps from previous run (in daemon mode) are not reported in this one
+        context['metrics_store'].clear_gauges()
+
+    results_db, run_id = None, None
+    if context['results_db'] is not None:
+        # Run is there from the start, but it is not compared with others until its results are added
+        results_db = ResultsDatabase(context['results_db'])
+        run_id = results_db.start_run(context['result_options'])
+
+    all_futures = {}
+    checkpoints = context['checkpoints']
+    results = []
+    # Locations of maps whose results are collected (only their parts are exported)
+    collected = set()
+    # Reason why not all entities are checked, for each map-check name where they are not
+    incomplete = {}
+    failed = False
+    unfinished = []
+    pending = []
+    for map_checks in context['map-check-groups']:
+        location = map_checks[0]['location']
+        done = checkpoints.load_done(map_checks)
+        if done is not None:
+            logger.info('[%s] Map is already processed, taking its results from checkpoint', location)
+            result, claimed = done
+            results.append(result)
+            collected.add(location)
+        else:
+            pending.append(map_checks)
+            # Map continues from its progress (if it is still on the same version of map, see OSMSource._resume)
+            claimed = checkpoints.load_claimed(map_checks) if context['checkpoint_interval'] else []
+        # Checks whose results are kept in checkpoints are claimed before any map starts, so no map repeats them
+        context['deduplicator'].restore(claimed, location)
+    for map_checks in pending:
+        future = executor.submit(process_map, context, map_checks)
+        all_futures[future] = map_checks
+
+    timeout = None if context['deadline'] is None else max(0, context['deadline'] - time.time())
+    try:
+        for future in as_completed(all_futures, timeout=timeout):
+            try:
+                results.append(future.result())
+                collected.add(all_futures[future][0]['location'])
+            except Exception as e:
+                # Other maps are still reported
+                logger.exception(e)
+                failed = True
+                # None of its results are kept, so other sources can do checks it claimed
+                context['deduplicator'].release_owner(all_futures[future][0]['location'])
+                for map_check in all_futures[future]:
+                    incomplete[map_check['name']] = 'failed: {0}'.format(e)
+    except TimeoutError:
+        logger.error('Deadline passed, report is made without maps which are not done')
+        for future, map_checks in all_futures.items():
+            if not future.done():
+                # Maps which did not start are not started at all, others are not waited for
+                if not future.cancel():
+                    unfinished.append(future)
+                for map_check in map_checks:
+                    incomplete[map_check['name']] = 'not done before deadline'
+    # In fix mode, maps are processed in this process, and its deadline is not needed anymore
+    http_client.set_deadline(None)
+    os.remove(deduplication_filename)
+
+    all_checks = {}
+    stats = Stats() if context['collect_stats'] else None
+    memory_profiles = {}
+    for map_checks, map_stats, memory_profile, map_incomplete in results:
+        all_checks.update(map_checks)
+        if stats is not None:
+            stats.merge(map_stats)
+        if memory_profile is not None:
+            memory_profiles[memory_profile[0]] = memory_profile[1]
+        if map_incomplete is not None:
+            incomplete.update({map_name: map_incomplete for map_name in map_checks})
+
+    if context['api'] is not None and not context['dry_run']:
+        context['api'].flush()
+    if stats is not None:
+        with open(context['stats_file'], 'w', encoding='utf-8') as f:
+            simplejson.dump(stats.to_json(), f, indent=2)
+    if memory_profiler is not None:
+        memory_profiler.mark('maps')
+    changes = None
+    if results_db is not None:
+        results_db.add_results(run_id, all_checks, incomplete)
+        previous = results_db.previous_run(run_id)
+        if previous is not None:
+            changes = dict(results_db.changes(run_id, previous[0]),
+                           previous=datetime.datetime.fromtimestamp(previous[1]))
+            logger.info('Since previous run: %d new errors, %d resolved errors', changes['count_new'],
+                        changes['count_resolved'])
+        results_db.prune(context['results_keep'])
+        results_db.close()
+    # Parts of maps which failed, or are still being written after deadline, are not exported
+    for export_format, filename in context['exports'].items():
+        exporters.combine(export_format, [checkpoints.export_filename(map_checks, export_format)
+                                          for map_checks in context['map-check-groups']
+                                          if map_checks[0]['location'] in collected], filename)
+    if context['report']:
+        generate_report(context, all_checks, stats, incomplete, changes)
+    if memory_profiler is not None:
+        memory_profiler.mark('report')
+        with open(context['memory_profile'], 'w', encoding='utf-8') as f:
+            simplejson.dump({'maps': memory_profiles, 'main': memory_profiler.to_json()}, f, indent=2)
+    if len(incomplete) > 0:
+        logger.warning('Not all entities are checked in %d maps. Maps which are done are kept in %s, run with '
+                       '--resume to continue from there', len(incomplete), checkpoints.directory)
+    else:
+        # Run is done, next run starts from the beginning even with --resume
+        checkpoints.clear()
+    return incomplete, failed, unfinished
+
+
+def serve(global_context, executor):
+    """
+    Daemon mode. Runs again and again, on schedule, or as soon as any map changes, in the same process and with the
+    same workers, so everything they loaded and cached is still there. Results are served over local HTTP API.
+    Runs until interrupted.
+    :param executor: Executor where maps are processed
+    """
+    source_factory = SourceFactory(process_entities, global_context)
+    query_api = daemon.QueryApi(global_context['results_db'], global_context['api_port'])
+    query_api.start()
+    poll_interval = global_context['poll_interval'] or float('inf')
+    first = True
+    next_run = time.time()
+    versions = {}
+    unfinished = []
+    try:
+        while True:
+            if time.time() < next_run:
+                time.sleep(max(0.0, min(poll_interval, next_run - time.time())))
+                if time.time() < next_run:
+                    changed = daemon.changed_maps(
+                        versions, daemon.map_versions(source_factory, global_context['map-check-groups']))
+                    if len(changed) == 0:
+                        continue
+                    logger.info('Maps changed (%s), running again', ', '.join(changed))
+
+            if len(unfinished) > 0:
+                # They are still taking workers, and writing the same checkpoints and exports next run is going to use
+                logger.info('Waiting for %d maps which were not done before deadline of previous run', len(unfinished))
+                wait(unfinished)
+            # Versions are taken before run, so maps which change while it is running are run again
+            versions = daemon.map_versions(source_factory, global_context['map-check-groups'])
+            if not first:
+                # Only the first run continues from checkpoints (with --resume), others are started from scratch
+                global_context['checkpoints'].clear()
+            first = False
+            query_api.status = dict(query_api.status, state='running', started=time.time())
+            incomplete, failed, unfinished = run(global_context, executor)
+            next_run = time.time() + global_context['run_interval']
+            query_api.status = {'state': 'waiting', 'finished': time.time(), 'next_run': next_run,
+                                'incomplete': incomplete, 'failed': failed}
+            logger.info('Run is done, running again at %s, or as soon as any map changes',
+                        datetime.datetime.fromtimestamp(next_run).strftime('%d.%m.%Y. %H:%M'))
+    finally:
+        query_api.stop()
+
+
+def main(log_queue):
+    global_context = create_global_context()
+    tools.limit_debug_rate(global_context['log_debug_rate'])
+    metrics_exporter = None
+    if global_context['metrics_store'] is not None:
+        metrics_exporter = metrics.MetricsExporter(global_context['metrics_store'],
+                                                   global_context['metrics_textfile'], global_context['metrics_port'],
+                                                   global_context['metrics_interval'])
+        metrics_exporter.start()
+
+    thread_count = 1 if global_context['fix'] and not global_context['simulate'] else multiprocessing.cpu_count()
+    thread_count = min(thread_count, len(global_context['map-check-groups']))
+    logger.info('Using %d threads to do work', thread_count)
 
-    if not global_context['dry_run']:
-        global_context['api'].flush()
-    if global_context['report']:
-        generate_report(global_context, all_checks)
+    failed = False
+    executor = create_executor(global_context, thread_count, log_queue)
+    try:
+        if global_context['daemon']:
+            serve(global_context, executor)
+        else:
+            _, failed, _ = run(global_context, executor)
+    finally:
+        # Maps which are not done by now (after deadline, or when interrupted) are not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+            # Metrics are kept in run directory, which is removed now
+            metrics.set_metrics_store(None)
+        shutil.rmtree(global_context['run_dir'], ignore_errors=True)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
+    # Log file is written only from this process, workers are sending their records here
+    log_queue = worker_context().Queue()
+    tools.setup_logger(logging_level=logging.INFO, log_queue=log_queue)
+    try:
+        main(log_queue)
+    finally:
+        tools.stop_logger()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module for memory profiling of workers. When turned on, memory is sampled at the boundary of each stage of map
+processing (download, read, check, result), so it can be seen which map and which stage needs the most memory.
+"""
+
+import contextlib
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+# Number of top allocation sites kept at each stage
+TOP_ALLOCATIONS = 10
+
+
+def _read_status():
+    """
+    :return: Tuple (current RSS, peak RSS) in bytes. Current RSS is None if it cannot be read on this platform.
+    """
+    rss, peak = None, None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    if peak is None and resource is not None:
+        # Linux reports it in kilobytes, macOS in bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return rss, peak
+
+
+def _reset_rss_peak():
+    """
+    Resets peak RSS of this process (only on Linux, elsewhere peak is since the start of the process)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def _reset_peak():
+    """
+    Resets peak RSS of this process, so peak of each map is measured on its own, even though workers are reused
+    """
+    _reset_rss_peak()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+class MemoryProfiler(object):
+    """
+    Samples memory of the current process for one map. Create it when map processing starts and call mark()
+    at the end of each stage. Work of one stage done while other stage is running (e.g. checking chunks of entities
+    while map is still read) is accounted to its own stage with within().
+    """
+    def __init__(self, map_name, use_tracemalloc=False):
+        """
+        :param map_name: Name of the map (or other unit of work) being profiled
+        :param use_tracemalloc: If True, Python allocations are traced too, so top allocation sites are known.
+        It is much slower than just sampling RSS.
+        """
+        self.map_name = map_name
+        self.use_tracemalloc = use_tracemalloc
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _reset_peak()
+        self.start = time.time()
+        self.stages = []
+        # Peak RSS since the start, as peak RSS of the process is reset for each stage
+        self.peak = 0
+        # Peak RSS of the running stage before it was interrupted by other stage (see within())
+        self.interrupted_peak = 0
+        # Peak RSS of stages done (so far) while other stage was running, by stage name
+        self.within_peaks = {}
+
+    def _take_peak(self):
+        """
+        :return: Peak RSS since the last time it was taken. Peak RSS of the process is reset, so next part of work
+        is measured on its own
+        """
+        _, peak = _read_status()
+        _reset_rss_peak()
+        peak = peak or 0
+        self.peak = max(self.peak, peak)
+        return peak
+
+    @contextlib.contextmanager
+    def within(self, stage):
+        """
+        Accounts memory used in the block to a given stage, and not to the stage which is running
+        """
+        self.interrupted_peak = max(self.interrupted_peak, self._take_peak())
+        try:
+            yield
+        finally:
+            self.within_peaks[stage] = max(self.within_peaks.get(stage, 0), self._take_peak())
+
+    def mark(self, stage):
+        """
+        Records memory at the end of a given stage
+        """
+        rss, _ = _read_status()
+        stage_peak = max(self._take_peak(), self.interrupted_peak, self.within_peaks.pop(stage, 0))
+        self.interrupted_peak = 0
+        sample = {'stage': stage, 'elapsed': time.time() - self.start, 'rss': rss, 'peak_rss': self.peak,
+                  'stage_peak_rss': stage_peak}
+        if self.use_tracemalloc:
+            sample['traced'], sample['traced_peak'] = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__)])
+            sample['top_allocations'] = [
+                {'site': '{0}:{1}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+        self.stages.append(sample)
+        logger.debug('[%s] Memory after %s: %s MB (peak of stage %d MB)', self.map_name, stage,
+                     rss // (1024 * 1024) if rss is not None else '?', stage_peak // (1024 * 1024))
+
+    def to_json(self):
+        return {
+            'pid': os.getpid(),
+            'peak_rss': max([s['peak_rss'] or 0 for s in self.stages] or [0]),
+            'traced_peak': max([s.get('traced_peak', 0) for s in self.stages] or [0]),
+            'stages': self.stages
+        }
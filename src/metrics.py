@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module for live metrics of the run (entities processed, bytes downloaded, API requests...), so long runs can be
+watched while they are running. Each worker keeps its metrics in memory and writes them to shared SQLite file
+every few seconds. Main process aggregates them and exports them in Prometheus text format, to a textfile
+(for node_exporter textfile collector) and/or on local HTTP endpoint.
+"""
+
+import http.server
+import os
+import threading
+import time
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+PREFIX = 'serbian_osm_lint_'
+# Description of each metric. Metrics ending with "_total" are counters, all others are gauges.
+HELP = {
+    'entities_processed_total': 'Entities read from source',
+    'entities_per_second': 'Entities read from source per second, since last export',
+    'bytes_downloaded_total': 'Bytes downloaded',
+    'queue_depth': 'Number of items waiting in queue',
+    'progress': 'Progress of a stage of processing a map, from 0 to 1 (only where it is known)',
+    'eta_seconds': 'Estimated time until a stage of processing a map is done',
+    'api_requests_total': 'Requests sent to external service',
+    'api_throttled_total': 'Requests which had to wait for rate limiter',
+    'api_retries_total': 'Requests which were retried',
+    'circuit_opened_total': 'Times external service was considered unavailable after it failed too many times',
+}
+
+_store = None
+
+
+class MetricsStore(object):
+    """
+    Metrics of all workers, shared through SQLite file. Each process keeps its own metrics in memory and writes
+    them to the file at most once per interval, so updating metric is cheap. Counters of all processes are summed,
+    while for gauges the last value written (by any process) is taken, as the same map can be processed by other
+    worker in the next run.
+    """
+    def __init__(self, filename, interval=5):
+        self.filename = filename
+        self.interval = interval
+        self._init_local()
+        connection = tools.connect_shared_db(self.filename)
+        connection.execute('CREATE TABLE IF NOT EXISTS metrics (pid INTEGER, name TEXT, labels TEXT, value REAL, '
+                           'PRIMARY KEY (pid, name, labels)) WITHOUT ROWID')
+        connection.execute('CREATE TABLE IF NOT EXISTS gauges (name TEXT, labels TEXT, value REAL, '
+                           'PRIMARY KEY (name, labels)) WITHOUT ROWID')
+        connection.close()
+
+    def __getstate__(self):
+        # Each process has its own metrics in memory
+        return {'filename': self.filename, 'interval': self.interval}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.interval = state['interval']
+        self._init_local()
+
+    def _init_local(self):
+        self._values = {}
+        # Gauges set since the last flush, so values of other processes set in the meantime are not overwritten
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._local = threading.local()
+
+    def _connection(self):
+        return tools.thread_connection(self._local, self.filename)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _labels_text(labels):
+        return '\x1f'.join('{0}={1}'.format(k, v) for k, v in labels)
+
+    @staticmethod
+    def _parse_labels(labels):
+        return tuple(tuple(label.split('=', 1)) for label in labels.split('\x1f')) if labels != '' else ()
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._maybe_flush()
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes metrics of this process to shared file
+        """
+        with self._lock:
+            self._last_flush = time.time()
+            rows = [(os.getpid(), name, self._labels_text(labels), value)
+                    for (name, labels), value in self._values.items()]
+            gauge_rows = [(name, self._labels_text(labels), value) for (name, labels), value in self._gauges.items()]
+            self._gauges = {}
+        if len(rows) > 0:
+            self._connection().executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)', rows)
+        if len(gauge_rows) > 0:
+            self._connection().executemany('INSERT OR REPLACE INTO gauges VALUES (?, ?, ?)', gauge_rows)
+
+    def clear_gauges(self):
+        """
+        Removes all gauges, so gauges of maps processed in previous run are not reported anymore
+        """
+        with self._lock:
+            self._gauges = {}
+        self._connection().execute('DELETE FROM gauges')
+
+    def read(self):
+        """
+        :return: Dictionary of (name, labels) -> value, where counters are summed over all processes, and gauges
+        have the last value set. Labels is tuple of (key, value).
+        """
+        connection = self._connection()
+        metrics = {}
+        for name, labels, value in connection.execute(
+                'SELECT name, labels, SUM(value) FROM metrics GROUP BY name, labels'):
+            metrics[(name, self._parse_labels(labels))] = value
+        for name, labels, value in connection.execute('SELECT name, labels, value FROM gauges'):
+            metrics[(name, self._parse_labels(labels))] = value
+        return metrics
+
+
+def set_metrics_store(store):
+    """
+    Sets store where metrics of this process are kept. Needs to be called in each worker process.
+    """
+    global _store
+    _store = store
+
+
+def inc(name, value=1, **labels):
+    """
+    Increases counter. Does nothing if metrics are not collected.
+    """
+    if _store is not None:
+        _store.inc(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    """
+    Sets gauge. Does nothing if metrics are not collected.
+    """
+    if _store is not None:
+        _store.set(name, value, **labels)
+
+
+def flush():
+    if _store is not None:
+        _store.flush()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(metrics):
+    """
+    Renders metrics in Prometheus text format
+    :param metrics: Dictionary of (name, labels) -> value
+    """
+    lines = []
+    for name in sorted({name for name, _ in metrics}):
+        lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, HELP.get(name, name)))
+        lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, 'counter' if name.endswith('_total') else 'gauge'))
+        for (metric_name, labels), value in sorted(metrics.items()):
+            if metric_name != name:
+                continue
+            labels_text = ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in labels)
+            lines.append('{0}{1}{{{2}}} {3:g}'.format(PREFIX, name, labels_text, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """
+    Periodically aggregates metrics from all workers, adds derived ones (rates and ETAs) and exports them.
+    Runs in background thread of main process.
+    """
+    def __init__(self, store, textfile=None, port=None, interval=10):
+        """
+        :param store: MetricsStore where workers are writing metrics
+        :param textfile: If given, metrics are written to this file (atomically) on every export
+        :param port: If given, metrics are served on http://localhost:<port>/metrics
+        """
+        self.store = store
+        self.textfile = textfile
+        self.port = port
+        self.interval = interval
+        self.text = ''
+        self.previous = None
+        # First (time, progress) seen for each stage (in this run), to estimate ETA from
+        self.progress_start = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def _derive(self, metrics):
+        now = time.time()
+        if self.previous is not None:
+            previous_time, previous_metrics = self.previous
+            for (name, labels), value in list(metrics.items()):
+                if name == 'entities_processed_total':
+                    rate = (value - previous_metrics.get((name, labels), 0)) / max(now - previous_time, 1e-6)
+                    metrics[('entities_per_second', labels)] = rate
+        self.previous = now, {key: value for key, value in metrics.items() if key[0].endswith('_total')}
+
+        progress_labels = {labels for name, labels in metrics if name == 'progress'}
+        for labels in list(self.progress_start):
+            if labels not in progress_labels:
+                # Stage is not running anymore (gauges are cleared on start of each run)
+                del self.progress_start[labels]
+        for (name, labels), progress in list(metrics.items()):
+            if name != 'progress':
+                continue
+            start_time, start_progress = self.progress_start.setdefault(labels, (now, progress))
+            if progress < start_progress:
+                # Stage started again (e.g. map is processed again in the next run)
+                start_time, start_progress = self.progress_start[labels] = now, progress
+            if progress >= 1:
+                metrics[('eta_seconds', labels)] = 0
+            elif progress > start_progress:
+                metrics[('eta_seconds', labels)] = (now - start_time) * (1 - progress) / (progress - start_progress)
+        return metrics
+
+    def export(self):
+        # Main process has its own metrics too (e.g. from OSM API)
+        self.store.flush()
+        self.text = render(self._derive(self.store.read()))
+        if self.textfile is not None:
+            with open(self.textfile + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.text)
+            os.replace(self.textfile + '.tmp', self.textfile)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:
+                logger.warning('Error exporting metrics: %s', e)
+
+    def start(self):
+        if self.port is not None:
+            exporter = self
+
+            class MetricsHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = exporter.text.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info('Serving metrics on http://127.0.0.1:%d/metrics', self.server.server_address[1])
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops exporting, after exporting final metrics once again
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -2,7 +2,10 @@
 
 import re
 
-p_point = re.compile('Point\((?P<lat>[-0-9.]+)\s(?P<lon>[-0-9.]+)\)')
+from entity_store import StoredEntity
+
+# WKT points (as returned from Sophox) are longitude first
+p_point = re.compile('Point\((?P<lon>[-0-9.]+)\s(?P<lat>[-0-9.]+)\)')
 p_url = re.compile('https://www.openstreetmap.org/(?P<type>.*)/(?P<id>\d+)')
 
 
@@ -31,7 +34,7 @@ class OsmLintEntity(object):
             self.tags = {}
             for tag in entity.tags:
                 self.tags[tag.k] = tag.v
-        self.entity_type = self._get_entity_type(entity)
+        self.entity_type = self.get_entity_type(entity)
 
     def _convert_from_sophox(self, entity):
         url = entity['id']['value']
@@ -42,11 +45,10 @@ class OsmLintEntity(object):
         self.entity_type = m.group('type')
 
         loc = entity['loc']['value']
-        m = p_point.match(loc)
-        if not m:
-            raise Exception('Invalid format for point. Expected Point(lat lon) and got {}', loc)
-        self.lat = float(m.group('lat'))
-        self.lon = float(m.group('lon'))
+        location = self.parse_wkt_point(loc)
+        if location is None:
+            raise Exception('Invalid format for point. Expected Point(lon lat) and got {}', loc)
+        self.lat, self.lon = location
         self.origin = 'sophox'
         self.tags = {}
         for key in entity:
@@ -58,12 +60,73 @@ class OsmLintEntity(object):
                 self.tags[key] = entity[key]['value']
 
     @staticmethod
-    def _get_entity_type(entity):
+    def parse_wkt_point(point):
+        """
+        Helper method to parse location of Sophox result.
+        :param point: Point in WKT format, which is longitude first (e.g. "Point(20.45 44.8)")
+        :return: Tuple (lat, lon), or None if it is not WKT point
+        """
+        m = p_point.match(point)
+        if not m:
+            return None
+        return float(m.group('lat')), float(m.group('lon'))
+
+    @staticmethod
+    def get_tags(entity):
+        """
+        Helper method to get tags of the raw PBF entity as dictionary.
+        :param entity: Entity (PyOsmium or osmread) to get tags from
+        :return: Dictionary of all tags
+        """
+        if isinstance(entity.tags, dict):
+            return entity.tags
+        return {tag.k: tag.v for tag in entity.tags}
+
+    @staticmethod
+    def get_location(entity):
+        """
+        Helper method to get location of the raw PBF entity. Location of way is centroid of its nodes (as Sophox
+        has it), known only if map is read with locations of nodes (with PyOsmium). Relations do not have location.
+        :param entity: Entity (PyOsmium, osmread or from entity store) to get location from
+        :return: Tuple (lat, lon), or None if entity does not have location
+        """
+        try:
+            if isinstance(entity, StoredEntity) and entity.entity_type != 'node':
+                return entity.centroid
+            if isinstance(entity.tags, dict):
+                return entity.lat, entity.lon
+            return entity.location.lat, entity.location.lon
+        except AttributeError:
+            return OsmLintEntity._way_centroid(entity)
+
+    @staticmethod
+    def _way_centroid(way):
+        """
+        :return: Centroid of nodes of PyOsmium way, or None if locations of its nodes are not known
+        """
+        locations = []
+        for node in getattr(way, 'nodes', ()):
+            # Only PyOsmium has locations of nodes of ways (if asked for), osmread has just their ids
+            location = getattr(node, 'location', None)
+            if location is not None and location.valid():
+                locations.append((location.lat, location.lon))
+        if len(locations) > 1 and locations[0] == locations[-1]:
+            # Closed way, first node is not counted twice
+            locations.pop()
+        if len(locations) == 0:
+            return None
+        return (sum(lat for lat, _ in locations) / len(locations),
+                sum(lon for _, lon in locations) / len(locations))
+
+    @staticmethod
+    def get_entity_type(entity):
         """
         Helper method to get type of the entity.
         :param entity: Entity to get type from
         :return: Type of the entity. Can be one of the 'node', 'way', 'relation'
         """
+        if isinstance(entity, StoredEntity):
+            return entity.entity_type
         try:
             import osmread
             if isinstance(entity, osmread.Node):
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding regions - areas (usually countries) to which entities from one big extract are routed.
+Regions are read from Osmosis polygon filter files (.poly), which Geofabrik publishes next to each extract.
+"""
+
+import os
+import re
+
+import http_client
+import tools
+
+logger = tools.get_logger(__name__)
+
+# Number of latitude bands edges are split to. Point is tested only against edges from its own band.
+BANDS = 256
+# Seconds after which slow download of .poly file is sent once again
+HEDGE_AFTER = 5
+
+
+class Region(object):
+    """
+    Region made of one or more polygons, some of which can be holes. Lookup is done by testing bounding box first,
+    and then by ray casting, but only against polygon edges from the latitude band point falls into.
+    """
+    def __init__(self, name, polygons):
+        """
+        :param name: Name of the region
+        :param polygons: List of (is_hole, points) tuples, where points is list of (lat, lon) tuples
+        """
+        self.name = name
+        all_points = [p for _, points in polygons for p in points]
+        if len(all_points) == 0:
+            raise Exception('Region {0} is empty'.format(name))
+        self.min_lat = min(p[0] for p in all_points)
+        self.max_lat = max(p[0] for p in all_points)
+        self.min_lon = min(p[1] for p in all_points)
+        self.max_lon = max(p[1] for p in all_points)
+        self.band_height = (self.max_lat - self.min_lat) / BANDS or 1
+
+        # Every band holds edges (lat1, lon1, lat2, lon2) crossing it. Since holes are also part of the polygon
+        # edges, ray casting gives correct result for them too, so we don't need to keep them separate.
+        self.bands = [[] for _ in range(BANDS)]
+        for _, points in polygons:
+            for i in range(len(points)):
+                lat1, lon1 = points[i - 1]
+                lat2, lon2 = points[i]
+                if lat1 == lat2:
+                    continue
+                for band in range(self._band(min(lat1, lat2)), self._band(max(lat1, lat2)) + 1):
+                    self.bands[band].append((lat1, lon1, lat2, lon2))
+
+    def _band(self, lat):
+        return min(max(int((lat - self.min_lat) / self.band_height), 0), BANDS - 1)
+
+    def contains(self, lat, lon):
+        if lat < self.min_lat or lat > self.max_lat or lon < self.min_lon or lon > self.max_lon:
+            return False
+        inside = False
+        for lat1, lon1, lat2, lon2 in self.bands[self._band(lat)]:
+            if (lat1 > lat) != (lat2 > lat):
+                crossing_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+                if lon < crossing_lon:
+                    inside = not inside
+        return inside
+
+
+def parse_poly(text):
+    """
+    Parses Osmosis polygon filter file format.
+    :param text: Content of .poly file
+    :return: Region
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    lines = [line for line in lines if line != '']
+    name = lines[0]
+    polygons = []
+    current = None
+    for line in lines[1:]:
+        if current is None:
+            if line == 'END':
+                break
+            current = (line.startswith('!'), [])
+        elif line == 'END':
+            polygons.append(current)
+            current = None
+        else:
+            lon, lat = re.split('\s+', line)[:2]
+            current[1].append((float(lat), float(lon)))
+    return Region(name, polygons)
+
+
+def region_location(pbf_url):
+    """
+    Guesses location of .poly file for Geofabrik extract
+    :param pbf_url: URL of Geofabrik extract, like https://download.geofabrik.de/europe/serbia-latest.osm.pbf
+    :return: URL of .poly file for that extract, or None if it cannot be guessed
+    """
+    if not pbf_url.endswith('-latest.osm.pbf'):
+        return None
+    return pbf_url[:-len('-latest.osm.pbf')] + '.poly'
+
+
+def load_region(location):
+    """
+    Loads region from local .poly file or from URL
+    """
+    if os.path.isfile(location):
+        with open(location, 'r', encoding='utf-8') as f:
+            return parse_poly(f.read())
+    logger.info('Downloading region %s', location)
+    r = http_client.request('GET', location, timeout=60, hedge_after=HEDGE_AFTER)
+    if not r.ok:
+        raise Exception(r.reason)
+    return parse_poly(r.text)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of checks and rules, which are referenced by name (e.g. "checks.WikipediaEntryExistsCheck") in config
+and in results. Module of each check is imported only when its first check is needed.
+"""
+
+import functools
+import importlib
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def resolve(name):
+    """
+    :param name: Full name of check or rule class, in format "<module>.<class>"
+    :return: Class with that name
+    """
+    module_name, _, cls_name = name.rpartition('.')
+    if module_name == '':
+        raise ValueError('{0} is not full name of a check, it should be in format "<module>.<class>"'.format(name))
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        raise ValueError('Cannot find module of {0}: {1}'.format(name, e))
+    if not hasattr(module, cls_name):
+        raise ValueError('There is no {0} in module {1}'.format(cls_name, module_name))
+    return getattr(module, cls_name)
+
+
+def name_of(cls):
+    """
+    :return: Full name of check or rule class, in the same format as it is given to resolve()
+    """
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
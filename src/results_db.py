@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding results database - local database where results of every run are kept, so errors can be looked up
+by check, map or entity, and each run can be compared with the previous one (which errors are new, which are
+resolved and which are still there).
+"""
+
+import sqlite3
+import time
+
+import simplejson
+
+import tools
+from engine import Result
+
+logger = tools.get_logger(__name__)
+
+BATCH_SIZE = 10000
+
+# Results which are kept. Passed checks are not, there are far more of them and nobody is looking for them
+KEPT_RESULTS = (Result.CHECKED_ERROR, Result.SKIPPED)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, finished REAL, '
+    'options TEXT)',
+    # One row for each source of each map processed in the run, incomplete is reason why not all entities are checked
+    'CREATE TABLE IF NOT EXISTS run_maps (run INTEGER, map TEXT, source TEXT, incomplete TEXT, '
+    'PRIMARY KEY (run, map, source)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS results (run INTEGER, map TEXT, check_name TEXT, entity_type TEXT, '
+    'entity_id INTEGER, source TEXT, entity_name TEXT, result INTEGER, messages TEXT, fixable INTEGER, '
+    'PRIMARY KEY (run, map, check_name, entity_type, entity_id, source)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS results_by_check ON results (check_name, run)',
+    'CREATE INDEX IF NOT EXISTS results_by_entity ON results (entity_type, entity_id, run)',
+]
+
+# Same error (check on entity in map) in the other run, no matter from which source of the map it came from
+SAME_ERROR = 'SELECT 1 FROM results o WHERE o.run=? AND o.map=r.map AND o.check_name=r.check_name AND ' \
+             'o.entity_type=r.entity_type AND o.entity_id=r.entity_id AND o.result={0}'.format(
+                 Result.CHECKED_ERROR.value)
+# Any result of the same check on the same entity in the other run (error, or check which was skipped)
+SAME_RESULT = 'SELECT 1 FROM results o WHERE o.run=? AND o.map=r.map AND o.check_name=r.check_name AND ' \
+              'o.entity_type=r.entity_type AND o.entity_id=r.entity_id'
+# Distinct errors of a run, if entity is found by more than one source of the map, it is still one error
+ERRORS = 'SELECT DISTINCT map, check_name, entity_type, entity_id FROM results r WHERE r.run=? AND r.result={0}' \
+    .format(Result.CHECKED_ERROR.value)
+
+
+def map_of(map_check_name):
+    """
+    :param map_check_name: Name of map-check, as "<map name> (<source>)"
+    :return: Name of the map, which is the same for all its sources
+    """
+    return map_check_name.split(' (')[0]
+
+
+class ResultsDatabase(object):
+    """
+    Results of all runs, in SQLite file. Only errors and skipped checks are kept, for each map, check and entity.
+    Errors are compared between runs of the same map, regardless of the source which found them (with deduplication,
+    it is not always the same one).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def start_run(self, options):
+        """
+        :param options: Options which change results of the run. Run is compared only with runs with the same options
+        :return: Id of the new run
+        """
+        cursor = self.connection.execute('INSERT INTO runs (started, options) VALUES (?, ?)',
+                                         (time.time(), simplejson.dumps(options, sort_keys=True)))
+        return cursor.lastrowid
+
+    def add_results(self, run, all_checks, incomplete=None):
+        """
+        Adds results of the run.
+        :param run: Id of the run
+        :param all_checks: Dictionary of all checks done (for each map-check name), as collected in main
+        :param incomplete: Reason why not all entities are checked, for each map-check name where they are not
+        (map-checks which failed, and have no results at all, are here too)
+        """
+        incomplete = incomplete or {}
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            for map_check_name in set(all_checks) | set(incomplete):
+                connection.execute('INSERT OR REPLACE INTO run_maps VALUES (?, ?, ?, ?)',
+                                   (run, map_of(map_check_name), map_check_name, incomplete.get(map_check_name)))
+            batch = []
+            for map_check_name, map_check in all_checks.items():
+                map_name = map_of(map_check_name)
+                for (entity_type, entity_id), (entity_name, _, checks) in map_check.items():
+                    for check_name, check in checks.items():
+                        if check['result'] not in KEPT_RESULTS:
+                            continue
+                        batch.append((run, map_name, check_name, entity_type, entity_id, map_check_name, entity_name,
+                                      check['result'].value, simplejson.dumps(check['messages'], ensure_ascii=False),
+                                      check['fixable']))
+                        if len(batch) >= BATCH_SIZE:
+                            connection.executemany('INSERT OR REPLACE INTO results VALUES '
+                                                   '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                            batch = []
+            connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            connection.execute('UPDATE runs SET finished=? WHERE id=?', (time.time(), run))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def previous_run(self, run):
+        """
+        :return: Tuple (id, started) of the last finished run before given one with the same options, None if there
+        is no such run
+        """
+        return self.connection.execute(
+            'SELECT p.id, p.started FROM runs p, runs r WHERE r.id=? AND p.id<r.id AND p.options=r.options '
+            'AND p.finished IS NOT NULL ORDER BY p.id DESC LIMIT 1', (run,)).fetchone()
+
+    def last_run(self):
+        """
+        :return: Id of the last finished run, None if there is no such run
+        """
+        return self.connection.execute('SELECT MAX(id) FROM runs WHERE finished IS NOT NULL').fetchone()[0]
+
+    def errors(self, run=None, map_name=None, check_name=None, entity=None):
+        """
+        Finds errors by any combination of run, map, check and entity.
+        :param run: Id of the run, None for last finished run
+        :param entity: Tuple (entity type, entity id)
+        :return: List of tuples (map, check name, entity type, entity id, entity name, messages)
+        """
+        if run is None:
+            run = self.last_run()
+            if run is None:
+                return []
+        conditions, parameters = ['run=?', 'result=?'], [run, Result.CHECKED_ERROR.value]
+        if map_name is not None:
+            conditions.append('map=?')
+            parameters.append(map_name)
+        if check_name is not None:
+            conditions.append('check_name=?')
+            parameters.append(check_name)
+        if entity is not None:
+            conditions.extend(['entity_type=?', 'entity_id=?'])
+            parameters.extend(entity)
+        rows = self.connection.execute(
+            'SELECT map, check_name, entity_type, entity_id, entity_name, messages FROM results WHERE {0} '
+            'ORDER BY map, check_name, entity_type, entity_id'.format(' AND '.join(conditions)), parameters)
+        return [row[:5] + (simplejson.loads(row[5]),) for row in rows]
+
+    def changes(self, run, previous):
+        """
+        Compares errors of two runs. Only maps processed in both runs are compared. Error is new only if map was
+        completely checked in previous run, and resolved only if map is completely checked in given run, and
+        only if check was not skipped on that entity. Otherwise, it is not known.
+        :param run: Id of the run
+        :param previous: Id of the run it is compared with
+        :return: Dictionary with number of new, resolved and persistent errors (in total, by map and by check),
+        set of new errors (as (map, check name, entity type, entity id) tuples) and list of resolved errors
+        (as tuples (map, check name, entity type, entity id, entity name, messages from previous run))
+        """
+        connection = self.connection
+        # Maps processed in both runs, and whether all their sources are completely checked in each of them
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS compared_maps '
+                           '(map TEXT PRIMARY KEY, complete INTEGER, previous_complete INTEGER)')
+        connection.execute('DELETE FROM compared_maps')
+        connection.execute('INSERT INTO compared_maps SELECT r.map, MIN(r.complete), MIN(p.complete) FROM '
+                           '(SELECT map, MIN(incomplete IS NULL) AS complete FROM run_maps WHERE run=? GROUP BY map) r '
+                           'JOIN (SELECT map, MIN(incomplete IS NULL) AS complete FROM run_maps WHERE run=? '
+                           'GROUP BY map) p ON p.map=r.map GROUP BY r.map', (run, previous))
+
+        new = connection.execute(
+            ERRORS + ' AND r.map IN (SELECT map FROM compared_maps WHERE previous_complete) '
+                     'AND NOT EXISTS (' + SAME_RESULT + ')', (run, previous)).fetchall()
+        persistent = connection.execute(
+            ERRORS + ' AND EXISTS (' + SAME_ERROR + ')', (run, previous)).fetchall()
+        resolved = connection.execute(
+            'SELECT map, check_name, entity_type, entity_id, MAX(entity_name), MAX(messages) FROM results r '
+            'WHERE r.run=? AND r.result=? AND r.map IN (SELECT map FROM compared_maps WHERE complete) '
+            'AND NOT EXISTS (' + SAME_RESULT + ') GROUP BY map, check_name, entity_type, entity_id '
+            'ORDER BY map, check_name, entity_type, entity_id',
+            (previous, Result.CHECKED_ERROR.value, run)).fetchall()
+        resolved = [row[:5] + (simplejson.loads(row[5]),) for row in resolved]
+
+        changes = {'count_new': len(new), 'count_resolved': len(resolved), 'count_persistent': len(persistent),
+                   'maps': {}, 'check_types': {}, 'new': set(new), 'resolved': resolved}
+        for kind, errors in (('new', new), ('resolved', resolved), ('persistent', persistent)):
+            for error in errors:
+                for group, key in (('maps', error[0]), ('check_types', error[1])):
+                    counts = changes[group].setdefault(key, {'new': 0, 'resolved': 0, 'persistent': 0})
+                    counts[kind] = counts[kind] + 1
+        return changes
+
+    def prune(self, keep):
+        """
+        Removes all runs except last ones
+        :param keep: Number of runs to keep
+        """
+        connection = self.connection
+        row = connection.execute('SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?', (keep - 1,)).fetchone()
+        if row is None:
+            return
+        connection.execute('BEGIN')
+        try:
+            for table in ('results', 'run_maps'):
+                connection.execute('DELETE FROM {0} WHERE run<?'.format(table), (row[0],))
+            deleted = connection.execute('DELETE FROM runs WHERE id<?', (row[0],)).rowcount
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if deleted > 0:
+            logger.info('Removed %d old runs from results database %s', deleted, self.filename)
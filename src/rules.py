@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding rules - local equivalents of Sophox queries from "sparql" directory.
+
+Rules are evaluated on every entity of PBF map, in the same pass as regular checks, and every matched entity is
+converted to the same form Sophox returns ("#defaultView:Editor" contract - id, loc and name columns together with
+(tag_N, val_N) suggestions). That way GenericSophoxCheck can check and fix them as if they came from Sophox.
+There is no need for "wikibase:around" service here, PBF map itself is defining the area.
+"""
+
+import re
+
+from osm_lint_entity import OsmLintEntity
+from transliteration import at_least_some_in_cyrillic, cyr2lat, lat2cyr, lat2ascii
+
+# Same as in SPARQL queries - "i" and "v" are missing since they are common in roman numbers
+p_latin = re.compile('a|b|c|č|ć|d|đ|e|f|g|h|j|k|l|m|n|o|p|r|s|š|t|u|z|ž', re.IGNORECASE)
+p_english = re.compile('x|y|w|q', re.IGNORECASE)
+
+
+class AbstractRule(object):
+    """
+    Rule is local equivalent of one Sophox query. Metadata is the same as JSON after "#defaultView:Editor".
+    """
+    comment = ''
+    check_description = ''
+    vote = False
+    # All of these tags needs to exist in entity for rule to be evaluated at all.
+    # Used to skip most of the entities without converting their tags.
+    required_tags = ()
+
+    def evaluate(self, tags):
+        """
+        Evaluates rule on entity tags.
+        :param tags: Dictionary of entity tags
+        :return: None if entity is not matched by this rule. Otherwise, tuple (name, suggestions) where suggestions
+        is list of (tag, value) pairs, in the same order as (tag_N, val_N) columns from Sophox query.
+        """
+        return None
+
+    def metadata(self):
+        return {'comment': self.comment, 'check_description': self.check_description, 'vote': self.vote}
+
+
+class AddingNameRule(AbstractRule):
+    """
+    Local version of sparql/adding_name.sparql
+    """
+    comment = 'Adding name tag from name:sr tag'
+    check_description = 'Entity {0} is missing name tag'
+    required_tags = ('name:sr',)
+
+    def evaluate(self, tags):
+        if 'name' in tags:
+            return None
+        if 'place' not in tags and 'highway' not in tags:
+            return None
+        return tags['name:sr'], [('name', tags['name:sr'])]
+
+
+class ChangingNameSrToCyrillicRule(AbstractRule):
+    """
+    Local version of sparql/changing_namesr_to_cyrillic.sparql
+    """
+    comment = 'Semi-automatic cyrillization of name:sr for highways and places in Serbia and close surrounding'
+    check_description = 'Entity {0} is not having cyrillic name:sr tag'
+    required_tags = ('name:sr',)
+
+    def evaluate(self, tags):
+        if 'place' not in tags and 'highway' not in tags:
+            return None
+        name_sr = tags['name:sr']
+        if not p_latin.search(name_sr):
+            return None
+        return name_sr, [('name:sr', lat2cyr(name_sr))]
+
+
+class AddingNameSrRule(AbstractRule):
+    """
+    Local version of sparql/adding_namesr_*.sparql (all regions at once)
+    """
+    comment = 'Semi-automatic addition of name:sr tag to highways in Serbia'
+    check_description = 'Entity {0} is missing name:sr tag'
+    required_tags = ('name', 'highway')
+
+    def evaluate(self, tags):
+        name = tags['name']
+        if not p_latin.search(name) or p_english.search(name):
+            return None
+        return name, [('name:sr', lat2cyr(name))]
+
+
+class CheckingNameSrLatnRule(AbstractRule):
+    """
+    Local version of sparql/checking_namesr-latn_*.sparql (all regions at once)
+    """
+    comment = 'Semi-automatic addition/checks of name:sr-Latn tag to entities in Serbia'
+    check_description = 'Entity {0} is missing name:sr-Latn tag or having name:sr-Latn tag that is not consistent ' \
+                        'with name:sr tag'
+    required_tags = ('name', 'name:sr')
+
+    def evaluate(self, tags):
+        correct_latin_name = cyr2lat(tags['name:sr'])
+        if 'name:sr-Latn' in tags:
+            if tags['name:sr-Latn'] == correct_latin_name:
+                return None
+        elif not at_least_some_in_cyrillic(tags['name']):
+            return None
+        return tags['name'], [('name:sr-Latn', correct_latin_name)]
+
+
+class AddingIntNameRule(AbstractRule):
+    """
+    Local version of sparql/adding_int_name.sparql
+    """
+    comment = 'Workaround for Nominatim GitHub issue #862, adding int_name'
+    check_description = 'Entity {0} could be better searchable with int_name'
+    required_tags = ('name:sr-Latn',)
+
+    def evaluate(self, tags):
+        if 'int_name' in tags:
+            return None
+        name_sr_latn = tags['name:sr-Latn']
+        if 'đ' not in name_sr_latn.lower():
+            return None
+        return name_sr_latn, [('int_name', lat2ascii(name_sr_latn))]
+
+
+def evaluate_rules(rules, raw_entity):
+    """
+    Evaluates all rules on one raw PBF entity.
+    :param rules: List of rule instances
+    :param raw_entity: Entity (PyOsmium or osmread) on which to evaluate rules
+    :return: List of Sophox-like results, one for each matched rule. Entities without location (e.g. ways read without
+    locations of their nodes) cannot be put on the map, so their results are without location (see to_sophox_result)
+    """
+    applicable_rules = [rule for rule in rules if all(t in raw_entity.tags for t in rule.required_tags)]
+    if len(applicable_rules) == 0:
+        return []
+
+    tags = OsmLintEntity.get_tags(raw_entity)
+    results = []
+    for rule in applicable_rules:
+        matched = rule.evaluate(tags)
+        if matched is None:
+            continue
+        if len(results) == 0:
+            entity_type = OsmLintEntity.get_entity_type(raw_entity)
+            location = OsmLintEntity.get_location(raw_entity)
+        name, suggestions = matched
+        results.append(to_sophox_result(entity_type, raw_entity.id, location, name, suggestions, rule.metadata()))
+    return results
+
+
+def to_sophox_result(entity_type, entity_id, location, name, suggestions, metadata):
+    """
+    Creates result in the same form as one binding returned from Sophox, so it can be used as raw entity.
+    If location is None, result has no 'loc' column, and it cannot be used as raw entity.
+    """
+    result = {
+        'id': {'type': 'uri', 'value': 'https://www.openstreetmap.org/{0}/{1}'.format(entity_type, entity_id)},
+        'name': {'type': 'literal', 'value': name},
+        'metadata': metadata
+    }
+    if location is not None:
+        # Sophox returns points in WKT format, which is longitude first
+        result['loc'] = {'type': 'literal', 'value': 'Point({0} {1})'.format(location[1], location[0])}
+    for i, (tag, val) in enumerate(suggestions, start=1):
+        result['tag_{0}'.format(i)] = {'type': 'literal', 'value': tag}
+        result['val_{0}'.format(i)] = {'type': 'literal', 'value': val}
+    return result
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Development modes of sources - taking only part of the entities map has, so new check can be tried on a small, but
+representative subset of the map in seconds. Entities are taken or skipped before they are wrapped to OsmLintEntity,
+so skipped entities cost almost nothing.
+"""
+
+from osm_lint_entity import OsmLintEntity
+
+# Fibonacci hashing - multiplying by 2^64 / golden ratio scatters consecutive ids evenly over 64 bits
+HASH_MULTIPLIER = 11400714819323198485
+HASH_MASK = (1 << 64) - 1
+
+
+def get_id(raw_entity):
+    """
+    :param raw_entity: Raw entity (PyOsmium, osmread, entity store or Sophox result)
+    :return: OSM id of the entity
+    """
+    if isinstance(raw_entity, dict):
+        return int(raw_entity['id']['value'].rsplit('/', 1)[-1])
+    return raw_entity.id
+
+
+def get_location(raw_entity):
+    """
+    :param raw_entity: Raw entity (PyOsmium, osmread, entity store or Sophox result)
+    :return: Tuple (lat, lon), or None if entity does not have location
+    """
+    if isinstance(raw_entity, dict):
+        return OsmLintEntity.parse_wkt_point(raw_entity.get('loc', {}).get('value', ''))
+    return OsmLintEntity.get_location(raw_entity)
+
+
+def in_sample(entity_id, percent):
+    """
+    Decides whether entity is in sample. Decision depends only on the id, so the same entities are taken in every run,
+    from every source, and smaller sample is always part of the bigger one.
+    """
+    return ((entity_id * HASH_MULTIPLIER) & HASH_MASK) < percent / 100.0 * (1 << 64)
+
+
+class EntitySampler(object):
+    """
+    Decides which entities source takes, and when it should stop reading.
+    """
+    def __init__(self, limit=None, sample_percent=None, bbox=None):
+        """
+        :param limit: Source stops after this many entities are taken. None means no limit
+        :param sample_percent: Percent of entities taken, chosen by hash of their id. None means all of them
+        :param bbox: Only entities inside this (min_lat, min_lon, max_lat, max_lon) box are taken. Entities without
+        location (see OsmLintEntity.get_location) are never inside. None means no bounding box
+        """
+        self.limit = limit
+        self.sample_percent = sample_percent
+        self.bbox = bbox
+        self.taken = 0
+
+    @staticmethod
+    def from_context(context):
+        """
+        :return: Sampler for development modes given in context, or None if none is given
+        """
+        limit, sample_percent, bbox = context.get('entity_limit'), context.get('sample_percent'), context.get('bbox')
+        if limit is None and sample_percent is None and bbox is None:
+            return None
+        return EntitySampler(limit, sample_percent, bbox)
+
+    def describe(self):
+        parts = []
+        if self.sample_percent is not None:
+            parts.append('{0:g}% of entities'.format(self.sample_percent))
+        if self.bbox is not None:
+            parts.append('entities inside {0}'.format(','.join('{0:g}'.format(b) for b in self.bbox)))
+        if self.limit is not None:
+            parts.append('at most {0} entities'.format(self.limit))
+        return ', '.join(parts)
+
+    def is_done(self):
+        return self.limit is not None and self.taken >= self.limit
+
+    def accept(self, raw_entity):
+        """
+        :return: True if entity should be processed, False if it should be skipped
+        """
+        if self.is_done():
+            return False
+        if self.sample_percent is not None and not in_sample(get_id(raw_entity), self.sample_percent):
+            return False
+        if self.bbox is not None:
+            location = get_location(raw_entity)
+            if location is None:
+                return False
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if not (min_lat <= location[0] <= max_lat and min_lon <= location[1] <= max_lon):
+                return False
+        self.taken += 1
+        return True
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding fake of OSM API, used to simulate fixes. Fixes are done on data of the entity which is already read
+from the map, so nothing is read from (nor sent to) OSM, and fixes can be simulated in all workers, in parallel.
+"""
+
+import copy
+
+from exceptions import SimulationException
+
+
+# Old value of tag which is not known locally
+UNKNOWN = '(unknown)'
+
+
+class SimulatedApi(object):
+    """
+    Stands for osmapi.OsmApi while one entity is being fixed. Only that entity can be read, as it is read
+    from the map, and updates of it are only recorded. Anything else raises SimulationException.
+    Results of Sophox queries are holding columns of the query, not tags of the entity, so they cannot be read
+    at all. Only changes query is suggesting can be recorded for them (see suggest()).
+    """
+    def __init__(self, entity):
+        """
+        :param entity: OsmLintEntity which is going to be fixed
+        """
+        self.entity = entity
+        # Last update of the entity, None if it is not updated
+        self.updated = None
+        # Changes suggested by Sophox query, None if nothing is suggested
+        self.suggested = None
+
+    def _get(self, entity_type, entity_id):
+        if entity_type != self.entity.entity_type or entity_id != self.entity.id:
+            raise SimulationException('{0} {1} is not available locally'.format(entity_type, entity_id))
+        if self.entity.origin == 'sophox':
+            raise SimulationException('tags of {0} {1} are not known, only columns of Sophox query'.format(
+                entity_type, entity_id))
+        return {'id': self.entity.id, 'visible': True, 'tag': dict(self.entity.tags)}
+
+    def _update(self, entity_type, data):
+        if entity_type != self.entity.entity_type or data['id'] != self.entity.id:
+            raise SimulationException('{0} {1} is not available locally'.format(entity_type, data['id']))
+        self.updated = copy.deepcopy(data)
+        return data
+
+    def NodeGet(self, node_id):
+        return self._get('node', node_id)
+
+    def WayGet(self, way_id):
+        return self._get('way', way_id)
+
+    def RelationGet(self, relation_id):
+        return self._get('relation', relation_id)
+
+    def NodeUpdate(self, data):
+        return self._update('node', data)
+
+    def WayUpdate(self, data):
+        return self._update('way', data)
+
+    def RelationUpdate(self, data):
+        return self._update('relation', data)
+
+    def suggest(self, suggestions):
+        """
+        Records changes suggested by Sophox query, instead of reading and updating entity.
+        :param suggestions: List of (tag, value) tuples, where value is None if tag is to be deleted
+        """
+        self.suggested = [(tag, UNKNOWN, value) for tag, value in suggestions]
+
+    def changes(self):
+        """
+        :return: List of (tag, old value, new value) tuples, sorted by tag, which fix would change. Value is None
+        where tag does not exist, and old value is UNKNOWN where it is not known locally.
+        """
+        if self.suggested is not None:
+            return sorted(self.suggested, key=lambda change: change[0])
+        if self.updated is None:
+            return []
+        old_tags, new_tags = self.entity.tags, self.updated['tag']
+        return [(k, old_tags.get(k), new_tags.get(k)) for k in sorted(set(old_tags) | set(new_tags))
+                if old_tags.get(k) != new_tags.get(k)]
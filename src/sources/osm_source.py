@@ -1,43 +1,294 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import time
+
+import metrics
 import tools
+from engine import Result, merge_checks
+from exceptions import ServiceUnavailableException
+from exporters import Export
+from stats import Stats
 from osm_lint_entity import OsmLintEntity
+from sampling import EntitySampler
 
 logger = tools.get_logger(__name__)
 
+# How often (in entities) live metrics are updated
+METRICS_EVERY = 1000
+
 
 class OSMSource(object):
     """
-    Abstract OSM source that can retrieve OSM entities
+    Abstract OSM source that can retrieve OSM entities.
+    Source is read only once, even if more check suites are using it - every entity found is checked
+    with checks from all map-checks given.
+    Entities are not checked one by one, but in chunks, so checks can process whole chunk at once.
     """
-    def __init__(self, context, map_name, process_entity_callback):
+    def __init__(self, context, map_checks, process_entities_callback):
         self.context = context
-        self.map_name = map_name
-        self.process_entity_callback = process_entity_callback
+        self.map_checks = map_checks
+        self.map_name = ', '.join(map_check['name'] for map_check in map_checks)
+        self.process_entities_callback = process_entities_callback
+        self.chunk_size = context.get('check_chunk_size', 1000)
         self.processed = 0
-        self.all_checks = {}
+        self.filtered = 0
+        self.checked = 0
+        # Number of processed entities already counted in live metrics
+        self.processed_reported = 0
+        # Number of entities source is going to find, if it is known in advance
+        self.expected = None
+        # In development modes (--limit, --sample, --bbox), only some of the entities are taken
+        self.sampler = EntitySampler.from_context(context)
+        self.checkpoints = context.get('checkpoints')
+        # Run-wide deduplicator, whose keys claimed by this map are kept with progress
+        self.deduplicator = context.get('deduplicator')
+        self.checkpoint_interval = context.get('checkpoint_interval', 0)
+        self.last_checkpoint = time.time()
+        # Version of the map progress is saved for, None if progress is not saved for this source
+        self.map_version = None
+        # Number of entities checked in previous run, which are skipped now
+        self.skip = 0
+        # Time (as time.time()) when source stops reading and checks what it found so far, None if there is no deadline
+        self.deadline = context.get('deadline')
+        # Why not all entities of the map are checked, None if they are
+        self.incomplete = None
+        # Number of entities on which some check was skipped (because service it needs was unavailable)
+        self.skipped = 0
+        # Each source collects its own stats (if asked for), they are merged at the end
+        self.stats = Stats() if context.get('collect_stats') else None
+        # Each map-check is getting its own context
+        self.contexts = []
+        for map_check in map_checks:
+            map_check_context = context.copy()
+            map_check_context['map-check'] = map_check
+            map_check_context['stats'] = self.stats
+            self.contexts.append(map_check_context)
+        self.all_checks = {map_check['name']: {} for map_check in map_checks}
+        # Results are not kept in memory if nobody needs them at the end (e.g. they are only exported)
+        self.keep_results = context.get('keep_results', True)
+        # Results are exported while they are checked, to part files kept with checkpoints
+        self.export = None
+        if len(context.get('exports', {})) > 0:
+            self.export = Export({export_format: self.checkpoints.export_filename(map_checks, export_format)
+                                  for export_format in context['exports']})
+        # Entities waiting to be checked, for each map-check name
+        self.pending = {map_check['name']: [] for map_check in map_checks}
 
     def process_map(self):
-        self._process_map()
+        """
+        :return: Dictionary of all checks done, for each map-check name
+        """
+        if self.sampler is not None:
+            logger.info('[%s] Taking only %s', self.map_name, self.sampler.describe())
+        try:
+            self._process_map()
+        except ServiceUnavailableException as e:
+            # Whatever is found so far is still checked and reported
+            self._mark_incomplete(e.message)
+        self._mark_memory('read')
+        for context in self.contexts:
+            self._check_pending(context)
+        if self.export is not None:
+            self.export.close()
+        self._mark_memory('check')
+        self._update_metrics()
+        metrics.flush()
+        if self.stats is not None:
+            self.stats.count(self.map_name, 'entities_decoded', self.processed)
+            self.stats.count(self.map_name, 'entities_filtered', self.filtered)
+            self.stats.count(self.map_name, 'entities_checked', self.checked)
         return self.all_checks
 
     def _process_map(self):
         raise NotImplemented()
 
+    def version(self):
+        """
+        :return: Version of the map, found without reading it (so it is known when map changes), or None if it cannot
+        be known
+        """
+        return None
+
+    def _resume(self, version):
+        """
+        Called by sources which always find entities in the same order, before they start reading map. From now on,
+        progress is saved from time to time, and if there is progress saved on the same version of map (from run which
+        died), entities which are already checked are skipped.
+        :param version: Version of the map (e.g. its checksum)
+        """
+        if self.checkpoints is None or not self.checkpoint_interval:
+            return
+        self.map_version = version
+        progress = self.checkpoints.load_progress(self.map_checks, version)
+        if progress is None:
+            if self.deduplicator is not None:
+                # Map changed since progress was saved, so checks claimed with it are done again from the start
+                self.deduplicator.release_owner(self.map_checks[0]['location'])
+            return
+        self.skip = progress['processed']
+        self.filtered, self.checked = progress['filtered'], progress['checked']
+        self.all_checks = progress['all_checks']
+        if self.stats is not None and progress['stats'] is not None:
+            self.stats.merge(progress['stats'])
+        if self.sampler is not None:
+            self.sampler.taken = progress['taken']
+        if self.export is not None:
+            self.export.resume(progress['export'])
+        logger.info('[%s] Resuming from checkpoint, first %d entities are already checked', self.map_name, self.skip)
+
+    def _save_progress(self):
+        """
+        Checks all pending entities and saves progress, so everything found so far does not need to be checked again
+        """
+        for context in self.contexts:
+            self._check_pending(context)
+        self.checkpoints.save_progress(self.map_checks, self.map_version, {
+            'processed': self.processed,
+            'filtered': self.filtered,
+            'checked': self.checked,
+            'all_checks': self.all_checks,
+            'stats': self.stats,
+            'taken': self.sampler.taken if self.sampler is not None else 0,
+            'export': self.export.tell() if self.export is not None else None,
+            'claimed': self.deduplicator.owned(self.map_checks[0]['location']) if self.deduplicator is not None else []
+        })
+        self.last_checkpoint = time.time()
+        logger.info('[%s] Saved progress after %d entities', self.map_name, self.processed)
+
+    def _should_stop(self):
+        """
+        :return: True if source should stop reading, because it took as many entities as it was asked for
+        (with --limit), or because deadline of the map passed
+        """
+        if self.sampler is not None and self.sampler.is_done():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._mark_incomplete('deadline passed after {0} entities'.format(self.processed))
+            return True
+        return False
+
+    def _mark_incomplete(self, reason):
+        if self.incomplete is None:
+            logger.warning('[%s] Not all entities are checked: %s', self.map_name, reason)
+            self.incomplete = reason
+
+    def _mark_memory(self, stage):
+        """
+        Marks end of processing stage for memory profiler, if memory is profiled
+        """
+        memory_profiler = self.context.get('memory_profiler')
+        if memory_profiler is not None:
+            memory_profiler.mark(stage)
+
+    def _memory_stage(self, stage):
+        """
+        :return: Context manager accounting memory used in it to given stage, if memory is profiled
+        """
+        memory_profiler = self.context.get('memory_profiler')
+        if memory_profiler is None:
+            # Suppressing no exceptions, it is just empty context manager
+            return contextlib.suppress()
+        return memory_profiler.within(stage)
+
+    def _update_metrics(self):
+        metrics.inc('entities_processed_total', self.processed - self.processed_reported, map=self.map_name)
+        self.processed_reported = self.processed
+        metrics.gauge('queue_depth', sum(len(pending) for pending in self.pending.values()),
+                      map=self.map_name, queue='check')
+        if self.expected:
+            metrics.gauge('progress', min(1.0, self.processed / self.expected), map=self.map_name, stage='read')
+
     def _entity_found(self, raw_entity):
+        # Progress is saved only between entities, when everything found so far is handled
+        if self.map_version is not None and self.processed % METRICS_EVERY == 0 and self.processed > self.skip and \
+                time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self._save_progress()
         self.processed += 1
+        if self.processed % METRICS_EVERY == 0:
+            self._update_metrics()
         if self.processed % 100000 == 0:
             logger.info('[%s] Processed %d entities', self.map_name, self.processed)
+        if self.processed <= self.skip:
+            return
+        if self.sampler is not None and not self.sampler.accept(raw_entity):
+            self.filtered += 1
+            return
+        self._process_entity(raw_entity)
+
+    @staticmethod
+    def _wrap(raw_entity):
+        """
+        :return: OsmLintEntity made from raw entity taken from the map, or None if it cannot be processed
+        """
         try:
-            entity = OsmLintEntity(raw_entity)
+            return OsmLintEntity(raw_entity)
         except AttributeError as e:
+            logger.debug('Skipping entity: %s', e)
+            return None
+
+    def _process_entity(self, raw_entity):
+        """
+        Checks entity taken from the map, in all map-checks it belongs to
+        """
+        self._process_wrapped(self._wrap(raw_entity))
+
+    def _process_wrapped(self, entity):
+        """
+        Checks entity (already made from raw entity with _wrap), in all map-checks it belongs to
+        """
+        if entity is None:
             # We cannot process this entity, skip it
-            logger.info(e)
+            self.filtered += 1
             return
 
-        checks_done = self.process_entity_callback(entity, self.context)
-        if len(checks_done) > 0:
+        for context in self.contexts:
+            # When reading one big extract, entity is checked only for map-checks whose region it belongs to
+            region = context['map-check'].get('region')
+            if region is not None and not region.contains(entity.lat, entity.lon):
+                self.filtered += 1
+                continue
+            self._check_entity(entity, context)
+
+    def _check_entity(self, entity, context):
+        pending = self.pending[context['map-check']['name']]
+        pending.append(entity)
+        if len(pending) >= self.chunk_size:
+            self._check_pending(context)
+
+    def _check_pending(self, context):
+        """
+        Checks all entities waiting to be checked in a given context
+        """
+        map_check_name = context['map-check']['name']
+        entities = self.pending[map_check_name]
+        if len(entities) == 0:
+            return
+        self.pending[map_check_name] = []
+        self.checked += len(entities)
+
+        with self._memory_stage('check'):
+            entities_checks = self.process_entities_callback(entities, context)
+        all_checks = self.all_checks[map_check_name]
+        for entity, checks_done in zip(entities, entities_checks):
+            if len(checks_done) == 0:
+                continue
+            if any(check['result'] == Result.SKIPPED for check in checks_done.values()):
+                self.skipped += 1
+            if self.export is not None:
+                self.export.write(map_check_name, entity, checks_done)
+            if not self.keep_results:
+                continue
+
+            # Ids are unique only within entity type
+            key = (entity.entity_type, entity.id)
+            if key in all_checks:
+                # Same entity can be found more than once (e.g. both as entity and as result of local rule),
+                # merge checks
+                merge_checks(all_checks[key][2], checks_done)
+                continue
+
             name = entity.tags['name'] if 'name' in entity.tags else str(entity.id)
             if 'name:sr' in entity.tags:
                 name = '{0} / {1}'.format(name, entity.tags['name:sr'])
-            self.all_checks[entity.id] = (name, entity.entity_type, checks_done)
+            all_checks[key] = (name, entity.entity_type, checks_done)
@@ -2,54 +2,166 @@
 
 from sources.osm_source import OSMSource
 import tools
+import hashlib
 import os
 import requests
 import tempfile
+import http_client
+import registry
+from download import Downloader
+from entity_store import EntityStoreWriter, count_entities, read_entities, store_filename
 from osm_lint_entity import OsmLintEntity
+from rules import evaluate_rules
 
 logger = tools.get_logger(__name__)
 
+# Seconds after which slow download of checksum is sent once again
+HEDGE_AFTER = 5
+
 
 class PBFSource(OSMSource):
     """
     Source reading from .pbf file
     """
-    def __init__(self, context, process_entity_callback, map_name, pbf_url):
-        super(PBFSource, self).__init__(context, map_name, process_entity_callback)
+    def __init__(self, context, process_entities_callback, map_checks, pbf_url):
+        super(PBFSource, self).__init__(context, map_checks, process_entities_callback)
         self.pbf_url = pbf_url
+        # Rules of each map-check, together with context in which their results are checked
+        self.rules = []
+        for map_check_context in self.contexts:
+            rules = [rule_cls() for rule_cls in map_check_context['map-check'].get('rules', [])]
+            if len(rules) > 0:
+                self.rules.append((map_check_context, rules))
+        # All applicabilities from all checks, used to decide which entities to keep in entity store
+        self.applicabilities = {a for map_check in map_checks for check_cls in map_check['checks']
+                                for a in check_cls.applicable_on}
+        self.store_writer = None
+        # Checksum of the map, if it is known
+        self.checksum = None
+        # Number of rule results not checked, because their entities have no location
+        self.unlocated = 0
+
+    def process_map(self):
+        all_checks = super(PBFSource, self).process_map()
+        if self.unlocated > 0:
+            logger.warning('[%s] %d results of rules are not checked, as their ways or relations have no location '
+                           '(install PyOsmium to read ways with locations of their nodes)',
+                           self.map_name, self.unlocated)
+            if self.stats is not None:
+                self.stats.count(self.map_name, 'rule_results_unlocated', self.unlocated)
+        return all_checks
 
-    def _download_map(self):
+    def _process_entity(self, raw_entity):
+        # Entity is made once, both for deciding if it is stored and for checking it
+        entity = self._wrap(raw_entity)
+        if self.store_writer is not None and self._should_store(raw_entity, entity):
+            self.store_writer.add(OsmLintEntity.get_entity_type(raw_entity), raw_entity.id,
+                                  getattr(raw_entity, 'version', None), OsmLintEntity.get_location(raw_entity),
+                                  OsmLintEntity.get_tags(raw_entity))
+        self._process_wrapped(entity)
+        for map_check_context, rules in self.rules:
+            region = map_check_context['map-check'].get('region')
+            for result in evaluate_rules(rules, raw_entity):
+                if 'loc' not in result:
+                    # Relations, and ways read with osmread (without locations of their nodes), cannot be put on the map
+                    self.unlocated += 1
+                    continue
+                result_entity = OsmLintEntity(result)
+                if region is not None and not region.contains(result_entity.lat, result_entity.lon):
+                    continue
+                self._check_entity(result_entity, map_check_context)
+
+    def _should_store(self, raw_entity, entity):
         """
-        Downloads map from internet. It is up to the caller to remove this temporary file.
-        :param map_name: Name of the map to download
-        :param map_uri: URI of the map to download
-        :return: Temprorary filename where map is downloaded
+        Entity is kept in entity store if any check is applicable on it, or if any rule could match it
+        :param raw_entity: Entity as read from the map
+        :param entity: OsmLintEntity made from raw entity, None if it could not be made
         """
-        logger.info('[%s] Downloading %s', self.map_name, self.pbf_url)
-        r = requests.get(self.pbf_url, stream=True)
-        if not r.ok:
-            raise Exception(r.reason)
-        f = tempfile.NamedTemporaryFile(suffix='.pbf', prefix=self.map_name + '_', delete=False)
+        for _, rules in self.rules:
+            for rule in rules:
+                if all(t in raw_entity.tags for t in rule.required_tags):
+                    return True
+        if entity is None:
+            return False
+        return any(a.is_entity_applicable(entity) for a in self.applicabilities)
+
+    def _store_signature(self):
+        """
+        Entity store depends on applicabilities and rules used, so it needs to be rebuilt if they change
+        """
+        applicabilities = sorted(registry.name_of(a) for a in self.applicabilities)
+        rules = sorted({registry.name_of(type(rule)) for _, rules in self.rules for rule in rules})
+        return '{0};{1}'.format(','.join(applicabilities), ','.join(rules))
+
+    def _extract_checksum(self):
+        """
+        Geofabrik publishes MD5 of each extract next to it, so we can know extract version without downloading it.
+        :return: Checksum of the extract, or None if it is not known before extract is downloaded
+        """
+        if os.path.isfile(self.pbf_url):
+            return tools.file_md5(self.pbf_url)
         try:
-            chunk_number = 0
-            for chunk in r.iter_content(chunk_size=1024):
-                f.write(chunk)
-                chunk_number = chunk_number + 1
-                if chunk_number % (10 * 1024) == 0:
-                    logger.info('[%s] Downloaded %d MB', self.map_name, chunk_number / 1024)
-            f.close()
-            logger.info('[%s] Map %s downloaded, parsing it now', self.map_name, self.map_name)
-            return f.name
-        except Exception as e:
-            logger.exception(e)
-            os.remove(f.name)
-            raise
+            r = http_client.request('GET', self.pbf_url + '.md5', timeout=30, hedge_after=HEDGE_AFTER)
+        except requests.RequestException:
+            return None
+        if not r.ok or r.text.strip() == '':
+            return None
+        return r.text.split()[0]
+
+    def version(self):
+        if os.path.isfile(self.pbf_url):
+            # Local map can be big, it is not read whole just to see if it changed
+            stat = os.stat(self.pbf_url)
+            return '{0}:{1}'.format(stat.st_size, stat.st_mtime)
+        return self._extract_checksum()
+
+    def _process_store_if_exists(self, checksum):
+        filename = store_filename(self.context['entity_store_dir'], checksum, self._store_signature())
+        if not os.path.isfile(filename):
+            return False
+        logger.info('[%s] Found entity store %s, using it instead of map', self.map_name, filename)
+        self.process_map_with_store(filename)
+        return True
+
+    def _download_map(self, checksum):
+        """
+        Downloads map from internet, or continues previous download of it, if it was interrupted.
+        It is up to the caller to remove this file.
+        :param checksum: MD5 checksum to verify downloaded map against. If None, map is not verified
+        :return: Filename where map is downloaded
+        """
+        download_dir = self.context.get('download_dir') or os.path.join(tempfile.gettempdir(), 'serbian-osm-lint')
+        os.makedirs(download_dir, exist_ok=True)
+        # Filename needs to be always the same for the same URL, so we can resume download
+        filename = os.path.join(download_dir, '{0}-{1}'.format(
+            hashlib.sha1(self.pbf_url.encode('utf-8')).hexdigest()[:8], os.path.basename(self.pbf_url)))
+
+        logger.info('[%s] Downloading %s', self.map_name, self.pbf_url)
+        downloader = Downloader(self.pbf_url, filename, connections=self.context.get('download_connections', 4),
+                                log_prefix=self.map_name)
+        downloader.download(expected_md5=checksum)
+        if self.stats is not None:
+            self.stats.count(self.map_name, 'bytes_downloaded', downloader.received)
+        self._mark_memory('download')
+        logger.info('[%s] Map %s downloaded, parsing it now', self.map_name, self.map_name)
+        return filename
 
     def _process_map(self):
         """
         Process PBF file. It will download map and use either PyOsmium/osmread to read map.
         It also cleans all downloaded maps.
+        If entity store is used, it will read entities from store instead (if store for this version of map exists),
+        or it will build store while reading map.
         """
+        use_store = self.context.get('entity_store_dir') is not None
+        # Map can also be local file (e.g. big extract downloaded in advance), we don't download nor remove it
+        local_map = os.path.isfile(self.pbf_url)
+        # For remote maps, checksum is also used to verify download
+        checksum = self._extract_checksum() if use_store or not local_map else None
+        self.checksum = checksum
+        if use_store and checksum is not None and self._process_store_if_exists(checksum):
+            return
+
         found_osmium, found_osmread = False, False
         try:
             import osmium
@@ -70,19 +182,65 @@ class PBFSource(OSMSource):
             logger.error('[%s] Didn\'t found any library for reading maps, quitting', self.map_name)
             return
 
-        filename = self._download_map()
+        filename = self.pbf_url if local_map else self._download_map(checksum)
         try:
+            if use_store:
+                if checksum is None:
+                    checksum = self.checksum = tools.file_md5(filename)
+                    if self._process_store_if_exists(checksum):
+                        return
+                # Store built from only part of the map would later be taken as the whole map, so it is not built
+                if self.sampler is None:
+                    self.store_writer = EntityStoreWriter(
+                        store_filename(self.context['entity_store_dir'], checksum, self._store_signature()),
+                        checksum, self._store_signature())
+
             if found_osmium:
-                return self.map_name, self.process_map_with_osmium(filename)
+                self.process_map_with_osmium(filename)
             elif found_osmread:
-                return self.map_name, self.process_map_with_osmread(filename)
+                self.process_map_with_osmread(filename)
             else:
                 logger.error('[%s] Didn\'t found any library for reading maps, quitting', self.map_name)
+
+            if self.store_writer is not None:
+                self.store_writer.commit()
         except Exception as e:
             logger.exception(e)
+            if self.store_writer is not None:
+                self.store_writer.abort()
             raise
         finally:
-            os.remove(filename)
+            self.store_writer = None
+            if not local_map:
+                os.remove(filename)
+
+    def _resume(self, version):
+        super(PBFSource, self)._resume(version)
+        if self.skip > 0 and self.store_writer is not None:
+            # Entities which are skipped would be missing from the store
+            self.store_writer.abort()
+            self.store_writer = None
+
+    def _map_version(self, filename, reader):
+        """
+        :return: Version of the map in given file, as read by given reader (readers can find entities in other order)
+        """
+        if self.checksum is not None:
+            return '{0}:{1}'.format(reader, self.checksum)
+        stat = os.stat(filename)
+        return '{0}:{1}:{2}:{3}'.format(reader, os.path.abspath(filename), stat.st_size, int(stat.st_mtime))
+
+    def process_map_with_store(self, filename):
+        """
+        Process entities from entity store, built earlier from PBF map
+        """
+        # Store name is made of map checksum and store signature
+        self._resume('store:{0}'.format(os.path.basename(filename)))
+        self.expected = count_entities(filename)
+        for raw_entity in read_entities(filename):
+            self._entity_found(raw_entity)
+            if self._should_stop():
+                return
 
     def process_map_with_osmread(self, filename):
         """
@@ -91,11 +249,11 @@ class PBFSource(OSMSource):
         # This import is here since user doesn't have to have it (optional)
         from osmread import parse_file
 
+        self._resume(self._map_version(filename, 'osmread'))
         for raw_entity in parse_file(filename):
             self._entity_found(raw_entity)
-            # If needed, this is how you can stop execution early
-            # if self.processed > 100000:
-            #     return
+            if self._should_stop():
+                return
 
     def process_map_with_osmium(self, filename):
         """
@@ -108,17 +266,17 @@ class PBFSource(OSMSource):
             pass
 
         class SerbianOsmLintHandler(osmium.SimpleHandler):
-            def __init__(self, entity_found_callback):
+            def __init__(self, entity_found_callback, should_stop_callback):
                 osmium.SimpleHandler.__init__(self)
                 self.entity_found_callback = entity_found_callback
+                self.should_stop_callback = should_stop_callback
                 self.processed = 0
                 self.all_checks = {}
 
             def process_entity(self, raw_entity, entity_type):
-                # If needed, this is how you can stop execution early
-                # if self.processed > 100000:
-                #     raise Exception
                 self.entity_found_callback(raw_entity)
+                if self.should_stop_callback():
+                    raise SignalEndOfExecution()
 
             def node(self, n):
                 self.process_entity(n, 'node')
@@ -126,9 +284,11 @@ class PBFSource(OSMSource):
             def way(self, w):
                 self.process_entity(w, 'way')
 
-        sloh = SerbianOsmLintHandler(self._entity_found)
+        self._resume(self._map_version(filename, 'osmium'))
+        sloh = SerbianOsmLintHandler(self._entity_found, self._should_stop)
         try:
-            sloh.apply_file(filename)
+            # Locations of nodes are kept, so ways have location too (as they have in Sophox)
+            sloh.apply_file(filename, locations=True)
         except SignalEndOfExecution:
             pass
         return sloh.all_checks
\ No newline at end of file
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import tempfile
+import time
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+
+class SophoxCache(object):
+    """
+    On-disk cache of Sophox responses, keyed by hash of query text. Responses are kept as lines, exactly as they
+    are received, so they can be streamed from cache the same way as from the network.
+    """
+    def __init__(self, cache_dir, ttl):
+        """
+        :param cache_dir: Directory where responses are kept. If None, cache is disabled
+        :param ttl: Time (in seconds) after which response in cache is considered stale. If 0, cache is disabled
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def is_enabled(self):
+        return self.cache_dir is not None and self.ttl > 0
+
+    def _filename(self, query):
+        return os.path.join(self.cache_dir, hashlib.sha256(query.encode('utf-8')).hexdigest() + '.tsv')
+
+    def get(self, query):
+        """
+        :param query: Query text
+        :return: Iterator over cached response lines, or None if there is no fresh response in cache
+        """
+        if not self.is_enabled():
+            return None
+        filename = self._filename(query)
+        try:
+            age = time.time() - os.path.getmtime(filename)
+        except OSError:
+            return None
+        if age > self.ttl:
+            return None
+        logger.debug('Using cached response %s', filename)
+        return self._read(filename)
+
+    @staticmethod
+    def _read(filename):
+        with open(filename, 'r', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                yield line[:-1] if line.endswith('\n') else line
+
+    def put(self, query, lines):
+        """
+        Wraps iterator over response lines, so that lines are written to cache as they are read.
+        Response ends up in cache only if it was read completely, and if it has header line at least.
+        :param query: Query text
+        :param lines: Iterator over response lines
+        :return: Iterator over same lines
+        """
+        if not self.is_enabled():
+            yield from lines
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        f = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', dir=self.cache_dir, suffix='.tmp',
+                                        delete=False)
+        completed = False
+        has_header = False
+        try:
+            for line in lines:
+                has_header = has_header or line != ''
+                f.write(line + '\n')
+                yield line
+            completed = has_header
+        finally:
+            f.close()
+            if completed:
+                os.replace(f.name, self._filename(query))
+            else:
+                os.remove(f.name)
@@ -1,49 +1,357 @@
 # -*- coding: utf-8 -*-
 
-from SPARQLWrapper import SPARQLWrapper, JSON
-import tools
+import math
+import queue
 import re
-from sources.osm_source import OSMSource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import simplejson
 
+import http_client
+import metrics
+import tools
+from exceptions import ServiceUnavailableException
+from haversine import haversine
+from osm_lint_entity import OsmLintEntity
+from sources.osm_source import OSMSource
+from sources.sophox_cache import SophoxCache
+
 logger = tools.get_logger(__name__)
 
+SOPHOX_URL = 'https://sophox.org/bigdata/namespace/wdq/sparql'
+# (connect, read) timeout for one query, in seconds
+SOPHOX_TIMEOUT = (10, 600)
+SOPHOX_ATTEMPTS = 5
+# Results waiting to be checked, from all tiles. Tile threads wait while queue is full, instead of buffering response
+SOPHOX_QUEUE_SIZE = 10000
+# How often tile thread waiting for room in full queue is checking whether it should stop, in seconds
+SOPHOX_QUEUE_PUT_TIMEOUT = 1
+# Grid of tiles is calculated on flat projection, so we shrink it a bit to be sure there are no gaps between tiles
+TILE_OVERLAP_FACTOR = 0.9
+KM_PER_LATITUDE_DEGREE = 111.32
+
 p_metadata = re.compile('#defaultView:Editor\s*(?P<json>.*)')
+p_center = re.compile('(?P<prefix>wikibase:center\s+"Point\()(?P<lon>[-0-9.]+)\s+(?P<lat>[-0-9.]+)(?P<suffix>\)")')
+p_radius = re.compile('(?P<prefix>wikibase:radius\s+")(?P<radius>[0-9.]+)(?P<suffix>")')
+p_tsv_literal = re.compile('^"(?P<value>.*)"(\^\^<(?P<datatype>[^>]*)>|@(?P<lang>[-a-zA-Z0-9]+))?$', re.DOTALL)
+p_tsv_escape = re.compile(r'\\(.)')
+p_tsv_integer = re.compile('^[-+]?[0-9]+$')
+p_tsv_decimal = re.compile('^[-+]?[0-9]*\.[0-9]+$')
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '"': '"', '\\': '\\'}
+
+# Kinds of messages tile threads are sending to thread that is processing entities
+_TILE_ROW, _TILE_DONE, _TILE_FAILED = range(3)
+
+
+def split_to_tiles(center, radius, tile_radius):
+    """
+    Covers circle with smaller circles (tiles). Each tile is circumscribed around one square of a grid
+    laid over the circle, so together they cover whole circle.
+    :param center: Center of the circle as (lat, lon) tuple
+    :param radius: Radius of the circle in km
+    :param tile_radius: Radius of each tile in km
+    :return: List of tiles, each one as ((lat, lon), radius) tuple
+    """
+    if radius <= tile_radius:
+        return [(center, radius)]
+
+    side = tile_radius * math.sqrt(2) * TILE_OVERLAP_FACTOR
+    cells = int(math.ceil(2 * radius / side))
+    km_per_longitude_degree = KM_PER_LATITUDE_DEGREE * math.cos(math.radians(center[0]))
+    tiles = []
+    for i in range(cells):
+        for j in range(cells):
+            dy = -radius + (i + 0.5) * side
+            dx = -radius + (j + 0.5) * side
+            # Skip squares that are completely outside of the circle
+            if math.hypot(max(abs(dx) - side / 2, 0), max(abs(dy) - side / 2, 0)) > radius:
+                continue
+            tile_center = (center[0] + dy / KM_PER_LATITUDE_DEGREE, center[1] + dx / km_per_longitude_degree)
+            tiles.append((tile_center, tile_radius))
+    return tiles
+
+
+def tile_intersects(tile, bbox):
+    """
+    Checks if tile can have any point inside bounding box. Tile is taken as square circumscribed around it.
+    :param tile: Tile as ((lat, lon), radius) tuple
+    :param bbox: Bounding box as (min_lat, min_lon, max_lat, max_lon) tuple
+    """
+    (lat, lon), radius = tile
+    min_lat, min_lon, max_lat, max_lon = bbox
+    lat_delta = radius / KM_PER_LATITUDE_DEGREE
+    lon_delta = radius / (KM_PER_LATITUDE_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - lat_delta <= max_lat and lat + lat_delta >= min_lat and \
+        lon - lon_delta <= max_lon and lon + lon_delta >= min_lon
+
+
+def parse_tsv_header(line):
+    """
+    Parses header line of SPARQL TSV result
+    :return: List of variable names
+    """
+    return [variable[1:] if variable.startswith('?') else variable for variable in line.split('\t')]
+
+
+def parse_tsv_term(term):
+    """
+    Parses one RDF term from SPARQL TSV result to the same form it would have in SPARQL JSON result
+    :return: Dictionary with "type", "value" and optionally "datatype"/"xml:lang" keys, or None if term is unbound
+    """
+    if term == '':
+        return None
+    if term.startswith('<') and term.endswith('>'):
+        return {'type': 'uri', 'value': term[1:-1]}
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    m = p_tsv_literal.match(term)
+    if m:
+        binding = {'type': 'literal', 'value': p_tsv_escape.sub(lambda e: TSV_ESCAPES.get(e.group(1), e.group(0)),
+                                                                m.group('value'))}
+        if m.group('datatype'):
+            binding['datatype'] = m.group('datatype')
+        elif m.group('lang'):
+            binding['xml:lang'] = m.group('lang')
+        return binding
+    # What is left are abbreviated literals from Turtle (booleans and numbers)
+    if term in ('true', 'false'):
+        datatype = XSD + 'boolean'
+    elif p_tsv_integer.match(term):
+        datatype = XSD + 'integer'
+    elif p_tsv_decimal.match(term):
+        datatype = XSD + 'decimal'
+    else:
+        datatype = XSD + 'double'
+    return {'type': 'literal', 'value': term, 'datatype': datatype}
+
+
+def parse_tsv_row(variables, line):
+    """
+    Parses one line of SPARQL TSV result to the same form as one binding from SPARQL JSON result
+    """
+    binding = {}
+    for variable, term in zip(variables, line.split('\t')):
+        value = parse_tsv_term(term)
+        if value is not None:
+            binding[variable] = value
+    return binding
+
+
+def iter_lines(chunks):
+    """
+    Splits stream of text chunks to lines. Unlike str.splitlines(), it splits only on new line,
+    which is only line separator in SPARQL TSV.
+    """
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def query_for_tile(query, tile):
+    """
+    Rewrites "wikibase:around" service parameters in query to point to a given tile
+    """
+    (lat, lon), radius = tile
+    query = p_center.sub(lambda m: '{0}{1:.5f} {2:.5f}{3}'.format(m.group('prefix'), lon, lat, m.group('suffix')),
+                         query, count=1)
+    query = p_radius.sub(lambda m: '{0}{1:.3f}{2}'.format(m.group('prefix'), radius, m.group('suffix')),
+                         query, count=1)
+    return query
 
 
 class SophoxSource(OSMSource):
-    def __init__(self, context, process_entity_callback, map_name, query):
-        super(SophoxSource, self).__init__(context, map_name, process_entity_callback)
+    def __init__(self, context, process_entities_callback, map_checks, query):
+        super(SophoxSource, self).__init__(context, map_checks, process_entities_callback)
         self.query = query
+        self.tile_radius = context.get('sophox_tile_radius', 50)
+        self.workers = context.get('sophox_workers', 4)
+        self.cache = SophoxCache(context.get('sophox_cache_dir'), context.get('sophox_cache_ttl', 0))
 
-    def _process_map(self):
-        sparql = SPARQLWrapper("https://sophox.org/bigdata/namespace/wdq/sparql")
-        sparql.setQuery(self.query)
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
+    def _get_tiles(self):
+        """
+        Splits area from "wikibase:around" service of the query to tiles.
+        :return: Tuple (center, radius, tiles), or None if query is not having "wikibase:around" service
+        """
+        center_match = p_center.search(self.query)
+        radius_match = p_radius.search(self.query)
+        if not center_match or not radius_match:
+            return None
+        center = (float(center_match.group('lat')), float(center_match.group('lon')))
+        radius = float(radius_match.group('radius'))
+        return center, radius, split_to_tiles(center, radius, self.tile_radius)
+
+    def _download_query(self, query):
+        """
+        Executes query and returns iterator over lines of response, as they are downloaded.
+        Sophox is often overloaded, so query is retried more times than usual.
+        """
+        r = http_client.request('GET', SOPHOX_URL, attempts=SOPHOX_ATTEMPTS, params={'query': query},
+                                headers={'Accept': 'text/tab-separated-values'}, timeout=SOPHOX_TIMEOUT, stream=True)
+        r.raise_for_status()
+        r.encoding = 'utf-8'
+        chunks = r.iter_content(chunk_size=64 * 1024, decode_unicode=True)
+        if self.stats is not None:
+            chunks = self._count_bytes(r, chunks)
+        return iter_lines(chunks)
+
+    def _count_bytes(self, response, chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            # Number of bytes really read from network (response can be compressed)
+            self.stats.count(self.map_name, 'bytes_downloaded', response.raw.tell())
+
+    def _iter_query(self, query):
+        """
+        Executes query (or takes its response from cache).
+        :return: Iterator which yields list of variables first, and then one result at a time, as they arrive
+        """
+        lines = self.cache.get(query)
+        if lines is None:
+            lines = self.cache.put(query, self._download_query(query))
+        header = next(lines, None)
+        if header is None or header == '':
+            raise Exception('Sophox returned empty response, without header line')
+        variables = parse_tsv_header(header)
+        yield variables
+        for line in lines:
+            if line != '':
+                yield parse_tsv_row(variables, line)
 
+    @staticmethod
+    def _put(results, message, stop):
+        """
+        Sends message to the queue. While queue is full, waits for room in it, until processing thread stops.
+        :return: False if processing thread stopped before message is sent
+        """
+        while not stop.is_set():
+            try:
+                results.put(message, timeout=SOPHOX_QUEUE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _stream_query(self, query, results, stop):
+        """
+        Executed in tile thread. Sends results of one query to the queue, as they arrive.
+        """
+        try:
+            rows = self._iter_query(query)
+            self._check_columns(next(rows))
+            count = 0
+            for row in rows:
+                if not self._put(results, (_TILE_ROW, row), stop):
+                    rows.close()
+                    return
+                count = count + 1
+            logger.info('[%s] Found %d results in tile', self.map_name, count)
+            self._put(results, (_TILE_DONE, None), stop)
+        except Exception as e:
+            self._put(results, (_TILE_FAILED, e), stop)
+
+    @staticmethod
+    def _check_columns(variables):
         for required_column in ['id', 'loc', 'name']:
-            if required_column not in results['head']['vars']:
+            if required_column not in variables:
                 raise Exception('Column "{0}" must be present in SPARQL query'.format(required_column))
 
-        metadata = {}
-        metadata_match = p_metadata.match(self.query)
-        if metadata_match:
-            metadata = simplejson.loads(metadata_match.group(1))
-
         # Count suggestions as total number of 'tag_N' columns. They should start from 1.
         # It is OK if there is no suggestions
         total_suggestions = 0
         while True:
-            if 'tag_{0}'.format(total_suggestions + 1) in results['head']['vars']:
+            if 'tag_{0}'.format(total_suggestions + 1) in variables:
                 total_suggestions = total_suggestions + 1
-                if 'val_{0}'.format(total_suggestions) not in results['head']['vars']:
+                if 'val_{0}'.format(total_suggestions) not in variables:
                     raise Exception('There exists "tag_{0}" column in SPARQL query and there is no "val_{0}" column'
                                     .format(total_suggestions))
             else:
                 break
 
-        logger.info('Found %d results', len(results["results"]["bindings"]))
-        for result in results["results"]["bindings"]:
-            result['metadata'] = metadata
-            self._entity_found(result)
+    @staticmethod
+    def _is_inside(result, center, radius):
+        """
+        Checks that result is inside original area. Tiles are covering more than original area, so this is needed
+        to have the same results as if query was executed without tiling.
+        """
+        location = OsmLintEntity.parse_wkt_point(result['loc']['value'])
+        if location is None:
+            return True
+        return haversine(center, location) <= radius
+
+    def _process_map(self):
+        metadata = {}
+        metadata_match = p_metadata.match(self.query)
+        if metadata_match:
+            metadata = simplejson.loads(metadata_match.group(1))
+
+        tiles = self._get_tiles()
+        tiled = tiles is not None and len(tiles[2]) > 1
+        if not tiled:
+            queries = [self.query]
+        else:
+            center, radius, tiles = tiles
+            logger.info('[%s] Area with radius %.0f km is split to %d tiles', self.map_name, radius, len(tiles))
+            if self.sampler is not None and self.sampler.bbox is not None:
+                tiles = [tile for tile in tiles if tile_intersects(tile, self.sampler.bbox)]
+                logger.info('[%s] %d tiles are intersecting bounding box', self.map_name, len(tiles))
+                if len(tiles) == 0:
+                    return
+            queries = [query_for_tile(self.query, tile) for tile in tiles]
+
+        seen_ids = set()
+        results = queue.Queue(maxsize=SOPHOX_QUEUE_SIZE)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(queries))) as executor:
+            for query in queries:
+                executor.submit(self._stream_query, query, results, stop)
+            # Entities are processed here, in this thread, as soon as they arrive. Checks should not run in parallel.
+            try:
+                finished = 0
+                while finished < len(queries):
+                    try:
+                        kind, result = results.get(
+                            timeout=None if self.deadline is None else max(0, self.deadline - time.time()))
+                    except queue.Empty:
+                        self._mark_incomplete('deadline passed while waiting for Sophox')
+                        break
+                    if kind == _TILE_DONE:
+                        finished = finished + 1
+                        metrics.gauge('progress', finished / len(queries), map=self.map_name, stage='read')
+                        metrics.gauge('queue_depth', results.qsize(), map=self.map_name, queue='sophox')
+                        continue
+                    elif kind == _TILE_FAILED:
+                        # Tile which failed because Sophox is down (or deadline passed) is left out, others are kept
+                        if isinstance(result, ServiceUnavailableException):
+                            self._mark_incomplete(result.message)
+                        elif self.deadline is not None and time.time() >= self.deadline:
+                            self._mark_incomplete('deadline passed while waiting for Sophox')
+                        else:
+                            raise result
+                        finished = finished + 1
+                        continue
+                    # Tiles are overlapping, take each entity only once
+                    entity_id = result['id']['value']
+                    if entity_id in seen_ids:
+                        continue
+                    if tiled and not self._is_inside(result, center, radius):
+                        continue
+                    seen_ids.add(entity_id)
+                    result['metadata'] = metadata
+                    self._entity_found(result)
+                    if self._should_stop():
+                        break
+            finally:
+                stop.set()
+        logger.info('[%s] Found %d results', self.map_name, len(seen_ids))
@@ -1,25 +1,45 @@
 # -*- coding: utf-8 -*-
 
+import collections
+
 from sources.pbf_source import PBFSource
 from sources.sophox_source import SophoxSource
+from sources.store_source import StoreSource
+
+
+def group_by_location(map_checks):
+    """
+    Groups map-checks by their location, so one source can be created for each group (see create_source)
+    :param map_checks: List of map-checks
+    :return: List of groups, each group being list of map-checks with the same location, in order of appearance
+    """
+    groups = collections.OrderedDict()
+    for map_check in map_checks:
+        groups.setdefault(map_check['location'], []).append(map_check)
+    return list(groups.values())
 
 
 class SourceFactory(object):
     """
     Based on info in configuration, creates appropriate source
     """
-    def __init__(self, process_entity_callback, context):
-        self.process_entity_callback = process_entity_callback
+    def __init__(self, process_entities_callback, context):
+        self.process_entities_callback = process_entities_callback
         self.context = context
 
-    def create_source(self, map_check):
-        location = map_check['location']
+    def create_source(self, map_checks):
+        """
+        Creates one source for all map-checks given. All of them needs to have same location.
+        """
+        location = map_checks[0]['location']
         if location.endswith(".pbf"):
-            return PBFSource(self.context, self.process_entity_callback, map_check['name'], location)
+            return PBFSource(self.context, self.process_entities_callback, map_checks, location)
+        elif location.endswith(".db"):
+            return StoreSource(self.context, self.process_entities_callback, map_checks, location)
         elif location.endswith(".sparql"):
             query = None
             with open(location, 'r', encoding='utf-8') as f:
                 query = f.read()
-            return SophoxSource(self.context, self.process_entity_callback, map_check['name'], query)
+            return SophoxSource(self.context, self.process_entities_callback, map_checks, query)
         else:
             raise Exception("Unknown source")
\ No newline at end of file
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from sources.pbf_source import PBFSource
+import tools
+
+logger = tools.get_logger(__name__)
+
+
+class StoreSource(PBFSource):
+    """
+    Source reading directly from entity store (.db file), previously built from .pbf file with --entity-store-dir
+    """
+    def _process_map(self):
+        logger.info('[%s] Reading entities from store %s', self.map_name, self.pbf_url)
+        self.process_map_with_store(self.pbf_url)
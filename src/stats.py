@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module holding run statistics - how much time each check takes, and how many entities and bytes each source
+went through. Statistics are collected only if asked for, otherwise nothing here is called at all.
+"""
+
+import collections
+import heapq
+import random
+import threading
+
+import tools
+
+logger = tools.get_logger(__name__)
+
+# Number of latencies kept for each check to calculate percentiles from
+SAMPLE_SIZE = 1024
+# Number of slowest entities kept for each check
+SLOWEST = 5
+
+
+class CheckStats(object):
+    """
+    Timings of one check in one map-check
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.fix_calls = 0
+        self.fix_total = 0.0
+        # Reservoir sample of latencies, so percentiles are calculated in constant memory
+        self.samples = []
+        # Heap of (duration, entity type, entity id)
+        self.slowest = []
+
+    def add(self, duration, entity_type, entity_id, calls=1):
+        """
+        :param duration: Time (in seconds) check took
+        :param calls: Number of entities check was performed on in that time (more than one for batch checks)
+        """
+        self.calls = self.calls + calls
+        self.total = self.total + duration
+        latency = duration / calls
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(latency)
+        else:
+            i = random.randrange(self.calls)
+            if i < SAMPLE_SIZE:
+                self.samples[i] = latency
+        if entity_id is not None:
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, (duration, entity_type, entity_id))
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (duration, entity_type, entity_id))
+
+    def add_fix(self, duration):
+        self.fix_calls = self.fix_calls + 1
+        self.fix_total = self.fix_total + duration
+
+    def merge(self, other):
+        if self.calls + other.calls > 0:
+            # Keep samples proportionally to number of calls they are taken from
+            samples = random.sample(self.samples, min(len(self.samples), SAMPLE_SIZE * self.calls //
+                                                      (self.calls + other.calls) + 1)) + \
+                random.sample(other.samples, min(len(other.samples), SAMPLE_SIZE * other.calls //
+                                                 (self.calls + other.calls) + 1))
+            self.samples = samples[:SAMPLE_SIZE]
+        self.calls = self.calls + other.calls
+        self.total = self.total + other.total
+        self.fix_calls = self.fix_calls + other.fix_calls
+        self.fix_total = self.fix_total + other.fix_total
+        self.slowest = heapq.nlargest(SLOWEST, self.slowest + other.slowest)
+        heapq.heapify(self.slowest)
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def to_json(self):
+        return {
+            'calls': self.calls,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'fix_calls': self.fix_calls,
+            'fix_total': self.fix_total,
+            'slowest': [{'duration': duration, 'entity_type': entity_type, 'id': entity_id}
+                        for duration, entity_type, entity_id in sorted(self.slowest, reverse=True)]
+        }
+
+
+class Stats(object):
+    """
+    Statistics of one or more sources, and of all checks performed on entities from them
+    """
+    def __init__(self):
+        # Source counters, by source name (bytes_downloaded, entities_decoded, entities_filtered, entities_checked)
+        self.sources = collections.defaultdict(collections.Counter)
+        # CheckStats, by map-check name and check name
+        self.checks = collections.defaultdict(lambda: collections.defaultdict(CheckStats))
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Stats are sent back from workers, lock and default factories cannot be pickled
+        return {'sources': {name: dict(counters) for name, counters in self.sources.items()},
+                'checks': {name: dict(checks) for name, checks in self.checks.items()}}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for name, counters in state['sources'].items():
+            self.sources[name].update(counters)
+        for name, checks in state['checks'].items():
+            self.checks[name].update(checks)
+
+    def count(self, source_name, counter, value=1):
+        """
+        Increases source counter. Safe to call from more threads.
+        """
+        with self.lock:
+            self.sources[source_name][counter] += value
+
+    def check(self, map_name, check_name):
+        """
+        :return: CheckStats of given check in given map-check
+        """
+        return self.checks[map_name][check_name]
+
+    def merge(self, other):
+        for name, counters in other.sources.items():
+            self.sources[name].update(counters)
+        for map_name, checks in other.checks.items():
+            for check_name, check_stats in checks.items():
+                self.checks[map_name][check_name].merge(check_stats)
+
+    def to_json(self):
+        return {
+            'sources': {name: dict(counters) for name, counters in self.sources.items()},
+            'checks': {map_name: {check_name: check_stats.to_json() for check_name, check_stats in checks.items()}
+                       for map_name, checks in self.checks.items()}
+        }
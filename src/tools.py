@@ -1,29 +1,148 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging.handlers
+import queue
+import sqlite3
+import threading
+import time
 
+# Default maximum number of debug records per second from each logger
+DEBUG_RATE = 100
 
-def setup_logger(logging_level=logging.INFO):
+_listener = None
+
+
+def setup_logger(logging_level=logging.INFO, log_queue=None):
     """
-    Simple logger used throughout whole code - logs both to file and console
+    Simple logger used throughout whole code - logs both to file and console.
+    Handlers are run by a listener thread which takes records from a queue, so logging never blocks on I/O.
+    Workers are sending their records to the same queue (see setup_worker_logger), so only this process is writing
+    to (and rotating) log file.
+    :param log_queue: Queue records are sent through. Give multiprocessing queue if workers are processes
     """
-    logger = logging.getLogger('serbian-osm-lint')
-    logger.setLevel(logging.DEBUG)
+    global _listener
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    ch = logging.handlers.TimedRotatingFileHandler(filename='serbian-osm-lint.log', when='midnight', interval=1,
+    fh = logging.handlers.TimedRotatingFileHandler(filename='serbian-osm-lint.log', when='midnight', interval=1,
                                                    encoding='utf-8')
-    ch.setLevel(logging.DEBUG)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
 
     ch = logging.StreamHandler()
     ch.setLevel(logging_level)
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
 
+    log_queue = queue.Queue() if log_queue is None else log_queue
+    _listener = logging.handlers.QueueListener(log_queue, fh, ch, respect_handler_level=True)
+    _listener.start()
+    return setup_worker_logger(log_queue)
+
+
+def setup_worker_logger(log_queue, debug_rate=DEBUG_RATE):
+    """
+    Sends all records of this process to a given queue, where listener in main process is taking them from.
+    Needs to be called in each worker process.
+    :param debug_rate: Maximum number of debug records per second from each logger, see limit_debug_rate()
+    """
+    logger = logging.getLogger('serbian-osm-lint')
+    logger.setLevel(logging.DEBUG)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    limit_debug_rate(debug_rate)
     return logger
 
 
+def limit_debug_rate(debug_rate):
+    """
+    Limits number of debug records sent from this process (checks can log a lot of them, for each entity)
+    :param debug_rate: Maximum number of debug records per second from each logger. 0 for no limit
+    """
+    for handler in logging.getLogger('serbian-osm-lint').handlers:
+        for f in [f for f in handler.filters if isinstance(f, RateLimitFilter)]:
+            handler.removeFilter(f)
+        if debug_rate > 0:
+            # Filter needs to be on handler, filters on logger are not applied to records from child loggers
+            handler.addFilter(RateLimitFilter(debug_rate))
+
+
+def stop_logger():
+    """
+    Waits until all records are written and stops listener
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most given number of records per second (with burst of the same size) from each logger.
+    Only records below given level are limited. Number of records dropped is added to next record let through.
+    """
+    def __init__(self, rate, level=logging.INFO):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.level = level
+        # Logger name -> [tokens, last update, number of records dropped]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(record.name, [self.rate, now, 0])
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] = bucket[2] + 1
+                return False
+            bucket[0] = bucket[0] - 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped > 0:
+            record.msg = '{0} ({1} similar records dropped)'.format(record.getMessage(), dropped)
+            record.args = None
+        return True
+
+
 def get_logger(name):
     return logging.getLogger('serbian-osm-lint.{0}'.format(name))
+
+
+def connect_shared_db(filename):
+    """
+    Opens connection to SQLite file through which workers (processes and threads) share state during the run.
+    State is not needed after the run, so nothing is lost if OS crashes and file does not need to be synced.
+    """
+    connection = sqlite3.connect(filename, timeout=60, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=OFF')
+    return connection
+
+
+def thread_connection(local, filename):
+    """
+    Connections cannot be shared between threads, so each thread opens its own, on first use
+    :param local: threading.local() of the object using the connection
+    :param filename: Shared SQLite file (see connect_shared_db)
+    :return: Connection of the current thread
+    """
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = local.connection = connect_shared_db(filename)
+    return connection
+
+
+def file_md5(filename):
+    """
+    Calculates MD5 checksum of a (possibly big) file
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
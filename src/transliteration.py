@@ -25,3 +25,47 @@ def cyr2lat(text):
         else:
             out += c
     return out
+
+
+# Order is important here - digraphs needs to be replaced before single letters
+lat_to_cyr_digraphs = [
+    ('DŽ', 'Џ'), ('Dž', 'Џ'), ('NJ', 'Њ'), ('Nj', 'Њ'), ('LJ', 'Љ'), ('Lj', 'Љ'),
+    ('dž', 'џ'), ('nj', 'њ'), ('lj', 'љ')]
+
+lat_to_cyr = {
+    'A': 'А', 'B': 'Б', 'V': 'В', 'G': 'Г', 'D': 'Д', 'Đ': 'Ђ',
+    'E': 'Е', 'Ž': 'Ж', 'Z': 'З', 'I': 'И', 'J': 'Ј', 'K': 'К',
+    'L': 'Л', 'M': 'М', 'N': 'Н', 'O': 'О', 'P': 'П', 'R': 'Р',
+    'S': 'С', 'T': 'Т', 'Ć': 'Ћ', 'U': 'У', 'F': 'Ф', 'H': 'Х',
+    'C': 'Ц', 'Č': 'Ч', 'Š': 'Ш',
+    'a': 'а', 'b': 'б', 'v': 'в', 'g': 'г', 'd': 'д', 'đ': 'ђ',
+    'e': 'е', 'ž': 'ж', 'z': 'з', 'i': 'и', 'j': 'ј', 'k': 'к',
+    'l': 'л', 'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'r': 'р',
+    's': 'с', 't': 'т', 'ć': 'ћ', 'u': 'у', 'f': 'ф', 'h': 'х',
+    'c': 'ц', 'č': 'ч', 'š': 'ш'}
+
+lat_to_ascii = {
+    'Đ': 'Dj', 'Ž': 'Z', 'Ć': 'C', 'Č': 'C', 'Š': 'S',
+    'đ': 'dj', 'ž': 'z', 'ć': 'c', 'č': 'c', 'š': 's'}
+
+
+def lat2cyr(text):
+    for digraph, cyr in lat_to_cyr_digraphs:
+        text = text.replace(digraph, cyr)
+    out = ''
+    for c in text:
+        if c in lat_to_cyr:
+            out += lat_to_cyr[c]
+        else:
+            out += c
+    return out
+
+
+def lat2ascii(text):
+    out = ''
+    for c in text:
+        if c in lat_to_ascii:
+            out += lat_to_ascii[c]
+        else:
+            out += c
+    return out
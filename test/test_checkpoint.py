@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import rules
+from checkpoint import Checkpoints
+from deduplication import EntityDeduplicator
+from engine import Result
+from entity_store import EntityStoreWriter, store_filename
+from sources.store_source import StoreSource
+
+
+class Crash(Exception):
+    pass
+
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.map_checks = [{'name': 'Suite (Serbia)', 'location': 'serbia.osm.pbf', 'checks': [],
+                            'rules': [rules.AddingNameRule]}]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_map(self):
+        checkpoints = Checkpoints(self.directory, {'limit': None})
+        self.assertIsNone(checkpoints.load_map(self.map_checks))
+        checkpoints.save_progress(self.map_checks, 'v1', {'processed': 10})
+        checkpoints.save_map(self.map_checks, ({'Suite (Serbia)': {}}, None, None))
+        self.assertEqual(checkpoints.load_map(self.map_checks), ({'Suite (Serbia)': {}}, None, None))
+        # Once map is done, its progress is not needed anymore
+        self.assertIsNone(checkpoints.load_progress(self.map_checks, 'v1'))
+
+        # Other options or other rules are other maps
+        self.assertIsNone(Checkpoints(self.directory, {'limit': 100}).load_map(self.map_checks))
+        other_rules = [dict(self.map_checks[0], rules=[rules.ChangingNameSrToCyrillicRule])]
+        self.assertIsNone(checkpoints.load_map(other_rules))
+
+        checkpoints.clear()
+        self.assertIsNone(checkpoints.load_map(self.map_checks))
+
+    def test_claimed_keys(self):
+        checkpoints = Checkpoints(self.directory, {})
+        self.assertEqual(checkpoints.load_claimed(self.map_checks), [])
+        checkpoints.save_progress(self.map_checks, 'v1', {'processed': 10, 'claimed': ['a']})
+        # Keys are known even if map changed since, so they are claimed until source finds that out
+        self.assertEqual(checkpoints.load_claimed(self.map_checks), ['a'])
+        checkpoints.save_map(self.map_checks, ({'Suite (Serbia)': {}}, None, None), ['a', 'b'])
+        self.assertEqual(checkpoints.load_done(self.map_checks), (({'Suite (Serbia)': {}}, None, None), ['a', 'b']))
+        self.assertEqual(checkpoints.load_claimed(self.map_checks), [])
+
+    def test_progress_on_other_version_is_not_used(self):
+        checkpoints = Checkpoints(self.directory, {})
+        checkpoints.save_progress(self.map_checks, 'v1', {'processed': 10})
+        self.assertEqual(checkpoints.load_progress(self.map_checks, 'v1')['processed'], 10)
+        self.assertIsNone(checkpoints.load_progress(self.map_checks, 'v2'))
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = store_filename(self.directory, 'abc', '')
+        writer = EntityStoreWriter(self.filename, 'abc', '')
+        for i in range(1, 3501):
+            writer.add('node', i, 1, (44.0, 20.5), {'place': 'village', 'name': 'Село {0}'.format(i)})
+        writer.commit()
+        self.map_checks = [{'name': 'Store', 'location': self.filename, 'checks': [], 'rules': []}]
+        self.context = {'checkpoints': Checkpoints(self.directory, {}), 'checkpoint_interval': 0.000001}
+        self.deduplication_count = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_source(self, crash_after=None):
+        checked = []
+
+        def process_entities(entities, _):
+            if crash_after is not None and len(checked) >= crash_after:
+                raise Crash()
+            checked.extend(entity.id for entity in entities)
+            if 'deduplicator' in self.context:
+                self.context['deduplicator'].claim([('Store', 'node', entity.id) for entity in entities], self.filename)
+            return [{'check': {'result': Result.CHECKED_OK, 'messages': [], 'fixable': False}} for _ in entities]
+        source = StoreSource(self.context, process_entities, self.map_checks, self.filename)
+        try:
+            source.process_map()
+        except Crash:
+            pass
+        return checked, source
+
+    def test_resume_after_crash(self):
+        checked, _ = self.run_source(crash_after=2500)
+        self.assertEqual(len(checked), 3000)
+
+        checked, source = self.run_source()
+        # Progress was saved after 3000 entities, when crash happened
+        self.assertEqual(source.skip, 3000)
+        self.assertEqual(checked, list(range(3001, 3501)))
+        self.assertEqual(sorted(source.all_checks['Store']), [('node', i) for i in range(1, 3501)])
+        self.assertEqual(source.checked, 3500)
+
+    def new_run(self):
+        """
+        Starts run with empty deduplicator, claiming again keys of this map from its progress (as main.run does)
+        """
+        self.deduplication_count += 1
+        deduplicator = EntityDeduplicator(os.path.join(self.directory, 'deduplication-{0}.db'.format(
+            self.deduplication_count)))
+        deduplicator.restore(self.context['checkpoints'].load_claimed(self.map_checks), self.filename)
+        self.context['deduplicator'] = deduplicator
+        return deduplicator
+
+    def test_claimed_keys_are_kept(self):
+        self.new_run()
+        self.run_source(crash_after=2500)
+        deduplicator = self.new_run()
+        # Other source finding entities already checked by this map does not check them again
+        self.assertEqual(deduplicator.claim([('Store', 'node', 3000), ('Store', 'node', 3001)], 'other.pbf'),
+                         {('Store', 'node', 3001)})
+        deduplicator.release([('Store', 'node', 3001)])
+        self.run_source()
+        self.assertEqual(len(deduplicator.owned(self.filename)), 3500)
+
+    def test_claimed_keys_on_other_version_are_released(self):
+        self.new_run()
+        self.run_source(crash_after=2500)
+        progress_filename = self.context['checkpoints']._filename(self.map_checks, 'progress')
+        with open(progress_filename, 'rb') as f:
+            progress = pickle.load(f)
+        with open(progress_filename, 'wb') as f:
+            pickle.dump(dict(progress, version='other'), f)
+        deduplicator = self.new_run()
+        self.assertEqual(len(deduplicator.owned(self.filename)), 3000)
+        checked, _ = self.run_source()
+        # Map is checked again from the start, with all its checks claimed again
+        self.assertEqual(len(checked), 3500)
+        self.assertEqual(len(deduplicator.owned(self.filename)), 3500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,16 @@
 
 import unittest
 
+import pywikibot
 from osmread import Node
 
+import http_client
 from checks import NameMissingCheck, NameCyrillicCheck, LatinNameExistsCheck, LatinNameSameAsCyrillicCheck
-from checks import LatinNameNotInCyrillicCheck
+from checks import LatinNameNotInCyrillicCheck, GenericSophoxCheck, _wiki_requests
+from entity_store import StoredEntity
+from osm_lint_entity import OsmLintEntity
+from rules import AddingNameSrRule, evaluate_rules
+from simulation import UNKNOWN, SimulatedApi
 
 
 class AbstractTestCheck(unittest.TestCase):
@@ -174,5 +180,47 @@ class TestLatinNameNotInCyrillicCheck(AbstractTestCheck):
         self.assertTrue(LatinNameNotInCyrillicCheck(self.default_context).do_check(node) == '')
 
 
+class TestGenericSophoxCheck(unittest.TestCase):
+    def test_simulated_fix(self):
+        global_context = {'fix': True, 'simulate': True, 'dry_run': False,
+                          'map-check': {'name': 'Serbia (Sophox)', 'suite': 'Serbia'}}
+        # Columns as returned by changing_namesr_to_cyrillic.sparql, where name is holding value of name:sr
+        entity = OsmLintEntity({'id': {'value': 'https://www.openstreetmap.org/way/7'},
+                                'loc': {'value': 'Point(20.45 44.8)'}, 'name': {'value': 'Ulica'},
+                                'tag_1': {'value': 'name:sr'}, 'val_1': {'value': 'Улица'},
+                                'metadata': {'check_description': 'Entity {0} is not having cyrillic name:sr tag'}})
+        api = SimulatedApi(entity)
+        GenericSophoxCheck({'global_context': global_context}).fix(entity, api)
+        # What is in name:sr now is not known, query is only telling that it is not cyrillic
+        self.assertEqual(api.changes(), [('name:sr', UNKNOWN, 'Улица')])
+
+    def test_rule_result_on_way(self):
+        # Highway ways read from PBF are put on the map at centroid of their nodes
+        global_context = {'fix': False, 'dry_run': True, 'map-check': {'name': 'Serbia', 'suite': 'Serbia'}}
+        way = StoredEntity(7, 1, 'way', {'name': 'Njegoševa', 'highway': 'residential'}, 44.8, 20.45)
+        results = evaluate_rules([AddingNameSrRule()], way)
+        self.assertEqual(len(results), 1)
+        entity = OsmLintEntity(results[0])
+        self.assertEqual((entity.entity_type, entity.id, entity.lat, entity.lon), ('way', 7, 44.8, 20.45))
+        check = GenericSophoxCheck({'global_context': global_context})
+        self.assertEqual(check.do_check(entity), 'Entity Njegoševa is missing name:sr tag')
+        self.assertEqual(GenericSophoxCheck.suggestions(entity), [('name:sr', 'Његошева')])
+
+
+class TestWikiRequests(unittest.TestCase):
+    def test_overlapping_blocks(self):
+        retries = pywikibot.config.max_retries, pywikibot.config.retry_wait
+        with http_client.deadline(10):
+            first, second = _wiki_requests(), _wiki_requests()
+            first.__enter__()
+            second.__enter__()
+            self.assertEqual((pywikibot.config.max_retries, pywikibot.config.retry_wait), (0, 0))
+            # Blocks (e.g. from two threads) can end in any order, retries are back only when both ended
+            first.__exit__(None, None, None)
+            self.assertEqual((pywikibot.config.max_retries, pywikibot.config.retry_wait), (0, 0))
+            second.__exit__(None, None, None)
+        self.assertEqual((pywikibot.config.max_retries, pywikibot.config.retry_wait), retries)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.request
+
+import simplejson
+
+from daemon import QueryApi, changed_maps, map_versions
+from engine import Result
+from results_db import ResultsDatabase
+from sources.source_factory import SourceFactory
+
+
+def error(message):
+    return {'result': Result.CHECKED_ERROR, 'messages': [message], 'fixable': False}
+
+
+class TestQueryApi(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'results.db')
+        results_db = ResultsDatabase(self.filename)
+        for all_checks in ({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')}),
+                                             ('way', 2): ('B', 'way', {'a': error('2')})}},
+                           {'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1'), 'b': error('3')})}}):
+            results_db.add_results(results_db.start_run({}), all_checks)
+        results_db.close()
+        self.api = QueryApi(self.filename, 0)
+
+    def tearDown(self):
+        self.api.stop()
+        shutil.rmtree(self.directory)
+
+    def test_errors(self):
+        status, errors = self.api.handle('/errors')
+        self.assertEqual(status, 200)
+        self.assertEqual([(e['check'], e['entity_id']) for e in errors], [('a', 1), ('b', 1)])
+        self.assertEqual(len(self.api.handle('/errors?check=b&map=Serbia')[1]), 1)
+        self.assertEqual(self.api.handle('/errors?entity=node/1')[1][0]['name'], 'A')
+        self.assertEqual(self.api.handle('/errors?entity=way/2')[1], [])
+        self.assertEqual(self.api.handle('/errors?entity=node')[0], 400)
+
+    def test_changes(self):
+        status, changes = self.api.handle('/changes')
+        self.assertEqual(status, 200)
+        self.assertEqual(changes['new'], [('Serbia', 'b', 'node', 1)])
+        self.assertEqual(changes['resolved'], [('Serbia', 'a', 'way', 2, 'B', ['2'])])
+        self.assertEqual(changes['count_persistent'], 1)
+
+    def test_server(self):
+        self.api.status = {'state': 'waiting'}
+        self.api.start()
+        url = 'http://127.0.0.1:{0}'.format(self.api.server.server_address[1])
+        with urllib.request.urlopen(url + '/status') as r:
+            self.assertEqual(simplejson.loads(r.read().decode('utf-8')), {'state': 'waiting'})
+        with urllib.request.urlopen(url + '/errors?check=a') as r:
+            self.assertEqual(len(simplejson.loads(r.read().decode('utf-8'))), 1)
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/report')
+        self.assertEqual(e.exception.code, 404)
+
+
+class TestMapVersions(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.map_check_groups = [[{'name': 'Serbia', 'location': os.path.join(self.directory, 'serbia.osm.pbf'),
+                                   'checks': [], 'rules': []}]]
+        with open(self.map_check_groups[0][0]['location'], 'wb') as f:
+            f.write(b'pbf')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_local_map_changes(self):
+        source_factory = SourceFactory(None, {})
+        versions = map_versions(source_factory, self.map_check_groups)
+        self.assertEqual(changed_maps({}, versions), list(versions))
+        self.assertEqual(changed_maps(versions, map_versions(source_factory, self.map_check_groups)), [])
+
+        with open(self.map_check_groups[0][0]['location'], 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(changed_maps(versions, map_versions(source_factory, self.map_check_groups)), list(versions))
+
+    def test_unknown_version_is_not_change(self):
+        self.assertEqual(changed_maps({'a.sparql': None}, {'a.sparql': None, 'b.sparql': None}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
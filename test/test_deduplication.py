@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from deduplication import EntityDeduplicator
+
+
+class TestEntityDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'deduplication.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claim(self):
+        deduplicator = EntityDeduplicator(self.filename)
+        key1 = ('Serbia checks', 'node', 123, 'checks.NameMissingCheck', '')
+        key2 = ('Serbia checks', 'way', 123, 'checks.NameMissingCheck', '')
+        self.assertEqual(deduplicator.claim([key1]), {key1})
+        self.assertEqual(deduplicator.claim([key1, key2]), {key2})
+        self.assertEqual(deduplicator.claim([key1, key2]), set())
+
+    def test_release(self):
+        deduplicator = EntityDeduplicator(self.filename)
+        key1 = ('Serbia checks', 'node', 123, 'checks.NameMissingCheck', '')
+        key2 = ('Serbia checks', 'way', 123, 'checks.NameMissingCheck', '')
+        deduplicator.claim([key1, key2])
+        deduplicator.release([key1])
+        self.assertEqual(deduplicator.claim([key1, key2]), {key1})
+
+    def test_release_owner(self):
+        deduplicator = EntityDeduplicator(self.filename)
+        key1 = ('Serbia checks', 'node', 123, 'checks.NameMissingCheck', '')
+        key2 = ('Serbia checks', 'way', 123, 'checks.NameMissingCheck', '')
+        deduplicator.claim([key1], 'serbia.pbf')
+        deduplicator.claim([key2], 'belgrade.pbf')
+        deduplicator.release_owner('serbia.pbf')
+        self.assertEqual(deduplicator.claim([key1, key2]), {key1})
+
+    def test_restore(self):
+        key1 = ('Serbia checks', 'node', 123, 'checks.NameMissingCheck', '')
+        key2 = ('Serbia checks', 'way', 123, 'checks.NameMissingCheck', '')
+        deduplicator = EntityDeduplicator(self.filename)
+        deduplicator.claim([key1], 'serbia.pbf')
+        deduplicator.claim([key2], 'belgrade.pbf')
+        owned = deduplicator.owned('serbia.pbf')
+        self.assertEqual(len(owned), 1)
+        # Next run is starting with empty deduplicator
+        other_deduplicator = EntityDeduplicator(os.path.join(self.directory, 'other.db'))
+        other_deduplicator.restore(owned, 'serbia.pbf')
+        self.assertEqual(other_deduplicator.claim([key1, key2], 'belgrade.pbf'), {key2})
+        self.assertEqual(other_deduplicator.owned('serbia.pbf'), owned)
+        other_deduplicator.release_owner('serbia.pbf')
+        self.assertEqual(other_deduplicator.claim([key1]), {key1})
+
+    def test_claim_is_shared_between_copies(self):
+        # This is how deduplicator ends up in other processes
+        deduplicator = EntityDeduplicator(self.filename)
+        other_deduplicator = pickle.loads(pickle.dumps(deduplicator))
+        key = ('Serbia checks', 'node', 123, 'checks.GenericSophoxCheck', 'Entity {0} is missing name tag')
+        self.assertEqual(other_deduplicator.claim([key]), {key})
+        self.assertEqual(deduplicator.claim([key]), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
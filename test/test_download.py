@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import download
+from download import Downloader
+from exceptions import ChecksumMismatchException
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in for map server, supporting Range requests. It can be told to break after some bytes.
+    """
+    fail_after = None
+    requests = []
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+    def do_GET(self):
+        RangeRequestHandler.requests.append(self.headers.get('Range'))
+        start, end = 0, len(CONTENT) - 1
+        if self.headers.get('Range'):
+            start, end = [int(x) for x in self.headers['Range'][len('bytes='):].split('-')]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        body = CONTENT[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if RangeRequestHandler.fail_after is not None:
+            self.wfile.write(body[:RangeRequestHandler.fail_after])
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'map.osm.pbf')
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{0}/map.osm.pbf'.format(self.server.server_port)
+        RangeRequestHandler.fail_after = None
+        RangeRequestHandler.requests = []
+        self.old_values = download.MIN_RANGE_SIZE, download.ATTEMPTS
+        download.MIN_RANGE_SIZE, download.ATTEMPTS = 64 * 1024, 1
+
+    def tearDown(self):
+        download.MIN_RANGE_SIZE, download.ATTEMPTS = self.old_values
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_parallel_ranges(self):
+        Downloader(self.url, self.filename, connections=4).download(hashlib.md5(CONTENT).hexdigest())
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(len(RangeRequestHandler.requests), 4)
+        self.assertFalse(os.path.isfile(self.filename + '.progress'))
+
+    def test_resume(self):
+        RangeRequestHandler.fail_after = 300 * 1024
+        with self.assertRaises(Exception):
+            Downloader(self.url, self.filename, connections=2).download()
+        self.assertTrue(os.path.isfile(self.filename + '.progress'))
+
+        RangeRequestHandler.fail_after = None
+        RangeRequestHandler.requests = []
+        Downloader(self.url, self.filename, connections=2).download(hashlib.md5(CONTENT).hexdigest())
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        # Second download continued both ranges from where they stopped
+        half = len(CONTENT) // 2
+        starts = sorted(int(r[len('bytes='):].split('-')[0]) for r in RangeRequestHandler.requests)
+        self.assertEqual(len(starts), 2)
+        self.assertTrue(0 < starts[0] < half)
+        self.assertTrue(half < starts[1] < len(CONTENT))
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ChecksumMismatchException):
+            Downloader(self.url, self.filename).download('0' * 32)
+        self.assertFalse(os.path.isfile(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import http_client
+from applicability import City
+from deduplication import EntityDeduplicator
+from engine import CheckEngine, EntityChunk, Result, check_chunk, merge_checks, order_checks
+from entity_store import StoredEntity
+from exceptions import CheckDependencyException, DeadlineExceededException
+from osm_lint_entity import OsmLintEntity
+
+performed = []
+
+
+class FakeCheck(object):
+    """
+    Minimal check, so engine can be tested without checks talking to Wikipedia
+    """
+    applicable_on = [City]
+    depends_on = []
+    is_fixable = False
+    message = ''
+
+    def __init__(self, entity_context):
+        self.entity_context = entity_context
+
+    @staticmethod
+    def result_key(entity):
+        return ''
+
+    def do_check(self, entity):
+        performed.append(type(self).__name__)
+        self.entity_context['artifacts'].setdefault(type(self), {})['value'] = type(self).__name__
+        return self.message
+
+
+class NameCheck(FakeCheck):
+    pass
+
+
+class FailingCheck(FakeCheck):
+    message = 'failed'
+
+
+class DependsOnNameCheck(FakeCheck):
+    depends_on = [NameCheck]
+
+    def do_check(self, entity):
+        # Prerequisite is already performed, its artifacts are available
+        assert self.entity_context['artifacts'][NameCheck]['value'] == 'NameCheck'
+        return super(DependsOnNameCheck, self).do_check(entity)
+
+
+class DependsOnFailingCheck(FakeCheck):
+    depends_on = [FailingCheck]
+
+
+class WikiCheck(FakeCheck):
+    services = ['wikimedia']
+
+
+class DependsOnWikiCheck(FakeCheck):
+    depends_on = [WikiCheck]
+
+
+class SlowCheck(FakeCheck):
+    def do_check(self, entity):
+        raise DeadlineExceededException('deadline exceeded before request to wikimedia')
+
+
+class BatchNameCheck(FakeCheck):
+    batch_capable = True
+
+    def do_check(self, entity):
+        performed.append('BatchNameCheck.do_check')
+        return 'Name missing' if 'name' not in entity.tags else ''
+
+    def do_check_batch(self, chunk):
+        performed.append('BatchNameCheck.do_check_batch')
+        return [Result.CHECKED_OK if name else Result.CHECKED_ERROR for name in chunk.column('name')]
+
+
+class MissingLatinNameCheck(FakeCheck):
+    is_fixable = True
+    message = 'name:sr-Latn missing'
+    map_name = 'Serbia'
+
+    def fix(self, entity, api):
+        node = api.NodeGet(entity.id)
+        node['tag']['name:sr-Latn'] = 'Beograd'
+        api.NodeUpdate(node)
+        return 'name:sr-Latn added'
+
+
+class FixingOtherEntityCheck(MissingLatinNameCheck):
+    def fix(self, entity, api):
+        api.WayGet(entity.id)
+        return 'way fixed'
+
+
+class CycleCheck(FakeCheck):
+    pass
+
+
+class OtherCycleCheck(FakeCheck):
+    depends_on = [CycleCheck]
+
+
+CycleCheck.depends_on = [OtherCycleCheck]
+
+
+class TestCheckEngine(unittest.TestCase):
+    def setUp(self):
+        del performed[:]
+        self.entity = OsmLintEntity(StoredEntity(1, 1, 'node', {'place': 'city', 'name': 'Београд'}, 44.8, 20.4))
+        self.global_context = {'fix': False, 'dry_run': True, 'map-check': {'name': 'Serbia', 'suite': 'Serbia'}}
+
+    def test_order_checks(self):
+        self.assertEqual(order_checks((DependsOnNameCheck, NameCheck)), (NameCheck, DependsOnNameCheck))
+        self.assertRaises(CheckDependencyException, order_checks, (CycleCheck,))
+
+    def test_dependency_performed_once(self):
+        checks = CheckEngine([DependsOnNameCheck, NameCheck], self.entity, self.global_context).check_all()
+        self.assertEqual(performed, ['NameCheck', 'DependsOnNameCheck'])
+        self.assertEqual(checks['test_engine.DependsOnNameCheck']['result'], Result.CHECKED_OK)
+        self.assertEqual(checks['test_engine.NameCheck']['result'], Result.CHECKED_OK)
+
+    def test_dependency_not_in_suite(self):
+        checks = CheckEngine([DependsOnNameCheck], self.entity, self.global_context).check_all()
+        self.assertEqual(performed, ['NameCheck', 'DependsOnNameCheck'])
+        # Only checks from the suite are reported
+        self.assertEqual(list(checks.keys()), ['test_engine.DependsOnNameCheck'])
+
+    def test_dependency_not_satisfied(self):
+        engine = CheckEngine([DependsOnFailingCheck, FailingCheck], self.entity, self.global_context)
+        checks = engine.check_all()
+        self.assertEqual(performed, ['FailingCheck'])
+        self.assertEqual(checks['test_engine.FailingCheck']['result'], Result.CHECKED_ERROR)
+        self.assertNotIn('test_engine.DependsOnFailingCheck', checks)
+        checks = engine.check_all(filter_not_checked=False)
+        self.assertEqual(checks['test_engine.DependsOnFailingCheck']['result'], Result.DEPENDENCY_NOT_SATISFIED)
+
+    def test_service_unavailable(self):
+        directory = tempfile.mkdtemp()
+        circuit_breaker = http_client.CircuitBreaker(os.path.join(directory, 'circuit-breaker.db'), failures=1)
+        circuit_breaker.record('wikimedia', False)
+        http_client.set_circuit_breaker(circuit_breaker)
+        try:
+            checks = CheckEngine([DependsOnWikiCheck, WikiCheck, NameCheck], self.entity,
+                                 self.global_context).check_all()
+        finally:
+            http_client.set_circuit_breaker(None)
+            shutil.rmtree(directory)
+        self.assertEqual(performed, ['NameCheck'])
+        self.assertEqual(checks['test_engine.WikiCheck']['result'], Result.SKIPPED)
+        self.assertEqual(checks['test_engine.WikiCheck']['messages'], ['Skipped: wikimedia unavailable'])
+        # It is not known whether dependency would pass
+        self.assertEqual(checks['test_engine.DependsOnWikiCheck']['result'], Result.SKIPPED)
+        self.assertEqual(checks['test_engine.NameCheck']['result'], Result.CHECKED_OK)
+
+    def test_check_timeout(self):
+        checks = CheckEngine([SlowCheck], self.entity, dict(self.global_context, check_timeout=1)).check_all()
+        self.assertEqual(checks['test_engine.SlowCheck']['result'], Result.SKIPPED)
+        self.assertEqual(checks['test_engine.SlowCheck']['messages'],
+                         ['Skipped: deadline exceeded before request to wikimedia'])
+
+    def test_skipped_check_is_released(self):
+        directory = tempfile.mkdtemp()
+        try:
+            deduplicator = EntityDeduplicator(os.path.join(directory, 'deduplication.db'))
+            global_context = dict(self.global_context, check_timeout=1, deduplicator=deduplicator)
+            checks = CheckEngine([SlowCheck, NameCheck], self.entity, global_context).check_all()
+            self.assertEqual(checks['test_engine.SlowCheck']['result'], Result.SKIPPED)
+            # Other sources can try skipped check, but not the one which is done
+            self.assertEqual(deduplicator.claim([('Serbia', 'node', 1, 'test_engine.SlowCheck', ''),
+                                                 ('Serbia', 'node', 1, 'test_engine.NameCheck', '')]),
+                             {('Serbia', 'node', 1, 'test_engine.SlowCheck', '')})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_simulated_fix(self):
+        global_context = dict(self.global_context, fix=True, simulate=True, api=None)
+        checks = CheckEngine([MissingLatinNameCheck, FixingOtherEntityCheck, NameCheck], self.entity,
+                             global_context).check_all()
+        self.assertEqual(checks['test_engine.MissingLatinNameCheck']['simulated_fix'],
+                         [('name:sr-Latn', None, 'Beograd')])
+        # Other entities are not available locally, so fix is not simulated, but error is still reported
+        self.assertEqual(checks['test_engine.FixingOtherEntityCheck']['result'], Result.CHECKED_ERROR)
+        self.assertNotIn('simulated_fix', checks['test_engine.FixingOtherEntityCheck'])
+        self.assertNotIn('simulated_fix', checks['test_engine.NameCheck'])
+        # Entity itself is not changed
+        self.assertNotIn('name:sr-Latn', self.entity.tags)
+
+    def test_merge_skipped(self):
+        existing = {'a': {'result': Result.CHECKED_OK, 'messages': []},
+                    'b': {'result': Result.SKIPPED, 'messages': ['Skipped']}}
+        merge_checks(existing, {'a': {'result': Result.SKIPPED, 'messages': ['Skipped']},
+                                'b': {'result': Result.CHECKED_ERROR, 'messages': ['error']},
+                                'c': {'result': Result.SKIPPED, 'messages': ['Skipped']}})
+        self.assertEqual(existing['a']['result'], Result.CHECKED_OK)
+        self.assertEqual(existing['b']['result'], Result.CHECKED_ERROR)
+        self.assertEqual(existing['c']['result'], Result.SKIPPED)
+
+
+class TestCheckChunk(unittest.TestCase):
+    def setUp(self):
+        del performed[:]
+        self.global_context = {'fix': False, 'dry_run': True, 'map-check': {'name': 'Serbia', 'suite': 'Serbia'}}
+        self.entities = [
+            OsmLintEntity(StoredEntity(1, 1, 'node', {'place': 'city', 'name': 'Београд'}, 44.8, 20.4)),
+            OsmLintEntity(StoredEntity(2, 1, 'node', {'place': 'city'}, 45.2, 19.8)),
+            OsmLintEntity(StoredEntity(3, 1, 'node', {'amenity': 'pub'}, 45.2, 19.8)),
+        ]
+
+    def test_columns(self):
+        chunk = EntityChunk(self.entities)
+        self.assertEqual(chunk.ids, [1, 2, 3])
+        self.assertEqual(chunk.column('name'), ['Београд', None, None])
+        self.assertEqual(chunk.subset([1, 2]).column('place'), ['city', None])
+        self.assertIs(chunk.subset([0, 1, 2]), chunk)
+
+    def test_check_chunk(self):
+        checks = check_chunk([BatchNameCheck, NameCheck], self.entities, self.global_context)
+        # Batch check is done once for the chunk (only on applicable entities), and message is made only for error
+        self.assertEqual(performed, ['BatchNameCheck.do_check_batch', 'BatchNameCheck.do_check', 'NameCheck',
+                                     'NameCheck'])
+        self.assertEqual(checks[0]['test_engine.BatchNameCheck']['result'], Result.CHECKED_OK)
+        self.assertEqual(checks[1]['test_engine.BatchNameCheck']['result'], Result.CHECKED_ERROR)
+        self.assertEqual(checks[1]['test_engine.BatchNameCheck']['messages'], ['Name missing'])
+        self.assertEqual(checks[1]['test_engine.NameCheck']['result'], Result.CHECKED_OK)
+        self.assertEqual(checks[2], {})
+
+    def test_chunk_is_claimed_at_once(self):
+        directory = tempfile.mkdtemp()
+        try:
+            deduplicator = CountingDeduplicator(os.path.join(directory, 'deduplication.db'))
+            deduplicator.claim([('Serbia', 'node', 2, 'test_engine.NameCheck', '')])
+            global_context = dict(self.global_context, deduplicator=deduplicator)
+            deduplicator.claims = 0
+            checks = check_chunk([NameCheck], self.entities, global_context)
+            self.assertEqual(deduplicator.claims, 1)
+            # Second entity is already checked by someone else
+            self.assertEqual(performed, ['NameCheck'])
+            self.assertEqual(checks[0]['test_engine.NameCheck']['result'], Result.CHECKED_OK)
+            self.assertEqual(checks[1], {})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_batch_check_only_on_claimed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            deduplicator = EntityDeduplicator(os.path.join(directory, 'deduplication.db'))
+            deduplicator.claim([('Serbia', 'node', 2, 'test_engine.BatchNameCheck', '')])
+            checks = check_chunk([BatchNameCheck], self.entities, dict(self.global_context, deduplicator=deduplicator))
+            # Error on second entity is not looked at again, as it is already checked by someone else
+            self.assertEqual(performed, ['BatchNameCheck.do_check_batch'])
+            self.assertEqual(checks[0]['test_engine.BatchNameCheck']['result'], Result.CHECKED_OK)
+            self.assertEqual(checks[1], {})
+        finally:
+            shutil.rmtree(directory)
+
+
+class CountingDeduplicator(EntityDeduplicator):
+    claims = 0
+
+    def claim(self, keys, owner=None):
+        self.claims += 1
+        return super(CountingDeduplicator, self).claim(keys, owner)
+
+
+if __name__ == '__main__':
+    unittest.main()
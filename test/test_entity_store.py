@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from entity_store import EntityStoreWriter, read_entities, store_filename
+from osm_lint_entity import OsmLintEntity
+
+
+class TestEntityStore(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_write_and_read(self):
+        filename = store_filename(self.store_dir, 'abc', 'applicability.City;')
+        writer = EntityStoreWriter(filename, 'abc', 'applicability.City;')
+        writer.add('node', 1, 3, (44.5, 20.5), {'place': 'city', 'name': 'Београд'})
+        writer.add('way', 2, 1, None, {'highway': 'primary', 'name': 'Bulevar'})
+        writer.add('way', 3, 1, (44.8, 20.45), {'highway': 'primary', 'name': 'Njegoševa'})
+        self.assertFalse(os.path.isfile(filename))
+        writer.commit()
+
+        entities = sorted(read_entities(filename), key=lambda e: e.id)
+        self.assertEqual(len(entities), 3)
+        node = OsmLintEntity(entities[0])
+        self.assertEqual((node.id, node.entity_type, node.lat, node.lon), (1, 'node', 44.5, 20.5))
+        self.assertEqual(node.tags['name'], 'Београд')
+        self.assertEqual(entities[0].version, 3)
+
+        # Ways are not having location, same as when read from PBF
+        self.assertIsNone(OsmLintEntity.get_location(entities[1]))
+        self.assertEqual(OsmLintEntity.get_entity_type(entities[1]), 'way')
+        with self.assertRaises(AttributeError):
+            OsmLintEntity(entities[1])
+        # Centroid of way is kept, but it is still not entity with location
+        self.assertEqual(OsmLintEntity.get_location(entities[2]), (44.8, 20.45))
+        with self.assertRaises(AttributeError):
+            OsmLintEntity(entities[2])
+
+    def test_aborted_store_is_not_visible(self):
+        filename = store_filename(self.store_dir, 'abc', '')
+        writer = EntityStoreWriter(filename, 'abc', '')
+        writer.add('node', 1, 1, (44.5, 20.5), {})
+        writer.abort()
+        self.assertEqual(os.listdir(self.store_dir), [])
+
+    def test_store_filename_depends_on_signature(self):
+        self.assertNotEqual(store_filename(self.store_dir, 'abc', 'applicability.City;'),
+                            store_filename(self.store_dir, 'abc', 'applicability.Town;'))
+
+
+if __name__ == '__main__':
+    unittest.main()
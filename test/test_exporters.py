@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import simplejson
+
+from checkpoint import Checkpoints
+from engine import Result
+from entity_store import EntityStoreWriter, StoredEntity, store_filename
+from exporters import Export, combine
+from osm_lint_entity import OsmLintEntity
+from sources.store_source import StoreSource
+
+ERROR = {'result': Result.CHECKED_ERROR, 'messages': ['Нема name:sr', 'Second'], 'fixable': True}
+OK = {'result': Result.CHECKED_OK, 'messages': [], 'fixable': False}
+
+
+def entity(entity_id):
+    return OsmLintEntity(StoredEntity(entity_id, 1, 'node', {'name': 'Село {0}'.format(entity_id)}, 44.5, 20.5))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, parts):
+        """
+        Writes one part for each given list of entity ids, combines them and returns parsed outputs
+        """
+        filenames = []
+        for i, entity_ids in enumerate(parts):
+            part = {export_format: os.path.join(self.directory, '{0}.export.{1}'.format(i, export_format))
+                    for export_format in ('ndjson', 'csv', 'geojson')}
+            export = Export(part)
+            for entity_id in entity_ids:
+                export.write('Serbia (PBF)', entity(entity_id), {'checks.A': ERROR, 'checks.B': OK})
+            export.close()
+            filenames.append(part)
+        outputs = {}
+        for export_format in ('ndjson', 'csv', 'geojson'):
+            filename = os.path.join(self.directory, 'errors.' + export_format)
+            combine(export_format, [part[export_format] for part in filenames] + ['missing'], filename)
+            with open(filename, encoding='utf-8', newline='') as f:
+                outputs[export_format] = f.read()
+        return outputs
+
+    def test_formats(self):
+        outputs = self.export([[1, 2], [], [3]])
+
+        records = [simplejson.loads(line) for line in outputs['ndjson'].splitlines()]
+        self.assertEqual([r['entity_id'] for r in records], [1, 2, 3])
+        self.assertEqual(records[0], {'map': 'Serbia (PBF)', 'entity_type': 'node', 'entity_id': 1,
+                                      'name': 'Село 1', 'lat': 44.5, 'lon': 20.5, 'check': 'checks.A',
+                                      'result': 'error', 'fixable': True, 'messages': ['Нема name:sr', 'Second']})
+
+        rows = list(csv.DictReader(outputs['csv'].splitlines()))
+        self.assertEqual([r['entity_id'] for r in rows], ['1', '2', '3'])
+        self.assertEqual(rows[2]['messages'], 'Нема name:sr; Second')
+
+        features = simplejson.loads(outputs['geojson'])['features']
+        self.assertEqual([f['id'] for f in features], ['node/1', 'node/2', 'node/3'])
+        self.assertEqual(features[0]['geometry'], {'type': 'Point', 'coordinates': [20.5, 44.5]})
+        self.assertEqual(features[0]['properties']['check'], 'checks.A')
+
+    def test_sophox_location(self):
+        filename = os.path.join(self.directory, 'part.geojson')
+        sophox_entity = OsmLintEntity({'id': {'value': 'https://www.openstreetmap.org/node/5'},
+                                       'loc': {'value': 'Point(20.45 44.8)'}, 'name': {'value': 'Београд'},
+                                       'metadata': {}})
+        export = Export({'geojson': filename})
+        export.write('Serbia (Sophox)', sophox_entity, {'checks.A': ERROR})
+        export.close()
+        output = os.path.join(self.directory, 'errors.geojson')
+        combine('geojson', [filename], output)
+        with open(output, encoding='utf-8') as f:
+            feature = simplejson.load(f)['features'][0]
+        self.assertEqual(feature['geometry'], {'type': 'Point', 'coordinates': [20.45, 44.8]})
+
+    def test_empty(self):
+        outputs = self.export([[]])
+        self.assertEqual(outputs['ndjson'], '')
+        self.assertEqual(len(list(csv.DictReader(outputs['csv'].splitlines()))), 0)
+        self.assertEqual(simplejson.loads(outputs['geojson'])['features'], [])
+
+    def test_resume_cuts_part(self):
+        filename = os.path.join(self.directory, 'part.ndjson')
+        export = Export({'ndjson': filename})
+        export.write('Serbia', entity(1), {'checks.A': ERROR})
+        offsets = export.tell()
+        export.write('Serbia', entity(2), {'checks.A': ERROR})
+        export.close()
+
+        # Entity 2 was written after checkpoint, it is checked (and written) again
+        export = Export({'ndjson': filename})
+        export.resume(offsets)
+        export.write('Serbia', entity(2), {'checks.A': ERROR})
+        export.close()
+        with open(filename, encoding='utf-8') as f:
+            self.assertEqual([simplejson.loads(line)['entity_id'] for line in f], [1, 2])
+
+
+class TestSourceExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = store_filename(self.directory, 'abc', '')
+        writer = EntityStoreWriter(self.filename, 'abc', '')
+        for i in range(1, 11):
+            writer.add('node', i, 1, (44.0, 20.5), {'place': 'village', 'name': 'Село {0}'.format(i)})
+        writer.commit()
+        self.checkpoints = Checkpoints(self.directory, {})
+        self.map_checks = [{'name': 'Store', 'location': self.filename, 'checks': [], 'rules': []}]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_are_only_exported(self):
+        def process_entities(entities, _):
+            return [{'checks.A': ERROR if entity.id % 2 == 0 else OK} for entity in entities]
+        context = {'checkpoints': self.checkpoints, 'exports': {'ndjson': 'errors.ndjson'}, 'keep_results': False,
+                   'check_chunk_size': 3}
+        source = StoreSource(context, process_entities, self.map_checks, self.filename)
+        self.assertEqual(source.process_map(), {'Store': {}})
+        with open(self.checkpoints.export_filename(self.map_checks, 'ndjson'), encoding='utf-8') as f:
+            self.assertEqual([simplejson.loads(line)['entity_id'] for line in f], [2, 4, 6, 8, 10])
+
+        # Parts are removed together with checkpoints
+        self.checkpoints.clear()
+        self.assertFalse(os.path.exists(self.checkpoints.export_filename(self.map_checks, 'ndjson')))
+
+
+if __name__ == '__main__':
+    unittest.main()
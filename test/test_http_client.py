@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import http.server
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+import http_client
+from exceptions import DeadlineExceededException, ServiceUnavailableException
+from http_client import CircuitBreaker, RateLimiter
+
+
+class FlakyRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in for overloaded service. "/flaky" fails first time, "/slow" is slow first time, "/down" always
+    fails.
+    """
+    requests = []
+
+    def do_GET(self):
+        FlakyRequestHandler.requests.append(self.path)
+        first = FlakyRequestHandler.requests.count(self.path) == 1
+        if (self.path == '/flaky' and first) or self.path == '/down':
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/slow' and first:
+            time.sleep(2)
+        body = 'first' if first else 'second'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'rate-limiter.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_burst_and_rate(self):
+        rate_limiter = RateLimiter(self.filename, {'sophox': (20.0, 2)})
+        start = time.time()
+        for _ in range(4):
+            rate_limiter.acquire('sophox')
+        # Two requests are in burst, other two have to wait 1/20 s each
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_unknown_service_is_not_limited(self):
+        rate_limiter = RateLimiter(self.filename, {'sophox': (0.001, 1)})
+        start = time.time()
+        for _ in range(10):
+            rate_limiter.acquire(None)
+            rate_limiter.acquire('wikimedia')
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        rate_limiter = RateLimiter(self.filename, {'sophox': (0.1, 1)})
+        self.assertTrue(rate_limiter.acquire('sophox', 1))
+        start = time.time()
+        # Next token is 10 s away, it is not waited for
+        self.assertFalse(rate_limiter.acquire('sophox', 1))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_throttled_request_is_not_waiting_over_deadline(self):
+        rate_limiter = RateLimiter(self.filename, {'wikimedia': (0.1, 1)})
+        http_client.set_rate_limiter(rate_limiter)
+        try:
+            with http_client.deadline(1):
+                session = http_client.mount(requests.Session())
+                rate_limiter.acquire('wikimedia')
+                start = time.time()
+                self.assertRaises(DeadlineExceededException, session.get, 'https://sr.wikipedia.org/')
+                self.assertLess(time.time() - start, 0.5)
+        finally:
+            http_client.set_rate_limiter(None)
+
+    def test_bucket_is_shared_between_copies(self):
+        # This is how rate limiter ends up in other processes
+        rate_limiter = RateLimiter(self.filename, {'osm': (1.0, 1)})
+        other = pickle.loads(pickle.dumps(rate_limiter))
+        rate_limiter.acquire('osm')
+        self.assertGreater(other._take('osm', 1.0, 1), 0.9)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'circuit-breaker.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_opens_after_failures_in_row(self):
+        circuit_breaker = CircuitBreaker(self.filename, failures=3, cooldown=60)
+        circuit_breaker.record('sophox', False)
+        circuit_breaker.record('sophox', False)
+        circuit_breaker.record('sophox', True)
+        circuit_breaker.record('sophox', False)
+        circuit_breaker.record('sophox', False)
+        self.assertTrue(circuit_breaker.is_available('sophox'))
+        circuit_breaker.record('sophox', False)
+        self.assertFalse(circuit_breaker.is_available('sophox'))
+        self.assertTrue(circuit_breaker.is_available('wikimedia'))
+        self.assertTrue(circuit_breaker.is_available(None))
+
+    def test_closes_after_cooldown(self):
+        circuit_breaker = CircuitBreaker(self.filename, failures=1, cooldown=0.1)
+        circuit_breaker.record('osm', False)
+        self.assertFalse(circuit_breaker.is_available('osm'))
+        time.sleep(0.15)
+        self.assertTrue(circuit_breaker.is_available('osm'))
+
+    def test_state_is_shared_between_copies(self):
+        circuit_breaker = CircuitBreaker(self.filename, failures=1, cooldown=60)
+        other = pickle.loads(pickle.dumps(circuit_breaker))
+        circuit_breaker.record('wikimedia', False)
+        self.assertFalse(other.is_available('wikimedia'))
+
+
+class TestRequest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyRequestHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{0}'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FlakyRequestHandler.requests = []
+        self.backoff_base = http_client.BACKOFF_BASE
+        http_client.BACKOFF_BASE = 0.01
+
+    def tearDown(self):
+        http_client.BACKOFF_BASE = self.backoff_base
+
+    def test_service_for(self):
+        self.assertEqual(http_client.service_for('https://download.geofabrik.de/europe/serbia.poly'), 'geofabrik')
+        self.assertEqual(http_client.service_for('https://sr.wikipedia.org/w/api.php'), 'wikimedia')
+        self.assertEqual(http_client.service_for('https://api.openstreetmap.org/api/0.6/node/1'), 'osm')
+        self.assertIsNone(http_client.service_for('https://notgeofabrik.de/'))
+
+    def test_retry(self):
+        r = http_client.request('GET', self.url + '/flaky')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(FlakyRequestHandler.requests, ['/flaky', '/flaky'])
+
+    def test_no_more_attempts(self):
+        r = http_client.request('GET', self.url + '/flaky', attempts=1)
+        self.assertEqual(r.status_code, 503)
+
+    def test_hedged_request(self):
+        start = time.time()
+        r = http_client.request('GET', self.url + '/slow', hedge_after=0.2)
+        self.assertEqual(r.text, 'second')
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(FlakyRequestHandler.requests, ['/slow', '/slow'])
+
+    def test_host_override(self):
+        http_client.set_host_overrides({'sophox.org': self.url})
+        try:
+            r = http_client.request('GET', 'https://sophox.org/flaky')
+        finally:
+            http_client.set_host_overrides({})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(FlakyRequestHandler.requests, ['/flaky', '/flaky'])
+
+    def test_circuit_breaker(self):
+        directory = tempfile.mkdtemp()
+        http_client.set_circuit_breaker(CircuitBreaker(os.path.join(directory, 'circuit-breaker.db'), failures=2))
+        http_client.set_host_overrides({'sophox.org': self.url})
+        try:
+            r = http_client.request('GET', 'https://sophox.org/down', attempts=2)
+            self.assertEqual(r.status_code, 503)
+            self.assertFalse(http_client.is_available('sophox'))
+            # Service is not asked anymore
+            self.assertRaises(ServiceUnavailableException, http_client.request, 'GET', 'https://sophox.org/flaky')
+            self.assertEqual(FlakyRequestHandler.requests, ['/down', '/down'])
+        finally:
+            http_client.set_host_overrides({})
+            http_client.set_circuit_breaker(None)
+            shutil.rmtree(directory)
+
+    def test_deadline(self):
+        start = time.time()
+        with http_client.deadline(0.3):
+            # Timeout of request is shortened to what is left until deadline
+            self.assertRaises(Exception, http_client.request, 'GET', self.url + '/slow', attempts=1, timeout=10)
+            self.assertLess(time.time() - start, 1.5)
+            time.sleep(0.3)
+            self.assertRaises(DeadlineExceededException, http_client.request, 'GET', self.url + '/flaky')
+        self.assertIsNone(http_client.remaining_time())
+        self.assertEqual(FlakyRequestHandler.requests, ['/slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
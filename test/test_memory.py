@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import tracemalloc
+import unittest
+
+from memory import MemoryProfiler
+
+
+class TestMemoryProfiler(unittest.TestCase):
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def test_stages(self):
+        profiler = MemoryProfiler('Serbia', use_tracemalloc=True)
+        profiler.mark('download')
+        data = [bytearray(1024) for _ in range(1000)]
+        profiler.mark('read')
+        result = profiler.to_json()
+
+        self.assertEqual([s['stage'] for s in result['stages']], ['download', 'read'])
+        self.assertGreater(result['peak_rss'], 0)
+        read = result['stages'][1]
+        self.assertGreaterEqual(read['traced'] - result['stages'][0]['traced'], 1000 * 1024)
+        # Biggest allocation site is the one above
+        self.assertIn('test_memory.py', read['top_allocations'][0]['site'])
+        self.assertEqual(len(data), 1000)
+
+    def test_within(self):
+        profiler = MemoryProfiler('Serbia')
+        with profiler.within('check'):
+            data = bytearray(64 * 1024 * 1024)
+            data[::4096] = b'x' * len(data[::4096])
+            del data
+        profiler.mark('read')
+        profiler.mark('check')
+        read, check = profiler.to_json()['stages']
+        # Memory used while checking is not accounted to reading (where process peak is not reset, all stages have it)
+        self.assertGreaterEqual(check['stage_peak_rss'], read['stage_peak_rss'])
+        self.assertGreaterEqual(check['stage_peak_rss'], 64 * 1024 * 1024)
+        self.assertEqual(check['peak_rss'], max(read['stage_peak_rss'], check['stage_peak_rss']))
+
+
+if __name__ == '__main__':
+    unittest.main()
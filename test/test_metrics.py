@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+import urllib.request
+
+import metrics
+from metrics import MetricsExporter, MetricsStore
+
+
+def _worker(store):
+    # Each worker gets its own copy of the store, as it does in process pool
+    metrics.set_metrics_store(store)
+    metrics.inc('entities_processed_total', 10, map='Serbia')
+    metrics.inc('api_requests_total', service='sophox')
+    metrics.flush()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = MetricsStore(os.path.join(self.tmp_dir, 'metrics.db'), interval=3600)
+
+    def tearDown(self):
+        metrics.set_metrics_store(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        # Nothing happens if metrics are not collected
+        metrics.inc('api_requests_total', service='osm')
+        metrics.gauge('queue_depth', 1, queue='check')
+
+    def test_aggregated_across_processes(self):
+        processes = [multiprocessing.get_context('spawn').Process(target=_worker, args=(pickle.loads(
+            pickle.dumps(self.store)),)) for _ in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        metrics.set_metrics_store(self.store)
+        metrics.inc('entities_processed_total', 5, map='Serbia')
+        metrics.flush()
+
+        values = self.store.read()
+        self.assertEqual(values[('entities_processed_total', (('map', 'Serbia'),))], 25)
+        self.assertEqual(values[('api_requests_total', (('service', 'sophox'),))], 2)
+
+    def test_flushed_only_after_interval(self):
+        self.store.inc('entities_processed_total', 1, map='Serbia')
+        self.assertEqual(self.store.read(), {})
+        self.store.flush()
+        self.assertEqual(len(self.store.read()), 1)
+
+    def test_gauge_is_last_value_set(self):
+        # Map processed by other worker in the next run
+        other_store = pickle.loads(pickle.dumps(self.store))
+        self.store.set('progress', 1.0, map='Serbia', stage='read')
+        self.store.flush()
+        self.store.clear_gauges()
+        self.assertEqual(self.store.read(), {})
+        other_store.set('progress', 0.25, map='Serbia', stage='read')
+        other_store.flush()
+        # First worker is not writing its old gauge again
+        self.store.inc('entities_processed_total', 1, map='Serbia')
+        self.store.flush()
+        self.assertEqual(self.store.read()[('progress', (('map', 'Serbia'), ('stage', 'read')))], 0.25)
+
+    def test_render(self):
+        text = metrics.render({('queue_depth', (('map', 'Serbia "1"'), ('queue', 'check'))): 3,
+                               ('api_requests_total', (('service', 'osm'),)): 7})
+        self.assertIn('# TYPE serbian_osm_lint_api_requests_total counter', text)
+        self.assertIn('# TYPE serbian_osm_lint_queue_depth gauge', text)
+        self.assertIn('serbian_osm_lint_api_requests_total{service="osm"} 7\n', text)
+        self.assertIn('serbian_osm_lint_queue_depth{map="Serbia \\"1\\"",queue="check"} 3\n', text)
+
+    def test_exporter(self):
+        textfile = os.path.join(self.tmp_dir, 'metrics.prom')
+        exporter = MetricsExporter(self.store, textfile=textfile, port=0, interval=3600)
+        exporter.start()
+        try:
+            self.store.inc('entities_processed_total', 100, map='Serbia')
+            self.store.set('progress', 0.25, map='Serbia', stage='download')
+            exporter.export()
+            time.sleep(0.1)
+            self.store.inc('entities_processed_total', 100, map='Serbia')
+            self.store.set('progress', 0.5, map='Serbia', stage='download')
+            exporter.export()
+
+            with open(textfile, 'r', encoding='utf-8') as f:
+                text = f.read()
+            self.assertIn('serbian_osm_lint_entities_processed_total{map="Serbia"} 200\n', text)
+            self.assertIn('serbian_osm_lint_entities_per_second{map="Serbia"}', text)
+            self.assertIn('serbian_osm_lint_eta_seconds{map="Serbia",stage="download"}', text)
+
+            url = 'http://127.0.0.1:{0}/metrics'.format(exporter.server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode('utf-8'), text)
+        finally:
+            exporter.stop()
+
+
+    def test_eta_of_stage_started_again(self):
+        exporter = MetricsExporter(self.store)
+        labels = (('map', 'Serbia'), ('stage', 'read'))
+        exporter._derive({('progress', labels): 0.5})
+        exporter._derive({('progress', labels): 1.0})
+        # Next run starts from scratch, ETA is not measured from the start of the previous one
+        exporter._derive({})
+        self.assertNotIn(('eta_seconds', labels), exporter._derive({('progress', labels): 0.1}))
+        self.assertIn(('eta_seconds', labels), exporter._derive({('progress', labels): 0.2}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from engine import Result
+from entity_store import EntityStoreWriter, StoredEntity, read_entities, store_filename
+from osm_lint_entity import OsmLintEntity
+from rules import AddingNameRule, AddingNameSrRule, to_sophox_result
+from sources.osm_source import OSMSource
+from sources.pbf_source import PBFSource
+from sources.source_factory import SourceFactory, group_by_location
+
+
+def process_entities(entities, _):
+    return [{'check': {'result': Result.CHECKED_ERROR, 'messages': [entity.entity_type], 'fixable': False}}
+            for entity in entities]
+
+
+class TestOSMSource(unittest.TestCase):
+    def test_same_id_of_other_type(self):
+        source = OSMSource({}, [{'name': 'Serbia', 'checks': []}], process_entities)
+        node = OsmLintEntity(StoredEntity(5, 1, 'node', {'name': 'Ниш'}, 43.3, 21.9))
+        way = OsmLintEntity(to_sophox_result('way', 5, (44.8, 20.45), 'Ниш', [('name:sr', 'Ниш')],
+                                             AddingNameRule().metadata()))
+        for entity in (node, way):
+            source._check_entity(entity, source.contexts[0])
+        source._check_pending(source.contexts[0])
+        all_checks = source.all_checks['Serbia']
+        self.assertEqual(sorted(all_checks), [('node', 5), ('way', 5)])
+        self.assertEqual(all_checks[('way', 5)][2]['check']['messages'], ['way'])
+
+
+class Region(object):
+    def __init__(self, bbox):
+        self.bbox = bbox
+
+    def contains(self, lat, lon):
+        return self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3]
+
+
+class CountingPBFSource(PBFSource):
+    wrapped = 0
+
+    def _wrap(self, raw_entity):
+        self.wrapped += 1
+        return super(CountingPBFSource, self)._wrap(raw_entity)
+
+
+class TestPBFSource(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entity_is_made_once(self):
+        map_checks = [{'name': 'Serbia', 'location': 'serbia.osm.pbf', 'checks': [], 'rules': [AddingNameRule]}]
+        source = CountingPBFSource({}, process_entities, map_checks, 'serbia.osm.pbf')
+        filename = store_filename(self.directory, 'abc', source._store_signature())
+        source.store_writer = EntityStoreWriter(filename, 'abc', source._store_signature())
+        for raw_entity in (StoredEntity(1, 1, 'node', {'name:sr': 'Ниш', 'place': 'city'}, 43.3, 21.9),
+                           StoredEntity(2, 1, 'node', {'amenity': 'pub'}, 43.3, 21.9),
+                           StoredEntity(3, 1, 'way', {'name:sr': 'Ниш', 'place': 'city'})):
+            source._entity_found(raw_entity)
+        source.store_writer.commit()
+        self.assertEqual(source.wrapped, 3)
+        # Only entities rule could match are stored
+        self.assertEqual([e.id for e in read_entities(filename)], [1, 3])
+
+    def test_rule_result_on_way(self):
+        map_checks = [{'name': 'Serbia', 'location': 'serbia.osm.pbf', 'checks': [], 'rules': [AddingNameSrRule]},
+                      {'name': 'Vojvodina', 'location': 'serbia.osm.pbf', 'checks': [], 'rules': [AddingNameSrRule],
+                       'region': Region((45.0, 19.0, 46.2, 21.6))}]
+        source = PBFSource({}, process_entities, map_checks, 'serbia.osm.pbf')
+        source._entity_found(StoredEntity(7, 1, 'way', {'name': 'Njegoševa', 'highway': 'residential'}, 44.8, 20.45))
+        source._entity_found(StoredEntity(8, 1, 'way', {'name': 'Bulevar', 'highway': 'primary'}))
+        for context in source.contexts:
+            source._check_pending(context)
+        # Way is put on the map, as it is in Sophox, so it is checked where it belongs
+        self.assertEqual(list(source.all_checks['Serbia']), [('way', 7)])
+        self.assertEqual(source.all_checks['Vojvodina'], {})
+        # Way without location (read with osmread) is only counted
+        self.assertEqual(source.unlocated, 2)
+
+
+class TestMapCheckGroups(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = store_filename(self.directory, 'abc', '')
+        writer = EntityStoreWriter(self.filename, 'abc', '')
+        for i in range(1, 4):
+            writer.add('node', i, 1, (44.0, 20.5), {'place': 'village', 'name': 'Село {0}'.format(i)})
+        writer.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_suites_sharing_extract(self):
+        map_checks = [{'name': 'Names (Serbia)', 'suite': 'Names', 'location': self.filename, 'checks': []},
+                      {'name': 'Other (Belgrade)', 'suite': 'Other', 'location': os.path.join(self.directory, 'b.db'),
+                       'checks': []},
+                      {'name': 'Wiki (Serbia)', 'suite': 'Wiki', 'location': self.filename, 'checks': []}]
+        groups = group_by_location(map_checks)
+        self.assertEqual([[map_check['name'] for map_check in group] for group in groups],
+                         [['Names (Serbia)', 'Wiki (Serbia)'], ['Other (Belgrade)']])
+
+        checked = []
+
+        def process_entities(entities, context):
+            suite = context['map-check']['suite']
+            checked.extend((suite, entity.id) for entity in entities)
+            return [{suite: {'result': Result.CHECKED_ERROR, 'messages': [], 'fixable': False}} for _ in entities]
+        source = SourceFactory(process_entities, {}).create_source(groups[0])
+        all_checks = source.process_map()
+        # Store is read once, and each entity is checked in both suites
+        self.assertEqual(source.processed, 3)
+        self.assertEqual(sorted(checked), [(suite, i) for suite in ('Names', 'Wiki') for i in range(1, 4)])
+        self.assertEqual(sorted(all_checks), ['Names (Serbia)', 'Wiki (Serbia)'])
+        for name, suite in (('Names (Serbia)', 'Names'), ('Wiki (Serbia)', 'Wiki')):
+            self.assertEqual(sorted(all_checks[name]), [('node', i) for i in range(1, 4)])
+            self.assertEqual([list(checks) for _, _, checks in all_checks[name].values()], [[suite]] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from regions import parse_poly, region_location
+
+POLY = """serbia
+1
+   1.9E+01   4.2E+01
+   2.3E+01   4.2E+01
+   2.3E+01   4.6E+01
+   1.9E+01   4.6E+01
+END
+!2
+   2.0E+01   4.3E+01
+   2.1E+01   4.3E+01
+   2.1E+01   4.4E+01
+   2.0E+01   4.4E+01
+END
+3
+   2.5E+01   4.0E+01
+   2.6E+01   4.0E+01
+   2.55E+01  4.1E+01
+END
+END
+"""
+
+
+class TestRegions(unittest.TestCase):
+    def test_contains(self):
+        region = parse_poly(POLY)
+        self.assertEqual(region.name, 'serbia')
+        self.assertTrue(region.contains(45.0, 20.0))
+        self.assertTrue(region.contains(42.5, 22.9))
+        # Outside of bounding box
+        self.assertFalse(region.contains(47.0, 20.0))
+        # In hole
+        self.assertFalse(region.contains(43.5, 20.5))
+        # In second polygon
+        self.assertTrue(region.contains(40.2, 25.5))
+        self.assertFalse(region.contains(40.9, 25.1))
+
+    def test_region_location(self):
+        self.assertEqual(region_location('https://download.geofabrik.de/europe/serbia-latest.osm.pbf'),
+                         'https://download.geofabrik.de/europe/serbia.poly')
+        self.assertIsNone(region_location('serbia.osm.pbf'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import registry
+from rules import AddingNameRule
+
+
+class TestRegistry(unittest.TestCase):
+    def test_resolve(self):
+        self.assertIs(registry.resolve('rules.AddingNameRule'), AddingNameRule)
+        self.assertEqual(registry.name_of(registry.resolve('rules.AddingNameRule')), 'rules.AddingNameRule')
+
+    def test_resolve_unknown(self):
+        self.assertRaises(ValueError, registry.resolve, 'AddingNameRule')
+        self.assertRaises(ValueError, registry.resolve, 'rules.NoSuchRule')
+        self.assertRaises(ValueError, registry.resolve, 'no_such_module.NoSuchRule')
+
+
+if __name__ == '__main__':
+    unittest.main()
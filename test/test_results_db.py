@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from engine import Result
+from results_db import ResultsDatabase, map_of
+
+
+def error(message):
+    return {'result': Result.CHECKED_ERROR, 'messages': [message], 'fixable': False}
+
+
+OK = {'result': Result.CHECKED_OK, 'messages': [], 'fixable': False}
+SKIPPED = {'result': Result.SKIPPED, 'messages': ['Skipped: wikimedia unavailable'], 'fixable': False}
+
+
+class TestResultsDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.results_db = ResultsDatabase(os.path.join(self.directory, 'results.db'))
+
+    def tearDown(self):
+        self.results_db.close()
+        shutil.rmtree(self.directory)
+
+    def add_run(self, all_checks, incomplete=None, options=None):
+        run = self.results_db.start_run(options or {})
+        self.results_db.add_results(run, all_checks, incomplete)
+        return run
+
+    def test_map_of(self):
+        self.assertEqual(map_of('Serbia (Sophox)'), 'Serbia')
+        self.assertEqual(map_of('Serbia'), 'Serbia')
+
+    def test_errors(self):
+        run = self.add_run({'Serbia (PBF)': {
+            ('node', 1): ('Београд', 'node', {'a': error('no name:sr'), 'b': OK}),
+            ('way', 2): ('Ниш', 'way', {'a': SKIPPED, 'b': error('no wikidata')})}})
+        self.assertEqual(self.results_db.errors(), [('Serbia', 'a', 'node', 1, 'Београд', ['no name:sr']),
+                                                    ('Serbia', 'b', 'way', 2, 'Ниш', ['no wikidata'])])
+        self.assertEqual(len(self.results_db.errors(run, check_name='b')), 1)
+        self.assertEqual(len(self.results_db.errors(map_name='Serbia', entity=('node', 1))), 1)
+        self.assertEqual(self.results_db.errors(map_name='Montenegro'), [])
+
+    def test_changes(self):
+        previous = self.add_run({
+            'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')}),
+                             ('node', 2): ('B', 'node', {'a': error('2')}),
+                             ('node', 3): ('C', 'node', {'a': error('3')})},
+            'Montenegro (PBF)': {('node', 9): ('Z', 'node', {'a': error('9')})}})
+        # Error on entity 3 is found by other source now, it is still the same error
+        run = self.add_run({
+            'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')}),
+                             ('node', 4): ('D', 'node', {'a': error('4')}),
+                             ('node', 5): ('E', 'node', {'a': SKIPPED})},
+            'Serbia (Sophox)': {('node', 3): ('C', 'node', {'a': error('3')})}})
+        self.assertEqual(self.results_db.previous_run(run)[0], previous)
+
+        changes = self.results_db.changes(run, previous)
+        self.assertEqual(changes['new'], {('Serbia', 'a', 'node', 4)})
+        self.assertEqual(changes['resolved'], [('Serbia', 'a', 'node', 2, 'B', ['2'])])
+        self.assertEqual(changes['count_persistent'], 2)
+        # Montenegro is not processed now, so its errors are not resolved
+        self.assertEqual(changes['maps'], {'Serbia': {'new': 1, 'resolved': 1, 'persistent': 2}})
+        self.assertEqual(changes['check_types'], {'a': {'new': 1, 'resolved': 1, 'persistent': 2}})
+
+    def test_incomplete_map_is_not_resolving_errors(self):
+        previous = self.add_run({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')})}})
+        run = self.add_run({'Serbia (PBF)': {}}, incomplete={'Serbia (Sophox)': 'failed: timeout'})
+        self.assertEqual(self.results_db.changes(run, previous)['resolved'], [])
+
+        # ...nor making all errors new in the next run
+        after = self.add_run({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')}),
+                                               ('node', 2): ('B', 'node', {'a': error('2')})}})
+        self.assertEqual(self.results_db.changes(after, run)['new'], set())
+
+    def test_skipped_check_is_not_resolving_error(self):
+        previous = self.add_run({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error('1')})}})
+        run = self.add_run({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': SKIPPED})}})
+        changes = self.results_db.changes(run, previous)
+        self.assertEqual(changes['count_resolved'], 0)
+        self.assertEqual(changes['count_new'], 0)
+
+    def test_previous_run_with_same_options(self):
+        full = self.add_run({}, options={'limit': None})
+        self.add_run({}, options={'limit': 100})
+        # Run which did not finish is never compared with
+        self.results_db.start_run({'limit': None})
+        run = self.add_run({}, options={'limit': None})
+        self.assertEqual(self.results_db.previous_run(run)[0], full)
+        self.assertIsNone(self.results_db.previous_run(full))
+
+    def test_prune(self):
+        runs = [self.add_run({'Serbia (PBF)': {('node', 1): ('A', 'node', {'a': error(str(i))})}}) for i in range(5)]
+        self.results_db.prune(2)
+        self.assertEqual(self.results_db.errors(runs[2]), [])
+        self.assertEqual(len(self.results_db.errors(runs[3])), 1)
+        self.assertEqual(self.results_db.previous_run(runs[4])[0], runs[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
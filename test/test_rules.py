@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from entity_store import StoredEntity
+from osm_lint_entity import OsmLintEntity
+from rules import AddingNameRule, ChangingNameSrToCyrillicRule, AddingNameSrRule, CheckingNameSrLatnRule
+from rules import AddingIntNameRule, evaluate_rules, to_sophox_result
+from transliteration import lat2cyr, lat2ascii
+
+
+class Location(object):
+    def __init__(self, lat, lon):
+        self.lat, self.lon = lat, lon
+
+    def valid(self):
+        return self.lat is not None
+
+
+class NodeRef(object):
+    def __init__(self, location):
+        self.location = location
+
+
+class Way(object):
+    tags = ()
+
+    def __init__(self, locations):
+        self.nodes = [NodeRef(location) for location in locations]
+
+
+class TestTransliteration(unittest.TestCase):
+    def test_lat2cyr(self):
+        self.assertEqual(lat2cyr('Njegoševa'), 'Његошева')
+        self.assertEqual(lat2cyr('DŽAKARTA'), 'ЏАКАРТА')
+        self.assertEqual(lat2cyr('Ljubljana 2'), 'Љубљана 2')
+
+    def test_lat2ascii(self):
+        self.assertEqual(lat2ascii('Đurđevo'), 'Djurdjevo')
+        self.assertEqual(lat2ascii('Čačak'), 'Cacak')
+
+
+class TestRules(unittest.TestCase):
+    def test_adding_name_rule(self):
+        rule = AddingNameRule()
+        self.assertEqual(rule.evaluate({'name:sr': 'фоо', 'place': 'village'}), ('фоо', [('name', 'фоо')]))
+        self.assertIsNone(rule.evaluate({'name:sr': 'фоо', 'name': 'фоо', 'place': 'village'}))
+        self.assertIsNone(rule.evaluate({'name:sr': 'фоо', 'amenity': 'cafe'}))
+
+    def test_changing_name_sr_to_cyrillic_rule(self):
+        rule = ChangingNameSrToCyrillicRule()
+        self.assertEqual(rule.evaluate({'name:sr': 'Bulevar', 'highway': 'primary'}),
+                         ('Bulevar', [('name:sr', 'Булевар')]))
+        self.assertIsNone(rule.evaluate({'name:sr': 'Булевар', 'highway': 'primary'}))
+
+    def test_adding_name_sr_rule(self):
+        rule = AddingNameSrRule()
+        self.assertEqual(rule.evaluate({'name': 'Njegoševa', 'highway': 'residential'}),
+                         ('Njegoševa', [('name:sr', 'Његошева')]))
+        self.assertIsNone(rule.evaluate({'name': 'Washington street', 'highway': 'residential'}))
+        self.assertIsNone(rule.evaluate({'name': 'Његошева', 'highway': 'residential'}))
+
+    def test_checking_name_sr_latn_rule(self):
+        rule = CheckingNameSrLatnRule()
+        self.assertEqual(rule.evaluate({'name': 'Ниш', 'name:sr': 'Ниш'}), ('Ниш', [('name:sr-Latn', 'Niš')]))
+        self.assertIsNone(rule.evaluate({'name': 'Ниш', 'name:sr': 'Ниш', 'name:sr-Latn': 'Niš'}))
+        self.assertEqual(rule.evaluate({'name': 'Ниш', 'name:sr': 'Ниш', 'name:sr-Latn': 'Nis'}),
+                         ('Ниш', [('name:sr-Latn', 'Niš')]))
+        # If there is no latin name, it is suggested only if local name is in cyrillic
+        self.assertIsNone(rule.evaluate({'name': 'Niš', 'name:sr': 'Ниш'}))
+
+    def test_adding_int_name_rule(self):
+        rule = AddingIntNameRule()
+        self.assertEqual(rule.evaluate({'name:sr-Latn': 'Đurđevo'}), ('Đurđevo', [('int_name', 'Djurdjevo')]))
+        self.assertIsNone(rule.evaluate({'name:sr-Latn': 'Đurđevo', 'int_name': 'Djurdjevo'}))
+        self.assertIsNone(rule.evaluate({'name:sr-Latn': 'Niš'}))
+
+    def test_to_sophox_result(self):
+        result = to_sophox_result('way', 123, (44.5, 20.5), 'foo', [('name:sr', 'фоо')], AddingNameRule().metadata())
+        self.assertEqual(result['id']['value'], 'https://www.openstreetmap.org/way/123')
+        self.assertEqual(result['loc']['value'], 'Point(20.5 44.5)')
+        self.assertEqual(result['name']['value'], 'foo')
+        self.assertEqual(result['tag_1']['value'], 'name:sr')
+        self.assertEqual(result['val_1']['value'], 'фоо')
+        self.assertNotIn('tag_2', result)
+        self.assertEqual(result['metadata']['check_description'], 'Entity {0} is missing name tag')
+
+    def test_to_sophox_result_location(self):
+        result = to_sophox_result('node', 123, (44.8, 20.45), 'foo', [('name:sr', 'фоо')], AddingNameRule().metadata())
+        entity = OsmLintEntity(result)
+        self.assertEqual((entity.lat, entity.lon), (44.8, 20.45))
+
+    def test_evaluate_rules_on_way(self):
+        way = StoredEntity(123, 1, 'way', {'name': 'Njegoševa', 'highway': 'residential'}, 44.8, 20.45)
+        results = evaluate_rules([AddingNameSrRule()], way)
+        self.assertEqual(len(results), 1)
+        entity = OsmLintEntity(results[0])
+        self.assertEqual((entity.entity_type, entity.id, entity.lat, entity.lon), ('way', 123, 44.8, 20.45))
+        self.assertEqual(entity.tags['val_1'], 'Његошева')
+
+    def test_way_centroid(self):
+        # As PyOsmium way is when map is read with locations of nodes
+        way = Way([Location(44.0, 20.0), Location(44.0, 21.0), Location(45.0, 21.0), Location(44.0, 20.0)])
+        self.assertEqual(OsmLintEntity.get_location(way), (44 + 1 / 3, 20 + 2 / 3))
+        self.assertIsNone(OsmLintEntity.get_location(Way([Location(None, None)])))
+
+    def test_evaluate_rules_without_location(self):
+        way = StoredEntity(123, 1, 'way', {'name:sr': 'фоо', 'place': 'village'})
+        results = evaluate_rules([AddingNameRule()], way)
+        self.assertEqual(len(results), 1)
+        # Way is not put on the map at (0, 0)
+        self.assertNotIn('loc', results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+
+from entity_store import EntityStoreWriter, StoredEntity, store_filename
+from sampling import EntitySampler, get_id, get_location, in_sample
+from sources.store_source import StoreSource
+
+
+class TestEntitySampler(unittest.TestCase):
+    def test_no_development_mode(self):
+        self.assertIsNone(EntitySampler.from_context({}))
+
+    def test_sample_is_deterministic(self):
+        taken = [i for i in range(1, 100001) if in_sample(i, 10)]
+        self.assertAlmostEqual(len(taken) / 100000, 0.1, delta=0.005)
+        self.assertEqual(taken, [i for i in range(1, 100001) if in_sample(i, 10)])
+        # Smaller sample is part of the bigger one
+        self.assertTrue(set(i for i in range(1, 100001) if in_sample(i, 1)) <= set(taken))
+
+    def test_bbox(self):
+        sampler = EntitySampler(bbox=(44.0, 20.0, 45.0, 21.0))
+        self.assertTrue(sampler.accept(StoredEntity(1, 1, 'node', {}, 44.8, 20.45)))
+        self.assertFalse(sampler.accept(StoredEntity(2, 1, 'node', {}, 43.3, 21.9)))
+        self.assertFalse(sampler.accept(StoredEntity(3, 1, 'way', {})))
+        self.assertEqual(sampler.taken, 1)
+
+    def test_sophox_result(self):
+        result = {'id': {'value': 'https://www.openstreetmap.org/node/42'}, 'loc': {'value': 'Point(20.45 44.8)'}}
+        self.assertEqual(get_id(result), 42)
+        self.assertEqual(get_location(result), (44.8, 20.45))
+
+    def test_limit(self):
+        sampler = EntitySampler(limit=2)
+        self.assertTrue(sampler.accept(StoredEntity(1, 1, 'way', {})))
+        self.assertFalse(sampler.is_done())
+        self.assertTrue(sampler.accept(StoredEntity(2, 1, 'way', {})))
+        self.assertTrue(sampler.is_done())
+        self.assertFalse(sampler.accept(StoredEntity(3, 1, 'way', {})))
+
+
+class TestSourceSampling(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.filename = store_filename(self.store_dir, 'abc', '')
+        writer = EntityStoreWriter(self.filename, 'abc', '')
+        for i in range(1, 1001):
+            writer.add('node', i, 1, (44.0 + i / 1000, 20.5), {'place': 'village', 'name': 'Село {0}'.format(i)})
+        writer.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def checked_ids(self, **context):
+        checked = []
+
+        def process_entities(entities, _):
+            checked.extend(entity.id for entity in entities)
+            return [{}] * len(entities)
+        map_checks = [{'name': 'Store', 'location': self.filename, 'checks': [], 'rules': []}]
+        source = StoreSource(context, process_entities, map_checks, self.filename)
+        source.process_map()
+        return checked, source
+
+    def test_limit_stops_reading(self):
+        checked, source = self.checked_ids(entity_limit=10)
+        self.assertEqual(len(checked), 10)
+        self.assertEqual(source.processed, 10)
+
+    def test_sample_and_bbox(self):
+        checked, source = self.checked_ids(sample_percent=50, bbox=(44.5, 20.0, 45.0, 21.0))
+        self.assertTrue(all(i >= 500 and in_sample(i, 50) for i in checked))
+        self.assertEqual(len(checked), sum(1 for i in range(500, 1001) if in_sample(i, 50)))
+        self.assertEqual(source.processed, 1000)
+        self.assertEqual(source.filtered, 1000 - len(checked))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from entity_store import StoredEntity
+from exceptions import SimulationException
+from osm_lint_entity import OsmLintEntity
+from simulation import UNKNOWN, SimulatedApi
+
+
+class TestSimulatedApi(unittest.TestCase):
+    def setUp(self):
+        self.entity = OsmLintEntity(StoredEntity(7, 3, 'node', {'highway': 'primary', 'name': 'Улица'}, 44.8, 20.4))
+
+    def test_changes(self):
+        api = SimulatedApi(self.entity)
+        node = api.NodeGet(7)
+        self.assertEqual(node['tag'], {'highway': 'primary', 'name': 'Улица'})
+        node['tag']['name:sr'] = 'Улица'
+        del node['tag']['highway']
+        # Nothing would change until entity is updated
+        self.assertEqual(api.changes(), [])
+        api.NodeUpdate(node)
+        node['tag']['name'] = 'Changed after update'
+        self.assertEqual(api.changes(), [('highway', 'primary', None), ('name:sr', None, 'Улица')])
+        self.assertEqual(self.entity.tags, {'highway': 'primary', 'name': 'Улица'})
+
+    def test_sophox_columns_are_not_tags(self):
+        # Columns as returned by changing_namesr_to_cyrillic.sparql, where name is holding value of name:sr
+        entity = OsmLintEntity({'id': {'value': 'https://www.openstreetmap.org/node/5'},
+                                'loc': {'value': 'Point(21.9 43.3)'}, 'name': {'value': 'Nis'},
+                                'tag_1': {'value': 'name:sr'}, 'val_1': {'value': 'Нис'},
+                                'metadata': {'check_description': 'Entity {0} is not having cyrillic name:sr tag'}})
+        api = SimulatedApi(entity)
+        self.assertRaises(SimulationException, api.NodeGet, 5)
+        api.suggest([('name:sr', 'Нис'), ('name:sr-Latn', None)])
+        self.assertEqual(api.changes(), [('name:sr', UNKNOWN, 'Нис'), ('name:sr-Latn', UNKNOWN, None)])
+
+    def test_other_entities_are_not_available(self):
+        api = SimulatedApi(self.entity)
+        self.assertRaises(SimulationException, api.NodeGet, 8)
+        self.assertRaises(SimulationException, api.WayGet, 7)
+        self.assertRaises(SimulationException, api.RelationUpdate, {'id': 7, 'tag': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
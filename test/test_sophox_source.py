@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from haversine import haversine
+from osm_lint_entity import OsmLintEntity
+from sources.sophox_cache import SophoxCache
+from sources.sophox_source import split_to_tiles, query_for_tile, tile_intersects, p_center, p_radius
+from sources.sophox_source import iter_lines, parse_tsv_header, parse_tsv_row, SophoxSource
+
+QUERY = """SELECT ?id ?name ?loc WHERE {
+  ?id osmt:name ?name .
+  SERVICE wikibase:around {
+    ?id osmm:loc ?loc .
+    bd:serviceParam wikibase:center "Point(21.00403 44.04751)"^^geo:wktLiteral.
+    bd:serviceParam wikibase:radius "250" .
+  }
+}"""
+
+
+class TestTiling(unittest.TestCase):
+    def test_small_area_is_not_split(self):
+        self.assertEqual(split_to_tiles((44.0, 21.0), 30, 50), [((44.0, 21.0), 30)])
+
+    def test_tiles_cover_whole_area(self):
+        center, radius = (44.04751, 21.00403), 250
+        tiles = split_to_tiles(center, radius, 50)
+        self.assertTrue(len(tiles) > 1)
+        rnd = random.Random(42)
+        for _ in range(2000):
+            point = (center[0] + rnd.uniform(-2.5, 2.5), center[1] + rnd.uniform(-3.5, 3.5))
+            if haversine(center, point) > radius:
+                continue
+            self.assertTrue(any(haversine(tile_center, point) <= tile_radius for tile_center, tile_radius in tiles))
+
+    def test_tiles_outside_bbox(self):
+        tiles = split_to_tiles((44.04751, 21.00403), 250, 50)
+        bbox = (44.7, 20.3, 44.9, 20.6)
+        inside = [tile for tile in tiles if tile_intersects(tile, bbox)]
+        self.assertTrue(0 < len(inside) < len(tiles) / 4)
+        # Belgrade is in the bounding box, it has to be covered by one of remaining tiles
+        self.assertTrue(any(haversine(tile_center, (44.8, 20.45)) <= tile_radius for tile_center, tile_radius in inside))
+
+    def test_query_for_tile(self):
+        query = query_for_tile(QUERY, ((43.5, 20.25), 50))
+        self.assertEqual(p_center.search(query).group('lat'), '43.50000')
+        self.assertEqual(p_center.search(query).group('lon'), '20.25000')
+        self.assertEqual(p_radius.search(query).group('radius'), '50.000')
+
+
+class TestTsvParsing(unittest.TestCase):
+    def test_parse_rows(self):
+        lines = list(iter_lines(['?id\t?name\t?loc\t?tag_1\t?val_1\n<https://www.openstreetmap.org/way/12',
+                                 '3>\t"Foo \\"bar\\""@sr\t"Point(20.5 44.5)"^^<http://www.opengis.net/ont/geosparql#',
+                                 'wktLiteral>\t"name:sr"\tfalse\n<https://www.openstreetmap.org/node/1>\t\t\t\t42\n']))
+        self.assertEqual(len(lines), 3)
+        variables = parse_tsv_header(lines[0])
+        self.assertEqual(variables, ['id', 'name', 'loc', 'tag_1', 'val_1'])
+
+        row = parse_tsv_row(variables, lines[1])
+        self.assertEqual(row['id'], {'type': 'uri', 'value': 'https://www.openstreetmap.org/way/123'})
+        self.assertEqual(row['name'], {'type': 'literal', 'value': 'Foo "bar"', 'xml:lang': 'sr'})
+        self.assertEqual(row['loc']['value'], 'Point(20.5 44.5)')
+        self.assertEqual(row['tag_1'], {'type': 'literal', 'value': 'name:sr'})
+        self.assertEqual(row['val_1']['datatype'], 'http://www.w3.org/2001/XMLSchema#boolean')
+
+        row = parse_tsv_row(variables, lines[2])
+        self.assertNotIn('name', row)
+        self.assertEqual(row['val_1']['datatype'], 'http://www.w3.org/2001/XMLSchema#integer')
+
+    def test_location_is_longitude_first(self):
+        lines = list(iter_lines(['?id\t?name\t?loc\n<https://www.openstreetmap.org/node/1>\t"Београд"\t'
+                                 '"Point(20.45 44.8)"^^<http://www.opengis.net/ont/geosparql#wktLiteral>\n']))
+        row = parse_tsv_row(parse_tsv_header(lines[0]), lines[1])
+        entity = OsmLintEntity(row)
+        self.assertEqual((entity.lat, entity.lon), (44.8, 20.45))
+        # Belgrade is inside area around Belgrade, and not inside the same area with axes swapped
+        self.assertTrue(SophoxSource._is_inside(row, (44.8, 20.45), 10))
+        self.assertFalse(SophoxSource._is_inside(row, (20.45, 44.8), 10))
+
+
+class TestSophoxCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache(self):
+        cache = SophoxCache(self.cache_dir, 3600)
+        self.assertIsNone(cache.get(QUERY))
+        self.assertEqual(list(cache.put(QUERY, iter(['?id', '<foo>', '<bar>']))), ['?id', '<foo>', '<bar>'])
+        self.assertEqual(list(cache.get(QUERY)), ['?id', '<foo>', '<bar>'])
+        self.assertIsNone(cache.get(QUERY + ' '))
+
+    def test_incomplete_response_is_not_cached(self):
+        cache = SophoxCache(self.cache_dir, 3600)
+
+        def failing_lines():
+            yield '?id'
+            raise IOError()
+
+        with self.assertRaises(IOError):
+            list(cache.put(QUERY, failing_lines()))
+        self.assertIsNone(cache.get(QUERY))
+
+    def test_empty_response_is_not_cached(self):
+        cache = SophoxCache(self.cache_dir, 3600)
+        self.assertEqual(list(cache.put(QUERY, iter([]))), [])
+        self.assertEqual(list(cache.put(QUERY, iter(['']))), [''])
+        self.assertIsNone(cache.get(QUERY))
+
+    def test_disabled_cache(self):
+        cache = SophoxCache(self.cache_dir, 0)
+        self.assertEqual(list(cache.put(QUERY, iter(['?id']))), ['?id'])
+        self.assertIsNone(cache.get(QUERY))
+
+
+class TestSophoxSource(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.source = SophoxSource({'sophox_cache_dir': self.cache_dir, 'sophox_cache_ttl': 3600}, None,
+                                   [{'name': 'Serbia (Sophox)', 'checks': [], 'rules': []}], QUERY)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_empty_response(self):
+        self.source._download_query = lambda query: iter([])
+        with self.assertRaisesRegex(Exception, 'empty response'):
+            next(self.source._iter_query(QUERY))
+        # It is downloaded again next time
+        self.source._download_query = lambda query: iter(['?id\t?loc\t?name', '<a>\t"Point(20 44)"\t"A"'])
+        self.assertEqual(len(list(self.source._iter_query(QUERY))), 2)
+
+    def test_tile_stops_while_queue_is_full(self):
+        self.source._download_query = lambda query: iter(['?id\t?loc\t?name'] + ['<a>\t"Point(20 44)"\t"A"'] * 5)
+        results, stop = queue.Queue(maxsize=2), threading.Event()
+        thread = threading.Thread(target=self.source._stream_query, args=(QUERY, results, stop))
+        thread.start()
+        # Tile is waiting for room in the queue, instead of buffering all results
+        while not results.full():
+            pass
+        self.assertTrue(thread.is_alive())
+        stop.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results.qsize(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import unittest
+
+from stats import CheckStats, Stats, SLOWEST
+
+
+class TestCheckStats(unittest.TestCase):
+    def test_add(self):
+        check_stats = CheckStats()
+        for i in range(1, 101):
+            check_stats.add(i / 1000.0, 'node', i)
+        self.assertEqual(check_stats.calls, 100)
+        self.assertAlmostEqual(check_stats.total, 5.05)
+        self.assertAlmostEqual(check_stats.percentile(50), 0.051)
+        self.assertAlmostEqual(check_stats.percentile(99), 0.1)
+        self.assertEqual([s['id'] for s in check_stats.to_json()['slowest']], list(range(100, 100 - SLOWEST, -1)))
+
+    def test_add_batch(self):
+        check_stats = CheckStats()
+        check_stats.add(1.0, None, None, calls=1000)
+        self.assertEqual(check_stats.calls, 1000)
+        self.assertAlmostEqual(check_stats.percentile(50), 0.001)
+        self.assertEqual(check_stats.slowest, [])
+
+
+class TestStats(unittest.TestCase):
+    def test_merge(self):
+        stats1, stats2 = Stats(), Stats()
+        stats1.count('PBF', 'entities_decoded', 10)
+        stats2.count('PBF', 'entities_decoded', 5)
+        stats2.count('Sophox', 'bytes_downloaded', 1024)
+        stats1.check('Serbia (PBF)', 'checks.NameMissingCheck').add(0.5, 'node', 1)
+        stats2.check('Serbia (PBF)', 'checks.NameMissingCheck').add(1.5, 'way', 2)
+        stats2.check('Serbia (PBF)', 'checks.NameMissingCheck').add_fix(2.0)
+
+        # This is how stats are coming back from workers
+        stats1.merge(pickle.loads(pickle.dumps(stats2)))
+        result = stats1.to_json()
+        self.assertEqual(result['sources'], {'PBF': {'entities_decoded': 15}, 'Sophox': {'bytes_downloaded': 1024}})
+        check = result['checks']['Serbia (PBF)']['checks.NameMissingCheck']
+        self.assertEqual(check['calls'], 2)
+        self.assertAlmostEqual(check['total'], 2.0)
+        self.assertEqual(check['fix_calls'], 1)
+        self.assertEqual(check['slowest'][0], {'duration': 1.5, 'entity_type': 'way', 'id': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
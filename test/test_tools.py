@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tools
+from tools import RateLimitFilter
+
+
+def _log_from_worker(log_queue):
+    tools.setup_worker_logger(log_queue)
+    tools.get_logger('worker').info('Hello from %s', 'worker')
+
+
+class TestRateLimitFilter(unittest.TestCase):
+    def record(self, name, level, msg, *args):
+        return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+    def test_debug_is_limited(self):
+        f = RateLimitFilter(5)
+        passed = [f.filter(self.record('checks', logging.DEBUG, 'Entry %d', i)) for i in range(100)]
+        self.assertEqual(sum(passed), 5)
+        # Other loggers have their own limit, and other levels are not limited
+        self.assertTrue(f.filter(self.record('engine', logging.DEBUG, 'Entry')))
+        self.assertTrue(all(f.filter(self.record('checks', logging.INFO, 'Entry')) for _ in range(100)))
+
+    def test_dropped_are_counted(self):
+        f = RateLimitFilter(1)
+        f.filter(self.record('checks', logging.DEBUG, 'Entry %d', 1))
+        for i in range(3):
+            f.filter(self.record('checks', logging.DEBUG, 'Entry %d', i))
+        f.buckets['checks'][0] = 1
+        record = self.record('checks', logging.DEBUG, 'Entry %d', 4)
+        self.assertTrue(f.filter(record))
+        self.assertEqual(record.getMessage(), 'Entry 4 (3 similar records dropped)')
+
+
+class TestQueueLogging(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        tools.stop_logger()
+        logger = logging.getLogger('serbian-osm-lint')
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_worker_records_are_written_by_main_process(self):
+        mp_context = multiprocessing.get_context('spawn')
+        log_queue = mp_context.Queue()
+        tools.setup_logger(logging.WARNING, log_queue)
+        tools.get_logger('main').debug('Hello from %s', 'main')
+        worker = mp_context.Process(target=_log_from_worker, args=(log_queue,))
+        worker.start()
+        worker.join()
+        tools.stop_logger()
+
+        with open('serbian-osm-lint.log', 'r', encoding='utf-8') as f:
+            log = f.read()
+        self.assertIn('serbian-osm-lint.main - DEBUG - Hello from main', log)
+        self.assertIn('serbian-osm-lint.worker - INFO - Hello from worker', log)
+
+
+
+class TestSharedDb(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_thread_connection(self):
+        filename = os.path.join(self.directory, 'shared.db')
+        local = threading.local()
+        connection = tools.thread_connection(local, filename)
+        self.assertIs(tools.thread_connection(local, filename), connection)
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(tools.thread_connection(local, filename)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], connection)
+
+
+if __name__ == '__main__':
+    unittest.main()